@@ -0,0 +1,83 @@
+import os
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
+import sys
+import resource
+import timeit
+import multiprocessing
+import numpy as np
+from utility.model_registry import configure_model_registry, load_scibert, model_size_bytes
+from utility.transform_question_to_vector import embed_docs
+from utility.onnx_backend import check_embedding_parity
+from utility.sync_fetch_data import initialize_and_fetch_db
+
+# (backend, quantize_int8), the first entry is the eager reference every other backend is compared against
+BENCHMARK_BACKENDS = [('torch', False), ('torch', True), ('onnx', False), ('onnx', True)]
+sample_size = 512
+batch_size  = 32
+num_threads = None
+parity_threshold = 0.999
+
+def load_sample_docs(limit: int):
+    db = initialize_and_fetch_db()
+    rows = db.execute("SELECT doc FROM question_answer_pairs WHERE doc IS NOT NULL ORDER BY question_id LIMIT ?", (limit,)).fetchall()
+    db.close()
+    return [doc for (doc,) in rows]
+
+def run_backend(embedding_backend: str, quantize_int8: bool, docs, results) -> None:
+    """
+    Embeds docs with one backend, run in its own process so peak RSS is measured per backend.
+    """
+    configure_model_registry(num_threads=num_threads, quantize_int8=quantize_int8, embedding_backend=embedding_backend)
+    load_start = timeit.default_timer()
+    tokenizer, model = load_scibert(embedding_backend, quantize_int8)
+    load_seconds = timeit.default_timer() - load_start
+    # One small batch first, so one-off allocation costs stay out of the timing
+    embed_docs(tokenizer, model, docs[:batch_size], batch_size)
+    start = timeit.default_timer()
+    result = embed_docs(tokenizer, model, docs, batch_size)
+    seconds = timeit.default_timer() - start
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    results.put({
+        'embeddings': result['embeddings'],
+        'load_seconds': load_seconds,
+        'seconds': seconds,
+        'tokens': result['tokens'],
+        'model_bytes': model_size_bytes(model),
+        'peak_rss': peak_rss
+    })
+
+def main():
+    docs = load_sample_docs(sample_size)
+    if not docs:
+        raise ValueError("No docs in the local database, run the pipeline's create_docs first")
+    print(f"Benchmarking {len(BENCHMARK_BACKENDS)} backends on {len(docs)} docs (batch_size={batch_size}, num_threads={num_threads})")
+
+    context = multiprocessing.get_context('spawn')
+    reports = {}
+    for embedding_backend, quantize_int8 in BENCHMARK_BACKENDS:
+        results = context.Queue()
+        process = context.Process(target=run_backend, args=(embedding_backend, quantize_int8, docs, results))
+        process.start()
+        reports[(embedding_backend, quantize_int8)] = results.get()
+        process.join()
+
+    reference = reports[BENCHMARK_BACKENDS[0]]['embeddings']
+    failed = []
+    print(f"{'backend':<12} {'load s':>7} {'docs/s':>8} {'tokens/s':>9} {'model MiB':>10} {'peak RSS MiB':>13} {'min cos':>8} {'mean cos':>9}")
+    for (embedding_backend, quantize_int8), report in reports.items():
+        parity = check_embedding_parity(reference, report['embeddings'], parity_threshold)
+        # int8 weights are expected to drift further than float graph rewrites, they are reported but not enforced
+        if not quantize_int8 and not parity['passed']:
+            failed.append(embedding_backend)
+        name = f"{embedding_backend}{':int8' if quantize_int8 else ''}"
+        print(f"{name:<12} {report['load_seconds']:>7.2f} {len(docs) / report['seconds']:>8.1f} "
+              f"{report['tokens'] / report['seconds']:>9.0f} {report['model_bytes'] / 1024 ** 2:>10.1f} "
+              f"{report['peak_rss'] / 1024 ** 2:>13.1f} {parity['min_cosine']:>8.5f} {parity['mean_cosine']:>9.5f}")
+
+    if failed:
+        raise SystemExit(f"Parity check failed (min cosine < {parity_threshold} against eager torch) for: {', '.join(failed)}")
+    print(f"Parity check passed: every float backend has cosine >= {parity_threshold} against eager torch")
+
+if __name__ == "__main__":
+    main()
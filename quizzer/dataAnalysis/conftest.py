@@ -0,0 +1,2 @@
+# conftest.py
+# Lets tests import the pipeline's modules (utility.*) the same way the scripts in this directory do
@@ -11,10 +11,10 @@ import random
 
 def pre_process_training_data():
     # Get our unprocessed table and load into a dataframe
-    df = ap.get_attempt_dataframe()
+    df, question_vectors = ap.get_attempt_dataframe()
 
-    # Unpack embedded features
-    df = ap.flatten_attempts_dataframe(df)
+    # Unpack embedded features (question vectors are expanded per attempt here, by index)
+    df = ap.flatten_attempts_dataframe(df, question_vectors)
 
     # # Impute and handle missing values (nulls)
     # df = ap.handle_nulls(df)
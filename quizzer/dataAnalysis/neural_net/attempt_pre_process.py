@@ -5,22 +5,25 @@ from utility.sync_fetch_data import initialize_and_fetch_db
 from sklearn.preprocessing import OneHotEncoder
 import pandas as pd
 import json
+import typing
 from typing import List, Dict, Any
 from imblearn.over_sampling import SMOTE
 import numpy as np
 import tensorflow as tf
 from datetime import datetime, timezone
 from utility.sync_fetch_data import initialize_supabase_session
+from utility.vector_store import load_question_vector_matrix
 from sklearn.model_selection import train_test_split
 
-def get_attempt_dataframe() -> pd.DataFrame:
+def get_attempt_dataframe() -> typing.Tuple[pd.DataFrame, np.ndarray]:
     """
     Reads all records from the question_answer_attempts table and returns as a pandas DataFrame.
-    Before querying, updates question_vectors in attempts table to match current vectors 
-    from question_answer_pairs table to ensure consistency.
+    Question vectors are not copied into the attempts: the unique vectors of question_answer_pairs
+    are loaded once as a dense float32 matrix, and every attempt carries only the integer row
+    (question_vector_index, -1 when its question has no vector) used to expand it in flatten_question_vector.
     
     Returns:
-        A pandas DataFrame containing all records from the question_answer_attempts table.
+        (df, question_vectors): the attempts DataFrame and the (n_questions, dims) question vector matrix.
     """
     db = initialize_and_fetch_db()
     
@@ -35,70 +38,35 @@ def get_attempt_dataframe() -> pd.DataFrame:
     except:
         pass
     
-    # Update question_vectors in attempts table from pairs table
-    print("Updating question_vectors in attempts table...")
     cursor = db.cursor()
+    cursor.execute("PRAGMA table_info(question_answer_attempts)")
+    attempt_columns = [row[1] for row in cursor.fetchall() if row[1] != 'question_vector']
     
-    # Get count of records that need updating
-    cursor.execute("""
-        SELECT COUNT(*) 
-        FROM question_answer_attempts qa
-        INNER JOIN question_answer_pairs qp ON qa.question_id = qp.question_id
-        WHERE qa.question_vector != qp.question_vector OR qa.question_vector IS NULL
-    """)
-    update_count = cursor.fetchone()[0]
-    print(f"Found {update_count} records with outdated question_vectors")
-    
-    if update_count > 0:
-        # Update the question_vectors
-        cursor.execute("""
-            UPDATE question_answer_attempts 
-            SET question_vector = (
-                SELECT question_vector 
-                FROM question_answer_pairs 
-                WHERE question_answer_pairs.question_id = question_answer_attempts.question_id
-            )
-            WHERE question_id IN (
-                SELECT question_id FROM question_answer_pairs 
-                WHERE question_answer_pairs.question_vector IS NOT NULL
-            )
-        """)
-        
-        db.commit()
-        print(f"Updated {cursor.rowcount} question_vectors in attempts table")
-    else:
-        print("All question_vectors are already up to date")
-    
-    # Now query the updated table
-    query = "SELECT * FROM question_answer_attempts"
+    query = f"SELECT {', '.join(attempt_columns)} FROM question_answer_attempts"
     df = pd.read_sql_query(query, db)
     
     print("Raw dataframe shape:", df.shape)
     
-    # Verify question_vector consistency
-    if 'question_vector' in df.columns:
-        vector_lengths = df['question_vector'].apply(
-            lambda x: len(json.loads(x)) if isinstance(x, str) and x.strip() else 0
-        )
-        unique_lengths = vector_lengths.unique()
-        print(f"Question vector lengths found: {sorted(unique_lengths)}")
-        
-        if len(unique_lengths) > 1:
-            print("WARNING: Multiple question vector lengths detected!")
-            for length in sorted(unique_lengths):
-                count = (vector_lengths == length).sum()
-                print(f"  Length {length}: {count} records")
+    question_vector_rows, question_vectors = load_question_vector_matrix(db)
+    df['question_vector_index'] = df['question_id'].map(question_vector_rows).fillna(-1).astype(np.int32)
+    print(f"Loaded {question_vectors.shape[0]} unique question vectors of dimension {question_vectors.shape[1]} "
+          f"({question_vectors.nbytes / 1e6:.1f} MB)")
+    
+    missing_vectors = int((df['question_vector_index'] < 0).sum())
+    if missing_vectors:
+        print(f"WARNING: {missing_vectors} attempts reference questions without a question_vector")
     
     db.close()
-    return df
+    return df, question_vectors
 
-def flatten_attempts_dataframe(df: pd.DataFrame) -> pd.DataFrame:
+def flatten_attempts_dataframe(df: pd.DataFrame, question_vectors: np.ndarray) -> pd.DataFrame:
     """
     Unpacks and cleans the question_answer_attempts DataFrame.
     Handles JSON string fields properly using pandas json_normalize.
     
     Args:
         df: Raw DataFrame from question_answer_attempts table
+        question_vectors: Question vector matrix returned alongside df by get_attempt_dataframe
         
     Returns:
         Flattened DataFrame with unpacked features and bad columns removed
@@ -130,7 +98,7 @@ def flatten_attempts_dataframe(df: pd.DataFrame) -> pd.DataFrame:
     processed_df = flatten_user_profile_record(processed_df, "up")
 
     # unpack question_vector
-    processed_df = flatten_question_vector(processed_df, "qv")
+    processed_df = flatten_question_vector(processed_df, "qv", question_vectors)
 
     # unpack knn_performance_vector
     processed_df = flatten_knn_performance_vector(processed_df, "knn")
@@ -275,39 +243,23 @@ def flatten_user_profile_record(df: pd.DataFrame, prefix: str) -> pd.DataFrame:
         flattened_df.reset_index(drop=True)
     ], axis=1)
 
-def flatten_question_vector(df: pd.DataFrame, prefix: str) -> pd.DataFrame:
-    if 'question_vector' not in df.columns:
+def flatten_question_vector(df: pd.DataFrame, prefix: str, question_vectors: np.ndarray) -> pd.DataFrame:
+    """
+    Expands each attempt's question_vector_index into one column per vector dimension.
+    Attempts without a vector (index -1) select the zero row appended to the matrix.
+    """
+    if 'question_vector_index' not in df.columns:
         return df
     
-    # Parse JSON arrays and create columns for each index
-    parsed_series = df['question_vector'].apply(lambda x: json.loads(x) if isinstance(x, str) else x)
-    
-    # Get the maximum vector length across all rows
-    max_length = 0
-    for vector in parsed_series:
-        if isinstance(vector, list):
-            max_length = max(max_length, len(vector))
-    
-    # Create columns for each vector index
-    vector_data = []
-    for vector in parsed_series:
-        row_data = {}
-        if isinstance(vector, list):
-            for i in range(max_length):
-                col_name = f"{prefix}_{i}"
-                row_data[col_name] = vector[i] if i < len(vector) else 0
-        else:
-            # Fill with zeros if not a list
-            for i in range(max_length):
-                col_name = f"{prefix}_{i}"
-                row_data[col_name] = 0
-        
-        vector_data.append(row_data)
-    
-    flattened_df = pd.DataFrame(vector_data)
+    padded_vectors = np.vstack([question_vectors, np.zeros((1, question_vectors.shape[1]), dtype=question_vectors.dtype)])
+    vector_matrix = padded_vectors[df['question_vector_index'].to_numpy()]
+    flattened_df = pd.DataFrame(
+        vector_matrix,
+        columns=[f"{prefix}_{i}" for i in range(vector_matrix.shape[1])]
+    )
     
     return pd.concat([
-        df.drop(columns=['question_vector']).reset_index(drop=True), 
+        df.drop(columns=['question_vector_index']).reset_index(drop=True), 
         flattened_df.reset_index(drop=True)
     ], axis=1)
 
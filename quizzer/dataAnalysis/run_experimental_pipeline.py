@@ -1,72 +1,147 @@
 import os
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
-import umap
 import timeit
 import hdbscan
 import supabase
 import datetime
 import pandas as pd
-from pathlib import Path
 from bertopic import BERTopic
 from sklearn.cluster import KMeans
 from neural_net import reports as rp
 from neural_net import attempt_pre_process as ap
-from sentence_transformers import SentenceTransformer
+from utility.cached_embedder import CachedSentenceEmbedder
 from bertopic.vectorizers import ClassTfidfTransformer
-from utility.transform_question_to_vector import vectorize_records
+from utility.transform_question_to_vector import vectorize_records, fill_question_features
+from utility.model_registry import configure_model_registry, report_model_memory
 from sklearn.feature_extraction.text import CountVectorizer
 from neural_net.grid_search import grid_search_quizzer_model
 from neural_net.accuracy_net import pre_process_training_data
 from neural_net.grid_search import train_and_save_batch_configs
+from utility.topic_model_store import (load_topic_model_snapshot, save_topic_model_snapshot, plan_topic_model_update,
+                                       update_topic_model_incrementally, build_topic_model_state, new_fit_info)
+from utility.reduction_service import build_umap_model, measure_projection_drift
+from utility.topic_report import start_topic_report
 from utility.bertopic_helpers import create_docs, export_outlier_topics_to_docx, set_process_limits
 from bertopic.representation import KeyBERTInspired, MaximalMarginalRelevance
-from utility.sync_fetch_data import (initialize_and_fetch_db, get_last_sync_date, fetch_new_records_from_supabase, 
-                             update_last_sync_date,find_newest_timestamp,upsert_records_to_db, 
+from utility.sync_fetch_data import (initialize_and_fetch_db, get_last_sync_date, get_table_sync_cursors, stream_new_records_from_supabase, 
+                             update_last_sync_date,
                              fetch_data_for_bertopic, initialize_supabase_session, sync_vectors_to_supabase,
                              sync_knn_results_to_supabase, clean_deleted_records_locally,
                              save_changed_records, load_changed_records)
 from neural_net.prediction_net.model_def import train_question_accuracy_model
 
-from utility.knn_utils import (compute_complete_pairwise_distances, plot_distance_distribution, compute_knn_model, update_knn_vectors_locally)
+from utility.knn_utils import (compute_distance_distribution, plot_distance_distribution, update_knn_vectors_locally)
+from utility.ann_index import refresh_knn_index, measure_knn_recall
 from sklearn.mixture import GaussianMixture
 # Define Globals
 bypass_model_train      = False  # topic model
 reset_question_vector   = False
 reset_doc               = False
+generate_topic_report   = True   # BERTopic HTML visualizations, rendered in a background process after the sync
+report_docs_per_topic   = 100    # document plots show a stratified sample of at most this many docs per topic
+force_topic_refit       = False  # refit BERTopic even when the saved model could transform the changed docs
+model_num_threads       = None   # torch intra-op threads for BLIP / SciBERT, None keeps torch's default
+quantize_models         = False  # dynamic int8 quantization of BLIP / SciBERT on CPU
+embedding_backend       = 'torch'  # 'torch' (eager) or 'onnx' (onnxruntime) for SciBERT, compare with benchmark_embedding_backends.py
+sync_text_features      = False    # fill is_math / keywords during every sync (spawned process pool, see fill_question_features)
+distance_sample_pairs   = None     # histogram this many uniformly sampled pairs for the distance plots, None streams every pair
+knn_backend             = 'exact'  # 'exact', 'ivf' (approximate) or 'hnsw' (approximate, hnswlib, euclidean / cosine only: with manhattan it falls back to 'exact')
+report_knn_recall       = False    # brute force recall@25 of the KNN index on a sample of questions, for judging 'ivf' / 'hnsw'
 
 # Timing Globals
 
 def run_data_sync_process(supabase_client, db):
     '''
     Fetches Fresh Data, Syncs new data from models
+    Returns per-stage statistics for the final report
     '''
     last_sync_date: datetime = get_last_sync_date()
-    print(f"Got last sync time of: {last_sync_date}")
-    new_records = fetch_new_records_from_supabase(
+    table_cursors = get_table_sync_cursors()
+    print(f"Resuming sync from cursors: {table_cursors}")
+    # Both tables are fetched concurrently, each page is written to the local db as it arrives and checkpointed
+    sync_summary = stream_new_records_from_supabase(
         supabase_client     =supabase_client,
-        last_sync_date      =last_sync_date
+        db                  =db,
+        table_cursors       =table_cursors
     )
-    # Now we need to save the new records to our local db file:
-    upsert_records_to_db(
-        records=new_records,
-        db = db,
-        supabase_client=supabase_client)
     
-    # Assuming we got anything back, update the last sync date for future runs (do this after we have recorded our return values)
-    update_last_sync_date(find_newest_timestamp(records=new_records))
+    # Tables advance independently, so never move the overall last sync date backwards
+    newest_timestamps = [table_summary['newest_timestamp'] for table_summary in sync_summary.values() if table_summary['newest_timestamp']]
+    update_last_sync_date(max(newest_timestamps + [last_sync_date]))
     clean_deleted_records_locally(db=db, supabase_client=supabase_client)
 
     # Ensure all question records have their doc created and placed back into the database
     create_docs() # {question_id: "", ..., doc: ""}
 
     # Pre-Compute vectors (so we don't have to recalculate 10,000's of records every run)
-    vectorize_records()
+    vectorize_stats = vectorize_records()
+    # is_math / keywords for the question records, nothing in this pipeline reads them yet
+    feature_stats = fill_question_features() if sync_text_features else None
     sync_vectors_to_supabase(reset_attempts_vector=reset_question_vector, reset_question_vector=reset_question_vector)
 
     changed_records = load_changed_records()
     sync_knn_results_to_supabase(db, supabase_client, changed_records, get_last_sync_date())
     # Once results are synced, clear the local changed_records cache (preventing repeats)
     save_changed_records([])
+    return {'vectorize': vectorize_stats, 'features': feature_stats}
+
+def build_topic_model(embedding_model, n_clusters, random_state) -> BERTopic:
+    '''
+    Unfitted BERTopic pipeline, only built when the topic model is (re)fit
+    '''
+    # Define Dimensionality Reduction model for bertopic (settings in reduction_service.UMAP_SETTINGS)
+    umap_model              = build_umap_model()
+    ######################################
+    # Define What clustering model to use:
+    ######################################
+    cluster_models = [
+        hdbscan.HDBSCAN(
+            min_cluster_size    = 25,
+            min_samples         = 10,
+            metric              = 'manhattan', #FIXME Evaluate better distance metric
+            cluster_selection_method = 'eom',
+            prediction_data     = True
+        ),
+        # These models require us to know what the number of clusters is before hand, since we don't know this information it presents an issue
+        KMeans(
+            n_clusters=n_clusters,
+            random_state=random_state
+        ),
+        GaussianMixture(n_components=3, random_state=42)
+    ]
+    # Select from list:
+    clustering_model        = cluster_models[0]
+
+    # Define which count vectorizer we will use for bertopic
+    vectorizer              = CountVectorizer(
+        lowercase   = True,
+        max_df      = 0.80,
+        stop_words  = 'english', # keep stopwords, but remove common words
+        ngram_range = (1,4)
+    )
+
+    # Define c_tf_idf model for bertopic
+    c_tf_idf                = ClassTfidfTransformer(
+        reduce_frequent_words   = True,
+        bm25_weighting          = True,
+        )
+
+    # Define the representation model for bertopic
+    representation_model    = MaximalMarginalRelevance(diversity=0.3)
+    
+    # Define the bertopic initialization using the models we've defined
+    return BERTopic(
+        verbose                 = True,
+        calculate_probabilities = True,
+        top_n_words             = 10,
+        embedding_model         = embedding_model,
+        umap_model              = umap_model,
+        hdbscan_model           = clustering_model,
+        vectorizer_model        = vectorizer,
+        ctfidf_model            = c_tf_idf,
+        representation_model    = representation_model,
+        # seed_topic_list     = seed_topics,
+    )
 
 def main():
     set_process_limits()
@@ -79,6 +154,8 @@ def main():
     n_clusters              = 31
     random_state            = 69
 
+    configure_model_registry(num_threads=model_num_threads, quantize_int8=quantize_models,
+                             embedding_backend=embedding_backend)
     overall_start = timeit.default_timer()
     # First we need initialize our supabase client and the local db file:
     supabase_client: supabase   = initialize_supabase_session()
@@ -88,115 +165,66 @@ def main():
         reset_doc=reset_doc
         )
     
-    run_data_sync_process(supabase_client = supabase_client,
-                          db = db)
-
-    start = timeit.default_timer()
-    end = timeit.default_timer()
-    topic_model_train_time = end - start # Set to now in case model doesn't run
+    sync_reports = [run_data_sync_process(supabase_client = supabase_client,
+                                          db = db)]
+
+    topic_report_process = None
+    projection_report = None  # UMAP projection of new and changed questions, set by the incremental path
+    projection_drift = None   # neighbour overlap of the previous coordinates vs. a full refit, set by the refit path
+    topic_model_fit_time = None        # full refit, None when the saved model was reused
+    topic_model_transform_time = None  # incremental transform of new and changed docs, None when skipped
+    knn_report = None
     if not bypass_model_train:
         docs, embeddings, question_ids = fetch_data_for_bertopic(db)
-        embedding_model = SentenceTransformer('sentence-transformers/allenai-specter')
-        # Define Dimensionality Reduction model for bertopic 
-        umap_model              = umap.UMAP(
-                n_neighbors     = 25,
-                n_components    = 25,
-                min_dist        = 0.01,
-                spread          = 0.5,
-                random_state    = 0,
-                metric          = 'manhattan'
-            )
-        ######################################
-        # Define What clustering model to use:
-        ######################################
-        cluster_models = [
-            hdbscan.HDBSCAN(
-                min_cluster_size    = 25,
-                min_samples         = 10,
-                metric              = 'manhattan', #FIXME Evaluate better distance metric
-                cluster_selection_method = 'eom',
-                prediction_data     = True
-            ),
-            # These models require us to know what the number of clusters is before hand, since we don't know this information it presents an issue
-            KMeans(
-                n_clusters=n_clusters,
-                random_state=random_state
-            ),
-            GaussianMixture(n_components=3, random_state=42)
-        ]
-        # Select from list:
-        clustering_model        = cluster_models[0]
-
-        # Define which count vectorizer we will use for bertopic
-        vectorizer              = CountVectorizer(
-            lowercase   = True,
-            max_df      = 0.80,
-            stop_words  = 'english', # keep stopwords, but remove common words
-            ngram_range = (1,4)
-        )
-
-        # Define c_tf_idf model for bertopic
-        c_tf_idf                = ClassTfidfTransformer(
-            reduce_frequent_words   = True,
-            bm25_weighting          = True,
-            )
+        # Document embeddings come from SciBERT, SPECTER only embeds keywords and representative docs, served from the embedding cache
+        embedding_model = CachedSentenceEmbedder('sentence-transformers/allenai-specter')
 
-        # Define the representation model for bertopic
-        representation_model    = MaximalMarginalRelevance(diversity=0.3)
-        
-        # Define the bertopic initialization using the models we've defined
+        # Reuse the saved model unless too much changed since it was fit
         start = timeit.default_timer()
-
-        topic_model = BERTopic(
-            verbose                 = True,
-            calculate_probabilities = True,
-            top_n_words             = 10,
-            embedding_model         = embedding_model,
-            umap_model              = umap_model,
-            hdbscan_model           = clustering_model,
-            vectorizer_model        = vectorizer,
-            ctfidf_model            = c_tf_idf,
-            representation_model    = representation_model,
-            # seed_topic_list     = seed_topics,
-        )
-
-        # Create visualizations directory if it doesn't exist
-        vis_dir = Path("bertopic_visualizations")
-        vis_dir.mkdir(exist_ok=True)
-
-        # Fit the model
-        topics, probabilities = topic_model.fit_transform(docs, embeddings)
-
-        # Get topic info
-        topic_info = topic_model.get_topic_info()
-        topic_info.to_csv(vis_dir / "topic_info.csv", index=False)
-
-        # Generate and save all BERTopic visualizations
-        topic_model.visualize_topics().write_html(str(vis_dir / "topics.html"))
-        
-        topic_model.visualize_documents(docs, embeddings=embeddings, hide_annotations=True).write_html(str(vis_dir / "documents.html"))
-        topic_model.visualize_hierarchy().write_html(str(vis_dir / "hierarchy.html"))
-        topic_model.visualize_barchart(top_n_topics=50).write_html(str(vis_dir / "barchart.html"))
-        topic_model.visualize_heatmap().write_html(str(vis_dir / "heatmap.html"))
-        # topic_model.visualize_term_rank().write_html(str(vis_dir / "term_rank.html"))
-
-        hierarchical_topics = topic_model.hierarchical_topics(docs)
-        topic_model.visualize_hierarchical_documents(docs, hierarchical_topics=hierarchical_topics, embeddings=embeddings).write_html(str(vis_dir / "hierarchical_documents.html"))
-
-        print(f"Visualizations saved to {vis_dir}")
-        end = timeit.default_timer()
-        topic_model_train_time = end - start
+        topic_model, topic_state = load_topic_model_snapshot(embedding_model)
+        previous_topic_state = topic_state
+        update_plan = plan_topic_model_update(topic_state, question_ids, docs)
+        needs_refit = update_plan['refit'] or force_topic_refit
+        print(f"Topic model: {update_plan['reason']}{', refit forced' if force_topic_refit else ''}")
+        if not needs_refit:
+            topic_state, projection_report = update_topic_model_incrementally(topic_model, topic_state, update_plan,
+                                                                               question_ids, docs, embeddings)
+            topic_model_transform_time = timeit.default_timer() - start
+            print(f"Topic model: {projection_report['reason']}")
+            needs_refit = topic_state is None
+            if not needs_refit:
+                save_topic_model_snapshot(None, topic_state)
+
+        if needs_refit:
+            start = timeit.default_timer()
+            topic_model = build_topic_model(embedding_model, n_clusters, random_state)
+            # Fit the model
+            topics, probabilities = topic_model.fit_transform(docs, embeddings)
+            topic_model_fit_time = timeit.default_timer() - start
+            topic_state = build_topic_model_state(question_ids, docs, embeddings, topic_model.umap_model.embedding_, topics,
+                                                  new_fit_info(topics, topic_model_fit_time))
+            save_topic_model_snapshot(topic_model, topic_state)
+            # How far the coordinates used since the previous fit (projected ones especially) were from a full refit
+            if previous_topic_state is not None:
+                projection_drift = measure_projection_drift(previous_topic_state, question_ids, topic_state['reduced_embeddings'])
+        print(f"SPECTER embedding cache: {embedding_model.cache_hits} hits, {embedding_model.encoded} texts encoded")
 
         # Save data locally
-        reduced_embeddings = topic_model.umap_model.embedding_
+        reduced_embeddings = topic_state['reduced_embeddings']
 
         # Visualize distance distribution of points (Are all points equally distant?)
-        distance_matrix = compute_complete_pairwise_distances(reduced_embeddings)
-        plot_distance_distribution(distance_matrix)
+        plot_distance_distribution(compute_distance_distribution(reduced_embeddings, max_pairs=distance_sample_pairs))
         
         # save only the updated values, if the knn vector has changed from last time then wipe it and it's neighbors (resetting dynamically)
-        knn_model = compute_knn_model(embeddings=reduced_embeddings, k=25)
-        changed_records, total_records = update_knn_vectors_locally(db=db, question_ids=question_ids, knn_model=knn_model, embeddings=reduced_embeddings)
+        # After a refit every coordinate moved, otherwise only new and changed questions are re-indexed and only their surroundings re-queried
+        knn_index, knn_query_rows, knn_neighbors, knn_report = refresh_knn_index(topic_state, previous_topic_state, update_plan['changed'],
+                                                                                 full_rebuild=needs_refit, backend=knn_backend, k=25)
+        changed_records, total_records = update_knn_vectors_locally(db=db, question_ids=question_ids, knn_model=knn_index,
+                                                                    embeddings=reduced_embeddings, query_rows=knn_query_rows,
+                                                                    neighbors=knn_neighbors)
+        knn_report['queried'] = len(knn_query_rows)
+        if report_knn_recall:
+            knn_report.update(measure_knn_recall(knn_index, reduced_embeddings, k=25))
         print(f"KNN vectors changed for {len(changed_records)}/{total_records} records")
 
         save_changed_records(changed_records)
@@ -210,8 +238,12 @@ def main():
         # export_outlier_topics_to_docx(topic_model=topic_model)
 
         # Run the data sync again, so we immediately push new data.
-        run_data_sync_process(supabase_client = supabase_client,
-                            db = db)
+        sync_reports.append(run_data_sync_process(supabase_client = supabase_client,
+                                                  db = db))
+
+        # Visualizations render in the background from the saved snapshot, nothing above waited on them
+        if generate_topic_report:
+            topic_report_process = start_topic_report(docs, embeddings, topic_state['topics'], max_docs_per_topic=report_docs_per_topic)
     # ================================================================================
     # # Begin neural net pipeline
     # if not bypass_prediction_model:
@@ -282,13 +314,47 @@ def main():
 
 
 
+    if topic_report_process is not None:
+        start = timeit.default_timer()
+        topic_report_process.join()
+        print(f"Waited {timeit.default_timer() - start:.2f}s for the topic report to finish")
+
     overall_end = timeit.default_timer()
     overall_time = overall_end - overall_start
     print("Final Report")
     # print(f"Got {len(new_records['question_answer_pairs'])} total qa records from supabase")
     # print(f"Got {len(new_records['question_answer_attempts'])} total attempt records from supabase")
-    print(f"Bertopic Training took: {topic_model_train_time:.5f} seconds")
+    if topic_model_transform_time is not None:
+        print(f"Bertopic incremental transform took: {topic_model_transform_time:.5f} seconds "
+              f"(last full fit took {topic_state['fit_seconds']:.5f} seconds)")
+    if topic_model_fit_time is not None:
+        print(f"Bertopic full refit took: {topic_model_fit_time:.5f} seconds")
+    if projection_report is not None:
+        print(f"UMAP projection: {projection_report['projected']} questions, "
+              f"{projection_report['seconds_per_question'] * 1000:.2f} ms per question")
+    if projection_drift is not None:
+        print(f"UMAP refit neighbour overlap (k=25, {projection_drift['sampled']} sampled): "
+              f"{projection_drift['overall_overlap']:.1%} overall, {projection_drift['projected_overlap']:.1%} "
+              f"for the {projection_drift['projected_questions']} projected questions")
+    if knn_report is not None:
+        print(f"KNN index ({knn_backend}): build {knn_report['build_seconds']:.3f}s, update {knn_report['update_seconds']:.3f}s, "
+              f"queried {knn_report['queried']} questions in {knn_report['query_seconds']:.3f}s")
+        if 'recall' in knn_report:
+            print(f"KNN recall@25 vs exact: {knn_report['recall']:.1%} ({knn_report['sampled']} sampled, {knn_report['query_ms']:.2f} ms per query)")
     print(f"Pipeline took:          {overall_time:.5f} seconds from start to finish")
+    for run_number, sync_report in enumerate(sync_reports, start=1):
+        vectorize_stats = sync_report['vectorize']
+        print(f"Sync run {run_number} vectorization: {vectorize_stats['records']} records, "
+              f"{vectorize_stats['embedded']} embedded ({vectorize_stats['long_docs']} chunked), "
+              f"{vectorize_stats['cache_hits']} embedding cache hits, "
+              f"{vectorize_stats['sequences_per_sec']:.1f} sequences/sec")
+        feature_stats = sync_report['features']
+        if feature_stats is not None:
+            print(f"Sync run {run_number} text features: {feature_stats['records']} records, "
+                  f"{feature_stats['extracted']} extracted, {feature_stats['cache_hits']} feature cache hits, "
+                  f"{feature_stats['timeouts']} parse timeouts, {feature_stats['records_per_sec']:.1f} records/sec")
+    print("Model memory:")
+    report_model_memory()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,28 @@
+-- Hash-bucketed question_id checksums used by clean_deleted_records_locally (utility/sync_fetch_data.py).
+-- A question_id's bucket is the first bucket_prefix_length hex characters of md5(question_id).
+-- A bucket's checksum is md5 of its ids joined with ',' in byte order, which the client reproduces locally.
+-- Both functions return a single JSON/array value so PostgREST's max-rows limit does not truncate them.
+
+create or replace function question_id_bucket_checksums(bucket_prefix_length int default 2)
+returns jsonb
+language sql
+stable
+as $$
+    select coalesce(jsonb_object_agg(bucket, checksum), '{}'::jsonb)
+    from (
+        select left(md5(question_id::text), bucket_prefix_length) as bucket,
+               md5(string_agg(question_id::text, ',' order by question_id::text collate "C")) as checksum
+        from question_answer_pairs
+        group by 1
+    ) buckets
+$$;
+
+create or replace function question_ids_in_buckets(buckets text[], bucket_prefix_length int default 2)
+returns text[]
+language sql
+stable
+as $$
+    select coalesce(array_agg(question_id::text), '{}')
+    from question_answer_pairs
+    where left(md5(question_id::text), bucket_prefix_length) = any(buckets)
+$$;
@@ -0,0 +1,86 @@
+# test_bertopic_helpers.py
+import json
+import sqlite3
+import pytest
+
+# The doc pipeline's import chain, BLIP and Tesseract themselves are faked below
+for module_name in ("torch", "torchvision", "transformers", "pytesseract", "docx", "pylatexenc", "yake", "latex2sympy2"):
+    pytest.importorskip(module_name)
+
+from PIL import Image
+from utility import bertopic_helpers
+from utility.sync_fetch_data import initialize_and_fetch_db
+
+class FakeBlip:
+    """
+    Stands in for BLIP's processor and model, generate raises while fail is set.
+    """
+    def __init__(self):
+        self.fail = False
+        self.generate_calls = 0
+
+    def __call__(self, images, return_tensors):
+        return {'images': images}
+
+    def generate(self, images, max_length, num_beams):
+        self.generate_calls += 1
+        if self.fail:
+            raise RuntimeError("out of memory")
+        return images
+
+    def batch_decode(self, out, skip_special_tokens):
+        return [f"a picture of color {img.getpixel((0, 0))}" for img in out]
+
+@pytest.fixture
+def doc_pipeline(tmp_path, monkeypatch):
+    """
+    A data.db with two questions sharing one image, every cache file under tmp_path and BLIP / OCR faked.
+    """
+    monkeypatch.chdir(tmp_path)
+    db = initialize_and_fetch_db()
+    for question_id in ('q1', 'q2'):
+        db.execute("""
+            INSERT INTO question_answer_pairs (question_id, question_elements, answer_elements, question_type, qst_contrib)
+            VALUES (?, ?, '[]', 'multiple_choice', 'tester')
+        """, (question_id, json.dumps([{'type': 'text', 'content': f'question {question_id}'},
+                                       {'type': 'image', 'content': 'shared.png'}])))
+    db.commit()
+    db.close()
+
+    blip = FakeBlip()
+    monkeypatch.setattr(bertopic_helpers, 'get_blip', lambda: (blip, blip))
+    monkeypatch.setattr(bertopic_helpers, 'prefetch_images', lambda image_names, max_workers: {})
+    monkeypatch.setattr(bertopic_helpers, 'load_image', lambda image_name: Image.new('RGB', (8, 8), color=(10, 20, 30)))
+    monkeypatch.setattr(bertopic_helpers.pytesseract, 'image_to_string', lambda img_pil, config: "")
+    return tmp_path, blip
+
+def cached_annotations(tmp_path):
+    cache_db = sqlite3.connect(tmp_path / "media_cache.db")
+    rows = cache_db.execute("SELECT caption, ocr_text FROM image_annotations").fetchall()
+    cache_db.close()
+    return rows
+
+def test_failed_caption_batch_is_not_cached_and_retried(doc_pipeline):
+    tmp_path, blip = doc_pipeline
+    blip.fail = True
+    bertopic_helpers.create_docs(chunk_size=1)
+    assert blip.generate_calls == 2  # nothing cached, so the shared image reaches the model in both chunks
+    assert cached_annotations(tmp_path) == []
+
+    # An edit resets the doc, the next run must caption the image instead of reusing a blank annotation
+    db = sqlite3.connect(tmp_path / "data.db")
+    db.execute("UPDATE question_answer_pairs SET doc = NULL WHERE question_id = 'q1'")
+    db.commit()
+    db.close()
+    blip.fail = False
+    bertopic_helpers.create_docs(chunk_size=1)
+    assert blip.generate_calls == 3
+    assert cached_annotations(tmp_path) == [("a picture of color (10, 20, 30)", "")]
+
+def test_failed_ocr_is_not_cached(doc_pipeline, monkeypatch):
+    tmp_path, blip = doc_pipeline
+    def missing_tesseract(img_pil, config):
+        raise OSError("tesseract is not installed")
+    monkeypatch.setattr(bertopic_helpers.pytesseract, 'image_to_string', missing_tesseract)
+    bertopic_helpers.create_docs(chunk_size=2)
+    assert cached_annotations(tmp_path) == []
@@ -0,0 +1,32 @@
+# test_knn_utils.py
+import numpy as np
+import pytest
+
+pytest.importorskip("matplotlib")
+from scipy.spatial.distance import pdist
+from utility.knn_utils import compute_distance_distribution, distribution_quantile
+
+@pytest.fixture
+def embeddings():
+    return np.random.default_rng(0).normal(size=(300, 8))
+
+@pytest.mark.parametrize("chunk_size", [7, 256])
+def test_streaming_histogram_matches_full_distances(embeddings, chunk_size):
+    distances = pdist(embeddings, metric='cityblock')
+    distribution = compute_distance_distribution(embeddings, metric='manhattan', bins=50, chunk_size=chunk_size)
+
+    counts, bin_edges = np.histogram(distances, bins=50)
+    np.testing.assert_array_equal(distribution['counts'], counts)
+    np.testing.assert_allclose(distribution['bin_edges'], bin_edges)
+    assert distribution['total_pairs'] == len(distances)
+    assert not distribution['sampled']
+    assert distribution['mean'] == pytest.approx(distances.mean())
+    assert distribution['std'] == pytest.approx(distances.std())
+    assert (distribution['min'], distribution['max']) == (distances.min(), distances.max())
+
+def test_quantiles_within_one_fine_bin(embeddings):
+    distances = pdist(embeddings, metric='cityblock')
+    distribution = compute_distance_distribution(embeddings, metric='manhattan')
+    bin_width = distribution['fine_edges'][1] - distribution['fine_edges'][0]
+    for q in (0.01, 0.25, 0.5, 0.75, 0.99):
+        assert abs(distribution_quantile(distribution, q) - np.quantile(distances, q)) <= bin_width
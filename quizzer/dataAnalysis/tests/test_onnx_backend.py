@@ -0,0 +1,53 @@
+# test_onnx_backend.py
+import pytest
+
+onnxruntime = pytest.importorskip("onnxruntime")
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+from utility import onnx_backend
+from utility.onnx_backend import load_onnx_encoder, check_embedding_parity
+
+DOCS = [
+    "the derivative of x squared is two x",
+    "mitochondria",
+    "a longer question about the quadratic formula and the roots of a polynomial with real coefficients",
+]
+
+@pytest.fixture
+def tiny_encoder(tmp_path):
+    """
+    A randomly initialized two-layer BERT and a tokenizer over DOCS' words, small enough to export in seconds.
+    """
+    words = sorted({word for doc in DOCS for word in doc.split()})
+    vocab_file = tmp_path / "vocab.txt"
+    vocab_file.write_text("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + words + ["export", "sample"]))
+    tokenizer = transformers.BertTokenizerFast(vocab_file=str(vocab_file))
+    config = transformers.BertConfig(vocab_size=tokenizer.vocab_size, hidden_size=64, num_hidden_layers=2,
+                                     num_attention_heads=4, intermediate_size=128)
+    torch.manual_seed(0)
+    return tokenizer, transformers.BertModel(config).eval()
+
+def test_onnx_embeddings_match_eager_model(tiny_encoder, tmp_path, monkeypatch):
+    tokenizer, model = tiny_encoder
+    monkeypatch.setattr(onnx_backend, "ONNX_MODEL_DIR", str(tmp_path / "onnx_models"))
+    encoder = load_onnx_encoder("tiny-bert", lambda: model, model.config, tokenizer, quantize_int8=False, num_threads=1)
+
+    # Padded batch, so the dynamic batch / sequence axes and the attention mask are exercised
+    batch = tokenizer(DOCS, padding=True, return_tensors="pt")
+    with torch.no_grad():
+        reference = model(**batch).last_hidden_state[:, 0, :].numpy()
+    candidate = encoder(**batch).last_hidden_state[:, 0, :].numpy()
+
+    parity = check_embedding_parity(reference, candidate)
+    assert parity['passed'], parity
+
+def test_existing_export_skips_eager_model(tiny_encoder, tmp_path, monkeypatch):
+    tokenizer, model = tiny_encoder
+    monkeypatch.setattr(onnx_backend, "ONNX_MODEL_DIR", str(tmp_path / "onnx_models"))
+    load_onnx_encoder("tiny-bert", lambda: model, model.config, tokenizer, quantize_int8=False, num_threads=1)
+
+    def eager_model_not_needed():
+        raise AssertionError("the eager model was loaded although the exported graph exists")
+    encoder = load_onnx_encoder("tiny-bert", eager_model_not_needed, model.config, tokenizer, quantize_int8=False, num_threads=1)
+    assert encoder.config.hidden_size == model.config.hidden_size
@@ -0,0 +1,429 @@
+# ann_index.py
+import io
+import abc
+import timeit
+import typing
+import numpy as np
+from pathlib import Path
+from scipy.spatial.distance import cdist
+from utility.knn_utils import compute_knn_model
+from utility.sync_fetch_data import write_bytes_atomically
+
+# Persisted nearest-neighbour index over the reduced embeddings, updated in place between full rebuilds
+KNN_INDEX_DIR = Path("knn_index")
+KNN_INDEX_FILE = KNN_INDEX_DIR / "index.npz"
+HNSW_INDEX_FILE = KNN_INDEX_DIR / "hnsw.bin"
+# 'exact' is sklearn's NearestNeighbors, 'ivf' a pure numpy inverted file index (any metric),
+# 'hnsw' hnswlib's graph index (euclidean and cosine only, other metrics fall back to 'exact')
+ANN_BACKENDS = ('exact', 'ivf', 'hnsw')
+CDIST_METRICS = {'manhattan': 'cityblock', 'euclidean': 'euclidean', 'cosine': 'cosine'}
+HNSW_SPACES = {'euclidean': 'l2', 'cosine': 'cosine'}
+# Query rows per distance block, bounds memory at block x n distances
+DISTANCE_BLOCK_SIZE = 256
+# Queries an IVF search handles at once, bounds memory at block x (k + largest list) distances
+IVF_QUERY_BLOCK_SIZE = 4096
+
+def blocked_distances(queries: np.ndarray, vectors: np.ndarray, metric: str) -> typing.Iterator[typing.Tuple[int, np.ndarray]]:
+    """
+    Yields (first query row, distances of DISTANCE_BLOCK_SIZE queries to every vector).
+    """
+    for start in range(0, len(queries), DISTANCE_BLOCK_SIZE):
+        yield start, cdist(queries[start:start + DISTANCE_BLOCK_SIZE], vectors, metric=CDIST_METRICS[metric])
+
+def exact_kneighbors(queries: np.ndarray, vectors: np.ndarray, k: int, metric: str) -> np.ndarray:
+    """
+    Brute force k nearest neighbour rows of every query, nearest first.
+    """
+    neighbors = np.zeros((len(queries), min(k, len(vectors))), dtype=np.int64)
+    for start, distances in blocked_distances(queries, vectors, metric):
+        nearest = np.argpartition(distances, neighbors.shape[1] - 1, axis=1)[:, :neighbors.shape[1]]
+        order = np.argsort(np.take_along_axis(distances, nearest, axis=1), axis=1)
+        neighbors[start:start + len(distances)] = np.take_along_axis(nearest, order, axis=1)
+    return neighbors
+
+class KnnIndex(abc.ABC):
+    """
+    Nearest-neighbour index over the rows of question_ids, with NearestNeighbors' kneighbors.
+
+    build indexes every vector, update re-indexes only new, moved and removed questions.
+    kneighbors returns rows of the current question_ids, like a NearestNeighbors fitted on the same matrix.
+    neighbor_rows and kth_distances remember the last query answer of every row (-1 and inf when
+    unknown), they are saved with the index so the next update can tell which rows to re-query.
+    """
+    backend = None
+
+    def __init__(self, metric: str, k: int):
+        self.metric = metric
+        self.k = k
+        self.question_ids = np.array([], dtype=str)
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self.neighbor_rows = np.zeros((0, k), dtype=np.int64)
+        self.kth_distances = np.zeros(0)
+
+    def build(self, question_ids: typing.List[str], vectors: np.ndarray) -> None:
+        self.question_ids = np.asarray(question_ids, dtype=str)
+        self.vectors = np.asarray(vectors, dtype=np.float32)
+        self.neighbor_rows = np.full((len(self.question_ids), self.k), -1, dtype=np.int64)
+        self.kth_distances = np.full(len(self.question_ids), np.inf)
+
+    def update(self, question_ids: typing.List[str], vectors: np.ndarray, changed_rows: np.ndarray) -> None:
+        self.build(question_ids, vectors)
+
+    @abc.abstractmethod
+    def kneighbors(self, X: np.ndarray, n_neighbors: typing.Union[int, None] = None) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """
+        (distances, rows) of the n_neighbors (default k) nearest indexed vectors of every row of X, nearest first.
+        """
+
+    def state(self) -> typing.Dict[str, typing.Any]:
+        return {'backend': self.backend, 'metric': self.metric, 'k': self.k, 'question_ids': self.question_ids,
+                'neighbor_rows': self.neighbor_rows, 'kth_distances': self.kth_distances}
+
+    def restore(self, saved: typing.Dict[str, typing.Any], vectors: np.ndarray) -> None:
+        self.question_ids = saved['question_ids']
+        self.vectors = np.asarray(vectors, dtype=np.float32)
+        self.neighbor_rows = saved['neighbor_rows']
+        self.kth_distances = saved['kth_distances']
+
+class ExactIndex(KnnIndex):
+    backend = 'exact'
+
+    def build(self, question_ids, vectors):
+        super().build(question_ids, vectors)
+        self.knn_model = compute_knn_model(embeddings=self.vectors, k=self.k, metric=self.metric)
+
+    def restore(self, saved, vectors):
+        super().restore(saved, vectors)
+        self.knn_model = compute_knn_model(embeddings=self.vectors, k=self.k, metric=self.metric)
+
+    def kneighbors(self, X, n_neighbors=None):
+        return self.knn_model.kneighbors(X, n_neighbors=n_neighbors or self.k)
+
+class IvfIndex(KnnIndex):
+    """
+    Inverted file index: k-means centroids split the vectors into n_lists lists, a query scans
+    only the vectors of its n_probe nearest lists. New and moved vectors are assigned to the
+    existing centroids, so updates never retrain.
+
+    n_probe starts at probe_fraction of the lists, so the scanned share of the corpus does not shrink
+    as it grows, and is doubled at build time until recall@k on a sample reaches target_recall.
+    """
+    backend = 'ivf'
+
+    def __init__(self, metric, k, probe_fraction: float = 0.1, target_recall: float = 0.95,
+                 kmeans_iterations: int = 15, seed: int = 0):
+        super().__init__(metric, k)
+        self.probe_fraction = probe_fraction
+        self.target_recall = target_recall
+        self.n_probe = 1
+        self.kmeans_iterations = kmeans_iterations
+        self.seed = seed
+        self.centroids = np.zeros((0, 0), dtype=np.float32)
+        self.assignments = np.array([], dtype=np.int64)
+
+    def nearest_centroids(self, vectors: np.ndarray, count: int) -> np.ndarray:
+        nearest = np.zeros((len(vectors), count), dtype=np.int64)
+        for start, distances in blocked_distances(vectors, self.centroids, self.metric):
+            nearest[start:start + len(distances)] = np.argsort(distances, axis=1)[:, :count]
+        return nearest
+
+    def build(self, question_ids, vectors):
+        super().build(question_ids, vectors)
+        rng = np.random.default_rng(self.seed)
+        n_lists = max(1, int(np.sqrt(len(self.vectors))))
+        # Lloyd iterations on a sample, about 64 vectors per list is enough to place the centroids
+        sample = self.vectors[rng.choice(len(self.vectors), min(len(self.vectors), 64 * n_lists), replace=False)]
+        self.centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+        for _ in range(self.kmeans_iterations):
+            labels = self.nearest_centroids(sample, 1)[:, 0]
+            for list_id in np.unique(labels):
+                self.centroids[list_id] = sample[labels == list_id].mean(axis=0)
+        self.assign(np.arange(len(self.vectors)))
+        self.calibrate_n_probe()
+
+    def calibrate_n_probe(self) -> None:
+        self.n_probe = max(1, int(np.ceil(self.probe_fraction * len(self.centroids))))
+        while self.n_probe < len(self.centroids):
+            if measure_knn_recall(self, self.vectors, self.k, seed=self.seed)['recall'] >= self.target_recall:
+                break
+            self.n_probe = min(2 * self.n_probe, len(self.centroids))
+        print(f"IVF index: probing {self.n_probe}/{len(self.centroids)} lists per query")
+
+    def assign(self, rows: np.ndarray) -> None:
+        if len(self.assignments) != len(self.vectors):
+            self.assignments = np.full(len(self.vectors), -1, dtype=np.int64)
+        if len(rows):
+            self.assignments[rows] = self.nearest_centroids(self.vectors[rows], 1)[:, 0]
+        order = np.argsort(self.assignments, kind='stable')
+        boundaries = np.searchsorted(self.assignments[order], np.arange(len(self.centroids) + 1))
+        self.lists = [order[boundaries[i]:boundaries[i + 1]] for i in range(len(self.centroids))]
+
+    def update(self, question_ids, vectors, changed_rows):
+        # Unchanged questions keep their list, wherever their row moved to
+        previous = dict(zip(self.question_ids, self.assignments))
+        KnnIndex.build(self, question_ids, vectors)
+        self.assignments = np.array([previous.get(question_id, -1) for question_id in self.question_ids], dtype=np.int64)
+        rows = np.union1d(np.asarray(changed_rows, dtype=np.int64), np.flatnonzero(self.assignments == -1))
+        self.assign(rows)
+
+    def kneighbors(self, X, n_neighbors=None):
+        X = np.asarray(X, dtype=np.float32)
+        k = min(n_neighbors or self.k, len(self.vectors))
+        distances = np.zeros((len(X), k))
+        indices = np.zeros((len(X), k), dtype=np.int64)
+        for start in range(0, len(X), IVF_QUERY_BLOCK_SIZE):
+            block = slice(start, start + IVF_QUERY_BLOCK_SIZE)
+            distances[block], indices[block] = self.search_block(X[block], k)
+        return distances, indices
+
+    def search_block(self, X: np.ndarray, k: int) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """
+        Scans list by list: one distance computation per probed list against every query probing it,
+        merged into those queries' running k best.
+        """
+        distances = np.full((len(X), k), np.inf)
+        indices = np.full((len(X), k), -1, dtype=np.int64)
+        probes = self.nearest_centroids(X, min(self.n_probe, len(self.centroids))).ravel()
+        probing_queries = np.repeat(np.arange(len(X)), min(self.n_probe, len(self.centroids)))
+        order = np.argsort(probes, kind='stable')
+        boundaries = np.searchsorted(probes[order], np.arange(len(self.centroids) + 1))
+        for list_id, members in enumerate(self.lists):
+            queries = probing_queries[order[boundaries[list_id]:boundaries[list_id + 1]]]
+            if not len(queries) or not len(members):
+                continue
+            merged_distances = np.hstack([distances[queries], cdist(X[queries], self.vectors[members], metric=CDIST_METRICS[self.metric])])
+            merged_indices = np.hstack([indices[queries], np.broadcast_to(members, (len(queries), len(members)))])
+            best = np.argpartition(merged_distances, k - 1, axis=1)[:, :k]
+            distances[queries] = np.take_along_axis(merged_distances, best, axis=1)
+            indices[queries] = np.take_along_axis(merged_indices, best, axis=1)
+
+        # Too few vectors in the probed lists (tiny corpus), fall back to scanning everything
+        short = np.flatnonzero((indices == -1).any(axis=1))
+        if len(short):
+            all_distances = cdist(X[short], self.vectors, metric=CDIST_METRICS[self.metric])
+            best = np.argpartition(all_distances, k - 1, axis=1)[:, :k]
+            distances[short] = np.take_along_axis(all_distances, best, axis=1)
+            indices[short] = best
+        nearest_first = np.argsort(distances, axis=1, kind='stable')
+        return np.take_along_axis(distances, nearest_first, axis=1), np.take_along_axis(indices, nearest_first, axis=1)
+
+    def state(self):
+        return dict(super().state(), centroids=self.centroids, assignments=self.assignments, n_probe=self.n_probe)
+
+    def restore(self, saved, vectors):
+        super().restore(saved, vectors)
+        self.centroids = saved['centroids']
+        self.n_probe = saved['n_probe']
+        self.assignments = saved['assignments']
+        self.assign(np.array([], dtype=np.int64))
+
+class HnswIndex(KnnIndex):
+    """
+    hnswlib graph index. Labels are stable per question: moved questions are re-added under
+    their label, removed ones are marked deleted, so updates never rebuild the graph.
+    """
+    backend = 'hnsw'
+
+    def __init__(self, metric, k, ef_construction: int = 200, M: int = 16, ef: int = 100):
+        if metric not in HNSW_SPACES:
+            raise ValueError(f"hnswlib does not support the {metric} metric, use one of {list(HNSW_SPACES)} or the 'ivf' backend")
+        super().__init__(metric, k)
+        self.ef_construction = ef_construction
+        self.M = M
+        self.ef = ef
+        self.labels = {}
+
+    def new_index(self, dimensions: int, max_elements: int):
+        # hnswlib is only needed when the hnsw backend is selected
+        import hnswlib
+        index = hnswlib.Index(space=HNSW_SPACES[self.metric], dim=dimensions)
+        index.init_index(max_elements=max_elements, ef_construction=self.ef_construction, M=self.M)
+        index.set_ef(self.ef)
+        return index
+
+    def build(self, question_ids, vectors):
+        super().build(question_ids, vectors)
+        self.labels = {question_id: label for label, question_id in enumerate(self.question_ids)}
+        self.index = self.new_index(self.vectors.shape[1], max(len(self.vectors), 1))
+        self.index.add_items(self.vectors, np.arange(len(self.vectors)))
+        self.refresh_rows()
+
+    def refresh_rows(self) -> None:
+        # label -> row of the current question_ids, kneighbors answers in rows
+        self.label_rows = np.full(max(self.labels.values(), default=-1) + 1, -1, dtype=np.int64)
+        self.label_rows[[self.labels[question_id] for question_id in self.question_ids]] = np.arange(len(self.question_ids))
+
+    def update(self, question_ids, vectors, changed_rows):
+        removed = set(self.question_ids) - set(question_ids)
+        for question_id in removed:
+            self.index.mark_deleted(self.labels.pop(question_id))
+        KnnIndex.build(self, question_ids, vectors)
+        next_label = max(self.labels.values(), default=-1) + 1
+        new_ids = [question_id for question_id in self.question_ids if question_id not in self.labels]
+        self.labels.update(zip(new_ids, range(next_label, next_label + len(new_ids))))
+        new_id_set = set(new_ids)
+        rows = np.union1d(np.asarray(changed_rows, dtype=np.int64),
+                          np.array([row for row, question_id in enumerate(self.question_ids) if question_id in new_id_set], dtype=np.int64))
+        if len(rows):
+            if self.index.get_current_count() + len(new_ids) > self.index.get_max_elements():
+                self.index.resize_index(2 * (self.index.get_current_count() + len(new_ids)))
+            # Adding under an existing label replaces that question's vector
+            self.index.add_items(self.vectors[rows], np.array([self.labels[self.question_ids[row]] for row in rows]))
+        self.refresh_rows()
+
+    def kneighbors(self, X, n_neighbors=None):
+        k = min(n_neighbors or self.k, len(self.vectors))
+        labels, distances = self.index.knn_query(np.asarray(X, dtype=np.float32), k=k)
+        # hnswlib's l2 space returns squared distances
+        if self.metric == 'euclidean':
+            distances = np.sqrt(np.maximum(distances, 0))
+        return distances.astype(np.float64), self.label_rows[labels.astype(np.int64)]
+
+    def state(self):
+        return dict(super().state(), label_question_ids=np.array(list(self.labels), dtype=str),
+                    label_values=np.array(list(self.labels.values()), dtype=np.int64))
+
+    def restore(self, saved, vectors):
+        import hnswlib
+        super().restore(saved, vectors)
+        self.labels = dict(zip(saved['label_question_ids'], saved['label_values'].tolist()))
+        self.index = hnswlib.Index(space=HNSW_SPACES[self.metric], dim=self.vectors.shape[1])
+        self.index.load_index(str(HNSW_INDEX_FILE), allow_replace_deleted=False)
+        self.index.set_ef(self.ef)
+        self.refresh_rows()
+
+KNN_INDEX_CLASSES = {index_class.backend: index_class for index_class in (ExactIndex, IvfIndex, HnswIndex)}
+
+def save_knn_index(index: KnnIndex, topic_state_updated_at: str) -> None:
+    """
+    Persists the index next to the topic model. Vectors are not stored, they are the reduced embeddings
+    of the topic model state the index was last brought up to date with (see load_knn_index).
+    """
+    KNN_INDEX_DIR.mkdir(exist_ok=True)
+    if isinstance(index, HnswIndex):
+        index.index.save_index(str(HNSW_INDEX_FILE))
+    buffer = io.BytesIO()
+    np.savez(buffer, **index.state(), topic_state_updated_at=topic_state_updated_at)
+    write_bytes_atomically(str(KNN_INDEX_FILE), buffer.getvalue())
+
+def load_knn_index(backend: str, metric: str, k: int, topic_state: typing.Dict[str, typing.Any]) -> typing.Union[KnnIndex, None]:
+    """
+    Returns the saved index when it was built with the same backend, metric and k and last updated
+    together with topic_state (the saved topic model state of the previous run), else None.
+    """
+    if not KNN_INDEX_FILE.exists():
+        return None
+    with np.load(KNN_INDEX_FILE) as saved:
+        saved = {key: saved[key] if saved[key].ndim else saved[key].item() for key in saved.files}
+    if 'kth_distances' not in saved:
+        return None
+    if (saved['backend'], saved['metric'], saved['k'], saved['topic_state_updated_at']) != (backend, metric, k, topic_state['updated_at']):
+        return None
+    rows = {question_id: row for row, question_id in enumerate(topic_state['question_ids'])}
+    index = KNN_INDEX_CLASSES[backend](metric, k)
+    index.restore(saved, topic_state['reduced_embeddings'][[rows[question_id] for question_id in saved['question_ids']]])
+    return index
+
+def carry_over_neighbors(index: KnnIndex, previous_question_ids: np.ndarray, previous_neighbor_rows: np.ndarray,
+                         previous_kth_distances: np.ndarray) -> None:
+    """
+    Moves the remembered query answers of the questions still indexed to their current rows.
+    Neighbours that were removed become -1, new questions have no answer yet.
+    """
+    previous_to_current = np.full(len(previous_question_ids) + 1, -1, dtype=np.int64)
+    current_rows = {question_id: row for row, question_id in enumerate(index.question_ids)}
+    kept = np.array([question_id in current_rows for question_id in previous_question_ids], dtype=bool)
+    previous_to_current[:-1][kept] = [current_rows[question_id] for question_id in previous_question_ids[kept]]
+    # -1 (unknown neighbour) indexes the trailing -1 entry
+    index.neighbor_rows[previous_to_current[:-1][kept]] = previous_to_current[previous_neighbor_rows[kept]]
+    index.kth_distances[previous_to_current[:-1][kept]] = previous_kth_distances[kept]
+
+def find_affected_rows(index: KnnIndex, changed_rows: np.ndarray) -> np.ndarray:
+    """
+    Rows whose k nearest neighbours can differ from their remembered answer: moved or new questions,
+    questions with a moved or removed neighbour, and questions a moved question now lies within
+    their k-th neighbour distance of.
+    """
+    changed_rows = np.asarray(changed_rows, dtype=np.int64)
+    moved = np.zeros(len(index.question_ids) + 1, dtype=bool)
+    moved[changed_rows] = True
+    # Removed neighbours were carried over as -1, which indexes the trailing True
+    moved[-1] = True
+    affected = moved[:-1] | moved[index.neighbor_rows].any(axis=1) | np.isinf(index.kth_distances)
+    for _, distances in blocked_distances(index.vectors[changed_rows], index.vectors, index.metric):
+        affected |= (distances <= index.kth_distances).any(axis=0)
+    return np.flatnonzero(affected)
+
+def query_knn_index(index: KnnIndex, rows: np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    kneighbors of the indexed vectors at rows, remembered as those rows' latest answer.
+    """
+    distances, indices = index.kneighbors(index.vectors[rows])
+    index.neighbor_rows[rows] = -1
+    index.neighbor_rows[rows, :indices.shape[1]] = indices
+    # With fewer than k questions any new one is a neighbour, whatever its distance
+    index.kth_distances[rows] = distances[:, -1] if indices.shape[1] == index.k else np.inf
+    return distances, indices
+
+def measure_knn_recall(index: KnnIndex, vectors: np.ndarray, k: int, sample_size: int = 500, seed: int = 0) -> typing.Dict[str, float]:
+    """
+    recall@k of the index against brute force exact neighbours, on a sample of the indexed points.
+    """
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False)
+    start = timeit.default_timer()
+    _, approximate = index.kneighbors(vectors[sample], n_neighbors=k)
+    query_seconds = timeit.default_timer() - start
+    exact = exact_kneighbors(vectors[sample], vectors, k, index.metric)
+    recall = np.mean([len(set(a) & set(e)) / len(e) for a, e in zip(approximate.tolist(), exact.tolist())])
+    return {'recall': float(recall), 'sampled': int(len(sample)), 'query_ms': 1000 * query_seconds / max(len(sample), 1)}
+
+def refresh_knn_index(topic_state: typing.Dict[str, typing.Any], previous_topic_state: typing.Union[typing.Dict[str, typing.Any], None],
+                      changed_rows: np.ndarray, full_rebuild: bool, backend: str = 'exact', metric: str = 'manhattan',
+                      k: int = 25) -> typing.Tuple[KnnIndex, np.ndarray, typing.Tuple[np.ndarray, np.ndarray], typing.Dict[str, float]]:
+    """
+    Brings the persisted index up to date with the reduced embeddings of topic_state and queries
+    the rows whose neighbours may have changed.
+
+    A full rebuild (or no usable saved index) indexes and queries every row. Otherwise only
+    changed_rows (new and moved questions) are re-indexed, removed questions dropped, and only
+    the rows find_affected_rows reports are queried.
+
+    Args:
+        topic_state: the current topic model state, its question_ids and reduced_embeddings are indexed
+        previous_topic_state: the state the saved index was built with, None when there was none
+        changed_rows: rows of topic_state that are new or were projected to new coordinates
+
+    Returns:
+        (index, queried rows, their (distances, indices), {'build_seconds', 'update_seconds', 'query_seconds'})
+    """
+    if backend not in ANN_BACKENDS:
+        raise ValueError(f"Unknown knn backend {backend}, expected one of {ANN_BACKENDS}")
+    if backend == 'hnsw' and metric not in HNSW_SPACES:
+        print(f"WARNING!!: hnswlib does not support the {metric} metric, using the 'exact' knn backend instead")
+        backend = 'exact'
+    question_ids = topic_state['question_ids'].tolist()
+    vectors = topic_state['reduced_embeddings']
+    timings = {'build_seconds': 0.0, 'update_seconds': 0.0}
+    index = None
+    if not full_rebuild and previous_topic_state is not None:
+        index = load_knn_index(backend, metric, k, previous_topic_state)
+
+    start = timeit.default_timer()
+    if index is None:
+        index = KNN_INDEX_CLASSES[backend](metric, k)
+        index.build(question_ids, vectors)
+        timings['build_seconds'] = timeit.default_timer() - start
+        query_rows = np.arange(len(question_ids))
+    else:
+        previous = (index.question_ids, index.neighbor_rows, index.kth_distances)
+        index.update(question_ids, vectors, changed_rows)
+        carry_over_neighbors(index, *previous)
+        query_rows = find_affected_rows(index, changed_rows)
+        timings['update_seconds'] = timeit.default_timer() - start
+
+    start = timeit.default_timer()
+    neighbors = query_knn_index(index, query_rows)
+    timings['query_seconds'] = timeit.default_timer() - start
+    save_knn_index(index, topic_state['updated_at'])
+    return index, query_rows, neighbors, timings
@@ -1,230 +1,83 @@
-from utility.sync_fetch_data import initialize_and_fetch_db, get_empty_doc_record, upsert_question_record
+from utility.sync_fetch_data import initialize_and_fetch_db, get_empty_doc_records, save_question_docs
 from utility.transform_question_to_vector import simplify_question_record
-from utility.data_utils import load_image
-from transformers import BlipProcessor, BlipForConditionalGeneration
+from utility.data_utils import load_image, prefetch_images
+from utility.media_cache import open_media_cache, image_annotator, image_content_hash, lookup_image_annotations, store_image_annotations
+from utility.model_registry import BLIP_MODEL_NAME, get_blip, get_model_variant
+from utility.latex_conversion import open_latex_cache, convert_latex_docs
 from PIL import Image
 import torch
 import pytesseract
 from docx import Document
 from docx.enum.text import WD_ALIGN_PARAGRAPH
-import re
-from pylatexenc import macrospec, latexwalker
-from pylatexenc.latexwalker import LatexMacroNode, LatexGroupNode, LatexCharsNode
 import os
 import sys
+import timeit
+import typing
+import collections
+from concurrent.futures import ThreadPoolExecutor
 
-def convert_latex_to_plain_english(doc: str) -> str:
+def ocr_image(img_pil: Image.Image) -> typing.Union[str, None]:
     """
-    Converts LaTeX mathematical expressions to plain English.
-    Finds LaTeX delimited by $ or $$ and replaces with English equivalents.
-    Skips chemical notation.
+    Extracts text from an image with Tesseract, returns '' when nothing useful was found
+    and None when Tesseract itself failed (the image is then not cached, see create_docs).
     """
-    lwc = latexwalker.get_default_latex_context_db()
-    lwc.add_context_category('powers', specials=[
-        macrospec.SpecialsSpec('^', args_parser=macrospec.MacroStandardArgsParser('{')),
-        macrospec.SpecialsSpec('_', args_parser=macrospec.MacroStandardArgsParser('{')),
-    ])
+    try:
+        ocr_text = pytesseract.image_to_string(img_pil, config='--psm 6').strip()
+    except Exception as e:
+        print(f"Error running OCR: {e}")
+        return None
+    if ocr_text and len(ocr_text) > 3:  # Filter out noise
+        return ocr_text
+    return ''
+
+def caption_images(processor, model, images: typing.List[Image.Image], batch_size: int) -> typing.List[typing.Union[str, None]]:
+    """
+    Generates BLIP captions for many images, batch_size images per forward pass.
+    A batch that fails is captioned as None rather than stopping the whole chunk.
+    """
+    captions = []
+    for i in range(0, len(images), batch_size):
+        batch = images[i:i + batch_size]
+        try:
+            inputs = processor(images=batch, return_tensors="pt")
+            with torch.inference_mode():
+                out = model.generate(**inputs, max_length=50, num_beams=5)
+            captions.extend(processor.batch_decode(out, skip_special_tokens=True))
+        except Exception as e:
+            print(f"Error captioning batch of {len(batch)} images: {e}")
+            captions.extend([None] * len(batch))
+    return captions
+
+def assemble_doc(record: typing.Dict, captions: typing.Dict[str, str], ocr_texts: typing.Dict[str, str]) -> str:
+    """
+    Combines question text + answer text + OCR text + image captions into a single document string.
+    LaTeX is converted afterwards for the whole chunk at once (see convert_latex_docs).
+    """
+    all_text_components = []
     
-    def process_node(node):
-        """Recursively process a single LaTeX node to English."""
-        if isinstance(node, LatexCharsNode):
-            text = node.chars
-            text = text.replace('+', ' plus ')
-            text = text.replace('-', ' minus ')
-            text = text.replace('=', ' equals ')
-            text = text.replace('/', ' divided by ')
-            text = text.replace('*', ' times ')
-            text = text.replace('%', ' percent ')
-            text = text.replace('<', ' less than ')
-            text = text.replace('>', ' greater than ')
-            text = text.replace('(', ' open parenthesis ')
-            text = text.replace(')', ' close parenthesis ')
-            return text
-        
-        if isinstance(node, LatexGroupNode):
-            return ''.join(process_node(n) for n in node.nodelist)
-        
-        if isinstance(node, latexwalker.LatexSpecialsNode):
-            if node.specials_chars == '^':
-                if node.nodeargd and hasattr(node.nodeargd, 'argnlist') and len(node.nodeargd.argnlist) > 0:
-                    power = process_node(node.nodeargd.argnlist[0])
-                    return f' to the power of {power}'
-                return ' to the power of '
-            elif node.specials_chars == '_':
-                if node.nodeargd and hasattr(node.nodeargd, 'argnlist') and len(node.nodeargd.argnlist) > 0:
-                    sub = process_node(node.nodeargd.argnlist[0])
-                    return f' subscript {sub}'
-                return ' subscript '
-        
-        if isinstance(node, LatexMacroNode):
-            macro = node.macroname
-            
-            if macro == 'int':
-                return ' integral '
-            elif macro == 'sum':
-                return ' summation '
-            elif macro == 'prod':
-                return ' product '
-            elif macro == 'lim':
-                return ' limit '
-            elif macro == 'frac':
-                if node.nodeargd and hasattr(node.nodeargd, 'argnlist') and len(node.nodeargd.argnlist) >= 2:
-                    num = process_node(node.nodeargd.argnlist[0])
-                    denom = process_node(node.nodeargd.argnlist[1])
-                    return f' {num} divided by {denom} '
-                return ' fraction '
-            elif macro == 'sqrt':
-                if node.nodeargd and hasattr(node.nodeargd, 'argnlist') and len(node.nodeargd.argnlist) > 0:
-                    arg = process_node(node.nodeargd.argnlist[0])
-                    return f' square root of {arg} '
-                return ' square root '
-            elif macro in ['cdot', 'times']:
-                return ' times '
-            elif macro == 'div':
-                return ' divided by '
-            elif macro == 'pm':
-                return ' plus or minus '
-            elif macro == 'mp':
-                return ' minus or plus '
-            elif macro == 'neq':
-                return ' not equal to '
-            elif macro == 'leq':
-                return ' less than or equal to '
-            elif macro == 'geq':
-                return ' greater than or equal to '
-            elif macro == 'approx':
-                return ' approximately equal to '
-            elif macro == 'equiv':
-                return ' equivalent to '
-            elif macro == 'propto':
-                return ' proportional to '
-            elif macro == 'infty':
-                return ' infinity '
-            elif macro == 'partial':
-                return ' partial derivative '
-            elif macro == 'nabla':
-                return ' del '
-            elif macro in ['to', 'rightarrow']:
-                return ' approaches '
-            elif macro == 'sin':
-                return ' sine '
-            elif macro == 'cos':
-                return ' cosine '
-            elif macro == 'tan':
-                return ' tangent '
-            elif macro == 'sec':
-                return ' secant '
-            elif macro == 'csc':
-                return ' cosecant '
-            elif macro == 'cot':
-                return ' cotangent '
-            elif macro == 'arcsin':
-                return ' arcsine '
-            elif macro == 'arccos':
-                return ' arccosine '
-            elif macro == 'arctan':
-                return ' arctangent '
-            elif macro == 'sinh':
-                return ' hyperbolic sine '
-            elif macro == 'cosh':
-                return ' hyperbolic cosine '
-            elif macro == 'tanh':
-                return ' hyperbolic tangent '
-            elif macro == 'log':
-                return ' logarithm '
-            elif macro == 'ln':
-                return ' natural logarithm '
-            elif macro == 'exp':
-                return ' exponential '
-            elif macro == 'max':
-                return ' maximum '
-            elif macro == 'min':
-                return ' minimum '
-            elif macro == 'sup':
-                return ' supremum '
-            elif macro == 'inf':
-                return ' infimum '
-            elif macro == 'det':
-                return ' determinant '
-            elif macro == 'gcd':
-                return ' greatest common divisor '
-            elif macro == 'arg':
-                return ' argument '
-            elif macro == 'deg':
-                return ' degree '
-            elif macro == 'dim':
-                return ' dimension '
-            elif macro == 'cup':
-                return ' union '
-            elif macro == 'cap':
-                return ' intersection '
-            elif macro == 'in':
-                return ' element of '
-            elif macro == 'notin':
-                return ' not element of '
-            elif macro in ['subset', 'subseteq']:
-                return ' subset of '
-            elif macro in ['supset', 'supseteq']:
-                return ' superset of '
-            elif macro == 'emptyset':
-                return ' empty set '
-            elif macro == 'forall':
-                return ' for all '
-            elif macro == 'exists':
-                return ' there exists '
-            elif macro == 'land':
-                return ' logical and '
-            elif macro == 'wedge':
-                return ' wedge '
-            elif macro == 'lor':
-                return ' logical or '
-            elif macro == 'vee':
-                return ' vee '
-            elif macro in ['neg', 'lnot']:
-                return ' logical not '
-            elif macro in ['implies', 'Rightarrow']:
-                return ' implies '
-            elif macro in ['iff', 'Leftrightarrow']:
-                return ' biconditional '
-            else:
-                return f' {macro} '
-        
-        if hasattr(node, 'chars'):
-            return node.chars
-        
-        return ''
+    # Add original question and answer text
+    if record['question_text']:
+        all_text_components.append(record['question_text'])
+    if record['answer_text']:
+        all_text_components.append(record['answer_text'])
     
-    def process_latex(latex_expr):
-        latex_expr = latex_expr.strip()
-        
-        chemical_patterns = [
-            r'\b(NADH|NAD|ATP|ADP|DNA|RNA|CO2|H2O|NH3|CH4|FAD|FADH|CoA)\b',
-            r'\b[A-Z][a-z]?\d*\^?[\+\-]?\d*\b',
-        ]
-        for pattern in chemical_patterns:
-            if re.search(pattern, latex_expr):
-                return latex_expr
-        
-        try:
-            walker = latexwalker.LatexWalker(latex_expr, latex_context=lwc)
-            nodes, _, _ = walker.get_latex_nodes()
-            result = ''.join(process_node(node) for node in nodes)
-            return result
-        except:
-            return latex_expr
+    # Add OCR extracted text, only the text, do not add random text to mark it.
+    media = [img_name for img_name in record['question_media'] + record['answer_media'] if img_name]
+    all_text_components.extend(ocr_texts[img_name] for img_name in media if ocr_texts[img_name])
     
-    pattern = r'\$\$([^\$]+)\$\$|\$([^\$]+)\$'
+    # Add image descriptions, additional explanatory text on answer images muddies the topic model
+    all_text_components.extend(f"Question image: {captions[img_name]}" for img_name in record['question_media'] if img_name and captions[img_name])
+    all_text_components.extend(captions[img_name] for img_name in record['answer_media'] if img_name and captions[img_name])
     
-    def handle_match(match):
-        latex_expr = match.group(1) if match.group(1) else match.group(2)
-        result = process_latex(latex_expr)
-        return result
+    # Create final doc string for BERTopic
+    doc = " ".join(all_text_components)
     
-    processed_doc = re.sub(pattern, handle_match, doc)
-    return processed_doc
+    # Ensure we have some text
+    if not doc.strip():
+        doc = "a the is"
+    return doc
 
-
-def create_docs() -> None:
+def create_docs(chunk_size: int = 64, caption_batch_size: int = 16, ocr_workers: int = None, io_workers: int = 8) -> None:
     """
     Creates document strings for question records to use with BERTopic.
     
@@ -236,176 +89,161 @@ def create_docs() -> None:
     This creates rich textual representations of multimodal content that BERTopic
     can use for topic modeling while preserving academic vocabulary.
     
-    Fetches records from DB, processes them, and saves back to DB until complete.
+    Records needing a doc are read chunk_size at a time. For each chunk the unique images are
+    loaded by a thread pool and looked up by content hash in the media cache (media_cache.py).
+    For images not cached yet, OCR runs in the background (every pytesseract call is its own
+    tesseract process) while BLIP captions the same images caption_batch_size per forward pass.
+    The LaTeX of all the chunk's docs is converted in one batch through the memoized
+    converter and its persistent cache (latex_conversion.py).
+    The chunk's docs are committed in one transaction.
+    
+    Args:
+        chunk_size: Records read, processed and committed together
+        caption_batch_size: Images per BLIP generate call
+        ocr_workers: Concurrent tesseract processes (default: half the CPU cores)
+        io_workers: Concurrent image downloads (shared pooled Supabase client) and loads
     """
-    processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
-    model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base")
+    if ocr_workers is None:
+        ocr_workers = max(1, (os.cpu_count() or 2) // 2)
+
+    # BLIP comes from the model registry, only loaded once an image misses the annotation cache
+    annotator = image_annotator(get_model_variant(BLIP_MODEL_NAME))
 
     db = initialize_and_fetch_db()
+    cache_db = open_media_cache()
+    latex_cache_db = open_latex_cache()
     processed_count = 0
+    image_count = 0
+    failed_image_count = 0
+    failed_annotation_count = 0
+    cache_hits = 0
+    latex_expressions = 0
+    latex_cache_hits = 0
+    stage_seconds = {'read': 0.0, 'load_images': 0.0, 'cache': 0.0, 'caption': 0.0, 'ocr_wait': 0.0, 'assemble': 0.0, 'latex': 0.0, 'write': 0.0}
+    last_question_id = ''
+    start = timeit.default_timer()
     
-    print("Starting doc creation process for BERTopic...")
+    print(f"Starting doc creation process for BERTopic (chunk_size={chunk_size}, caption_batch_size={caption_batch_size}, "
+          f"ocr_workers={ocr_workers}, io_workers={io_workers})...")
     
-    while True:
-        # Get next record that needs doc creation
-        record = get_empty_doc_record(db)
-        
-        # Break if no more records need processing
-        if record is None:
-            print(f"Doc creation complete! Processed {processed_count} records.")
-            break
-        
-        try:
-            # Simplify the record format
-            record = simplify_question_record(record)
+    with ThreadPoolExecutor(max_workers=io_workers) as io_pool, ThreadPoolExecutor(max_workers=ocr_workers) as ocr_pool:
+        while True:
+            stage_start = timeit.default_timer()
+            raw_records = get_empty_doc_records(db, chunk_size, last_question_id)
+            stage_seconds['read'] += timeit.default_timer() - stage_start
             
-            question_id = record.get('question_id', '')
-            question_text = record.get('question_text', '')
-            answer_text = record.get('answer_text', '')
-            question_media = record.get('question_media', [])
-            answer_media = record.get('answer_media', [])
+            # Break if no more records need processing
+            if not raw_records:
+                break
+            last_question_id = raw_records[-1]['question_id']
             
-            # Helper function to safely convert tensor to PIL
-            def safe_tensor_to_pil(img_tensor):
-                if img_tensor is None:
-                    return None
-                
-                # If it's already a PIL Image, return as-is
-                if isinstance(img_tensor, Image.Image):
-                    return img_tensor
-                
-                # Convert tensor to PIL safely
-                if torch.is_tensor(img_tensor):
-                    # Normalize tensor to [0,1] range
-                    img_tensor = img_tensor.float()
-                    img_tensor = (img_tensor - img_tensor.min()) / (img_tensor.max() - img_tensor.min())
-                    
-                    # Remove batch dimension if present
-                    if img_tensor.dim() == 4:
-                        img_tensor = img_tensor.squeeze(0)
-                    
-                    # Ensure correct channel order (C, H, W) -> (H, W, C)
-                    if img_tensor.dim() == 3 and img_tensor.shape[0] in [1, 3]:
-                        img_tensor = img_tensor.permute(1, 2, 0)
-                    
-                    # Convert to uint8 and PIL
-                    img_array = (img_tensor * 255).clamp(0, 255).byte().numpy()
-                    
-                    # Handle grayscale
-                    if img_array.shape[-1] == 1:
-                        img_array = img_array.squeeze(-1)
-                        return Image.fromarray(img_array, mode='L')
-                    else:
-                        return Image.fromarray(img_array, mode='RGB')
-                
-                return None
-            
-            # Process images to text descriptions
-            image_descriptions = []
-            ocr_texts = []
-            
-            # Process question media images
-            if question_media:
-                for img_name in question_media:
-                    if img_name:
-                        try:
-                            img_tensor = load_image(img_name)
-                            img_pil = safe_tensor_to_pil(img_tensor)
-                            if img_pil is not None:
-                                # Generate image caption using BLIP
-                                inputs = processor(img_pil, return_tensors="pt")
-                                with torch.no_grad():
-                                    out = model.generate(**inputs, max_length=50, num_beams=5)
-                                    caption = processor.decode(out[0], skip_special_tokens=True)
-                                    image_descriptions.append(f"Question image: {caption}")
-                                
-                                # Extract text using OCR if image contains text
-                                try:
-                                    ocr_text = pytesseract.image_to_string(img_pil, config='--psm 6').strip()
-                                    if ocr_text and len(ocr_text) > 3:  # Filter out noise
-                                        ocr_texts.append(ocr_text) # only append the text, do not add random text to mark it.
-                                except:
-                                    pass  # OCR failed, continue without it
-                        except Exception as e:
-                            print(f"Error processing question image {img_name}: {e}")
-            
-            # Process answer media images
-            if answer_media:
-                for img_name in answer_media:
-                    if img_name:
-                        try:
-                            img_tensor = load_image(img_name)
-                            img_pil = safe_tensor_to_pil(img_tensor)
-                            if img_pil is not None:
-                                # Generate image caption using BLIP
-                                inputs = processor(img_pil, return_tensors="pt")
-                                with torch.no_grad():
-                                    out = model.generate(**inputs, max_length=50, num_beams=5)
-                                    caption = processor.decode(out[0], skip_special_tokens=True)
-                                    image_descriptions.append(caption) # Additional explanatory text muddies the topic model
-                                
-                                # Extract text using OCR if image contains text
-                                try:
-                                    ocr_text = pytesseract.image_to_string(img_pil, config='--psm 6').strip()
-                                    if ocr_text and len(ocr_text) > 3:  # Filter out noise
-                                        ocr_texts.append(ocr_text)
-                                except:
-                                    pass  # OCR failed, continue without it
-                        except Exception as e:
-                            print(f"Error processing answer image {img_name}: {e}")
-            
-            # Combine all textual information into a single document
-            all_text_components = []
-            
-            # Add original question and answer text
-            if question_text:
-                all_text_components.append(question_text)
-            if answer_text:
-                all_text_components.append(answer_text)
+            # Malformed records still get a fallback doc so they are not picked up again
+            records = []
+            docs = {}
+            for raw_record in raw_records:
+                try:
+                    records.append(simplify_question_record(raw_record))
+                except Exception as e:
+                    print(f"Error processing record {raw_record['question_id']}: {e}")
+                    docs[raw_record['question_id']] = "Empty educational content"
+            # Images shared by several questions in the chunk are only processed once
+            image_names = list(dict.fromkeys(
+                img_name for record in records for img_name in record['question_media'] + record['answer_media'] if img_name
+            ))
+            image_count += len(image_names)
             
-            # Add OCR extracted text
-            if ocr_texts:
-                all_text_components.extend(ocr_texts)
+            stage_start = timeit.default_timer()
+            prefetch_images(image_names, max_workers=io_workers)
+            # Images that could not be loaded are left out of the doc, never captioned or cached
+            loaded = [(img_name, img_pil) for img_name, img_pil in zip(image_names, io_pool.map(load_image, image_names)) if img_pil is not None]
+            failed_image_count += len(image_names) - len(loaded)
+            image_names = [img_name for img_name, _ in loaded]
+            images = [img_pil for _, img_pil in loaded]
+            content_hashes = list(io_pool.map(image_content_hash, images))
+            stage_seconds['load_images'] += timeit.default_timer() - stage_start
             
-            # Add image descriptions
-            if image_descriptions:
-                all_text_components.extend(image_descriptions)
+            # Byte-identical images are annotated once, ever: only hashes missing from the cache reach the models
+            stage_start = timeit.default_timer()
+            annotations = lookup_image_annotations(cache_db, list(set(content_hashes)), annotator)
+            missing = {}
+            for content_hash, img_pil in zip(content_hashes, images):
+                if content_hash not in annotations:
+                    missing.setdefault(content_hash, img_pil)
+            cache_hits += len(content_hashes) - sum(content_hash in missing for content_hash in content_hashes)
+            stage_seconds['cache'] += timeit.default_timer() - stage_start
             
-            # Create final doc string for BERTopic
-            doc = " ".join(all_text_components)
-            
-            # Ensure we have some text
-            if not doc.strip():
-                doc = "a the is"
+            if missing:
+                processor, model = get_blip()
+                missing_hashes = list(missing)
+                missing_images = list(missing.values())
+                ocr_futures = [ocr_pool.submit(ocr_image, img_pil) for img_pil in missing_images]
+                
+                stage_start = timeit.default_timer()
+                new_captions = caption_images(processor, model, missing_images, caption_batch_size)
+                stage_seconds['caption'] += timeit.default_timer() - stage_start
+                
+                stage_start = timeit.default_timer()
+                new_ocr_texts = [future.result() for future in ocr_futures]
+                stage_seconds['ocr_wait'] += timeit.default_timer() - stage_start
+                # Only complete annotations are cached, a failed caption or OCR is retried on the next run.
+                # This run's doc still gets whatever did succeed.
+                new_annotations = {}
+                for content_hash, caption, ocr_text in zip(missing_hashes, new_captions, new_ocr_texts):
+                    if caption is not None and ocr_text is not None:
+                        new_annotations[content_hash] = (caption, ocr_text)
+                    else:
+                        failed_annotation_count += 1
+                    annotations[content_hash] = (caption or '', ocr_text or '')
+            else:
+                new_annotations = {}
             
-            # Update the record with the doc
-            record['doc'] = convert_latex_to_plain_english(doc)
+            stage_start = timeit.default_timer()
+            store_image_annotations(cache_db, new_annotations, dict(zip(image_names, content_hashes)), annotator)
+            stage_seconds['cache'] += timeit.default_timer() - stage_start
+            captions = collections.defaultdict(str, {img_name: annotations[content_hash][0] for img_name, content_hash in zip(image_names, content_hashes)})
+            ocr_texts = collections.defaultdict(str, {img_name: annotations[content_hash][1] for img_name, content_hash in zip(image_names, content_hashes)})
             
-            # Save back to database
-            success = upsert_question_record(db, record)
+            stage_start = timeit.default_timer()
+            assembled = {}
+            for record in records:
+                try:
+                    assembled[record['question_id']] = assemble_doc(record, captions, ocr_texts)
+                except Exception as e:
+                    print(f"Error processing record {record['question_id']}: {e}")
+                    docs[record['question_id']] = "Empty educational content"
+            stage_seconds['assemble'] += timeit.default_timer() - stage_start
             
-            if success:
-                processed_count += 1
-                print(f"Processed record {processed_count}: {question_id}")
-                # print(f"  - Image descriptions: {len(image_descriptions)}")
-                # print(f"  - OCR extractions: {len(ocr_texts)}")
-                # print(f"  - Doc length: {len(doc)} chars")
-            else:
-                print(f"WARNING!!: Failed to save record: {question_id}")
+            stage_start = timeit.default_timer()
+            converted_docs, latex_stats = convert_latex_docs(list(assembled.values()), latex_cache_db)
+            docs.update(zip(assembled.keys(), converted_docs))
+            latex_expressions += latex_stats['expressions']
+            latex_cache_hits += latex_stats['cache_hits']
+            stage_seconds['latex'] += timeit.default_timer() - stage_start
             
-        except Exception as e:
-            print(f"Error processing record {record.get('question_id', 'unknown')}: {e}")
+            stage_start = timeit.default_timer()
+            saved = save_question_docs(db, docs)
+            stage_seconds['write'] += timeit.default_timer() - stage_start
             
-            # Still try to save a fallback record to avoid infinite loop
-            try:
-                record['doc'] = "Empty educational content"
-                upsert_question_record(db, record)
-                processed_count += 1
-                print(f"Saved fallback for record: {record.get('question_id', 'unknown')}")
-            except Exception as save_error:
-                print(f"Failed to save fallback record: {save_error}")
-                break  # Prevent infinite loop if DB is broken
+            processed_count += saved
+            elapsed = timeit.default_timer() - start
+            print(f"Processed {processed_count} records ({image_count} images), {processed_count / elapsed:.2f} records/sec")
+            if saved < len(docs):
+                print(f"WARNING!!: Failed to save {len(docs) - saved}/{len(docs)} docs of this chunk")
+    
+    elapsed = timeit.default_timer() - start
+    print(f"Doc creation complete! Processed {processed_count} records and {image_count} images in {elapsed:.2f}s")
+    if failed_image_count:
+        print(f"{failed_image_count} images could not be loaded and were left out of their docs")
+    if failed_annotation_count:
+        print(f"{failed_annotation_count} images failed captioning or OCR and were not cached, they are retried next run")
+    print(f"Media cache hit rate: {cache_hits}/{image_count} images ({cache_hits / image_count if image_count else 0:.1%}) skipped captioning and OCR")
+    print(f"LaTeX cache hit rate: {latex_cache_hits}/{latex_expressions} unique expressions per chunk "
+          f"({latex_cache_hits / latex_expressions if latex_expressions else 0:.1%}) skipped conversion")
+    for stage, seconds in stage_seconds.items():
+        print(f"  - {stage:<12} {seconds:8.2f}s")
     
+    cache_db.close()
+    latex_cache_db.close()
     db.close()
     print("Database connection closed.")
 
@@ -0,0 +1,73 @@
+# cached_embedder.py
+import typing
+import numpy as np
+from bertopic.backend import BaseEmbedder
+from sentence_transformers import SentenceTransformer
+from utility.embedding_cache import EMBEDDING_CACHE_FILE, open_embedding_cache, embedding_cache_key, lookup_embeddings, store_embeddings
+
+class CachedSentenceEmbedder(BaseEmbedder):
+    """
+    SentenceTransformer stand-in for BERTopic's embedding_model that serves repeated texts
+    (MMR candidate keywords, representative docs) from the persistent embedding cache.
+
+    Offers both BERTopic's embed and SentenceTransformer's encode. Texts are deduplicated,
+    looked up by hash of (model, text) and only the misses are encoded, in batches, by a
+    SentenceTransformer that is loaded on the first miss.
+    """
+    def __init__(self, model_name: str, batch_size: int = 64, cache_file: str = EMBEDDING_CACHE_FILE):
+        super().__init__()
+        self.model_name = model_name
+        self.model_variant = f"sentence-transformers:{model_name}"
+        self.batch_size = batch_size
+        self.cache_file = cache_file
+        self.cache_db = None
+        self.cache_hits = 0
+        self.encoded = 0
+
+    def get_backend(self) -> SentenceTransformer:
+        if self.embedding_model is None:
+            self.embedding_model = SentenceTransformer(self.model_name)
+        return self.embedding_model
+
+    def encode(self, sentences: typing.Union[str, typing.List[str]], batch_size: typing.Union[int, None] = None,
+               show_progress_bar: bool = False, normalize_embeddings: bool = False, **kwargs) -> np.ndarray:
+        """
+        Same call as SentenceTransformer.encode, returns a float32 numpy array (one row per sentence,
+        a single vector for a single string).
+        """
+        if isinstance(sentences, str):
+            return self.encode([sentences], batch_size, show_progress_bar, normalize_embeddings)[0]
+        if self.cache_db is None:
+            self.cache_db = open_embedding_cache(self.cache_file)
+
+        cache_keys = [embedding_cache_key(self.model_variant, sentence) for sentence in sentences]
+        vectors = lookup_embeddings(self.cache_db, list(set(cache_keys)))
+        missing = {}
+        for cache_key, sentence in zip(cache_keys, sentences):
+            if cache_key not in vectors:
+                missing.setdefault(cache_key, sentence)
+        self.cache_hits += len(cache_keys) - sum(cache_key in missing for cache_key in cache_keys)
+
+        if missing:
+            encoded = self.get_backend().encode(list(missing.values()), batch_size=batch_size or self.batch_size,
+                                                show_progress_bar=show_progress_bar, convert_to_numpy=True)
+            new_vectors = dict(zip(missing.keys(), np.asarray(encoded, dtype=np.float32)))
+            store_embeddings(self.cache_db, self.model_variant, new_vectors)
+            vectors.update(new_vectors)
+            self.encoded += len(missing)
+
+        if not cache_keys:
+            return np.zeros((0, self.get_backend().get_sentence_embedding_dimension()), dtype=np.float32)
+        embeddings = np.vstack([vectors[cache_key] for cache_key in cache_keys])
+        if normalize_embeddings:
+            embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        return embeddings
+
+    def embed(self, documents: typing.List[str], verbose: bool = False) -> np.ndarray:
+        return self.encode(documents, show_progress_bar=verbose)
+
+    def __getstate__(self):
+        # The SQLite connection cannot be pickled, it is reopened on the next encode
+        state = self.__dict__.copy()
+        state['cache_db'] = None
+        return state
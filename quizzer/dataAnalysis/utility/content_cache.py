@@ -0,0 +1,82 @@
+# content_cache.py
+import hashlib
+import datetime
+import sqlite3
+import typing
+from sqlite3 import Connection
+from utility.db_migrations import apply_connection_pragmas
+
+# Expensive results (image annotations, doc embeddings, LaTeX conversions, text features) are cached by content hash,
+# each in its own SQLite file next to data.db rather than inside it, so wiping data.db for a full resync keeps them.
+# Every cache module supplies its file name and table schema, lookups and stores go through the helpers below.
+
+# Keys per IN (...) query, below SQLite's default host parameter limit of older builds (999)
+LOOKUP_BATCH_SIZE = 900
+
+def open_content_cache(cache_file: str, schema: typing.List[str]) -> Connection:
+    """
+    Opens a cache file, running its schema statements (CREATE ... IF NOT EXISTS) on first use.
+    """
+    cache_db: Connection = sqlite3.connect(cache_file)
+    apply_connection_pragmas(cache_db)
+    for statement in schema:
+        cache_db.execute(statement)
+    cache_db.commit()
+    return cache_db
+
+def content_hash(*parts: str) -> str:
+    """
+    sha256 of the parts (e.g. model variant and text), separated so ("ab", "c") and ("a", "bc") differ.
+    """
+    return hashlib.sha256("\x00".join(parts).encode('utf-8')).hexdigest()
+
+def cache_timestamp() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+def lookup_cached_rows(cache_db: Connection, table: str, key_column: str, value_columns: typing.List[str],
+                       keys: typing.List[str], filters: typing.Union[typing.Dict[str, typing.Any], None] = None,
+                       count_hits: bool = False) -> typing.Dict[str, tuple]:
+    """
+    Returns {key: (value_columns...)} for every key already cached, LOOKUP_BATCH_SIZE keys per query.
+
+    Args:
+        filters: further column = value conditions (e.g. the annotator or converter version)
+        count_hits: bump hit_count and last_used_at of the rows found (tables that track usage)
+    """
+    filters = filters or {}
+    filter_conditions = ''.join(f" AND {column} = ?" for column in filters)
+    keys = list(keys)
+    found = {}
+    for i in range(0, len(keys), LOOKUP_BATCH_SIZE):
+        batch = keys[i:i + LOOKUP_BATCH_SIZE]
+        placeholders = ','.join('?' * len(batch))
+        cursor = cache_db.execute(f"""
+            SELECT {key_column}, {', '.join(value_columns)} FROM {table}
+            WHERE {key_column} IN ({placeholders}){filter_conditions}
+        """, batch + list(filters.values()))
+        found.update((row[0], row[1:]) for row in cursor.fetchall())
+
+    if count_hits and found:
+        now = cache_timestamp()
+        with cache_db:
+            cache_db.executemany(
+                f"UPDATE {table} SET hit_count = hit_count + 1, last_used_at = ? WHERE {key_column} = ?{filter_conditions}",
+                [(now, key, *filters.values()) for key in found]
+            )
+    return found
+
+def store_cached_rows(cache_db: Connection, table: str, key_columns: typing.List[str], rows: typing.List[typing.Dict[str, typing.Any]]) -> None:
+    """
+    Stores rows (dicts with the same columns) in one transaction. A row whose key is already cached
+    has its other columns overwritten, created_at and hit_count keep their values.
+    """
+    if not rows:
+        return
+    columns = list(rows[0])
+    update_columns = [column for column in columns if column not in key_columns and column != 'created_at']
+    conflict_action = f"DO UPDATE SET {', '.join(f'{column} = excluded.{column}' for column in update_columns)}" if update_columns else "DO NOTHING"
+    with cache_db:
+        cache_db.executemany(f"""
+            INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})
+            ON CONFLICT ({', '.join(key_columns)}) {conflict_action}
+        """, [tuple(row[column] for column in columns) for row in rows])
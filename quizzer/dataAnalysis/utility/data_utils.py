@@ -4,12 +4,12 @@ from PIL import Image
 import io
 from torchvision import transforms
 import os
-from utility.sync_fetch_data import initialize_supabase_session
-from supabase import Client
+import time
+import threading
+from utility.sync_fetch_data import get_supabase_client, write_bytes_atomically
+from concurrent.futures import ThreadPoolExecutor
 import torchvision.transforms as transforms
-import yake
-from latex2sympy2 import latex2sympy
-import re
+from utility.text_features import extract_keywords, detect_is_math
 import pandas as pd
 import numpy as np
 from sklearn.decomposition import PCA
@@ -25,45 +25,158 @@ transform = transforms.Compose([
     )
 ])
 
-def load_image(image_name: str):
+IMAGE_DIR = "data_images"
+IMAGE_BUCKET = "question-answer-pair-assets"
+# On-disk budget for downloaded images, least recently used files are evicted beyond it
+IMAGE_DIR_MAX_BYTES = 2 * 1024 ** 3
+# Images whose download failed in this process, not requested again until the next run
+failed_downloads = set()
+
+class ImageDirUsage:
+    """
+    Last use time and size of every file in IMAGE_DIR, with their running total. The directory is walked
+    once per process, on first use, and then kept current as images are downloaded, read and evicted,
+    so checking the budget after every prefetched chunk never rescans it.
+    """
+    def __init__(self, image_dir: str):
+        self.image_dir = image_dir
+        self.files = None
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def scan(self) -> None:
+        # Caller holds the lock, mtime is the last use of files from earlier runs (load_image touches it)
+        self.files = {}
+        for root, _, file_names in os.walk(self.image_dir):
+            for file_name in file_names:
+                path = os.path.join(root, file_name)
+                stat = os.stat(path)
+                self.files[os.path.relpath(path, self.image_dir)] = (stat.st_mtime, stat.st_size)
+        self.total_bytes = sum(size for _, size in self.files.values())
+
+    def touch(self, image_name: str, size: Union[int, None] = None) -> None:
+        """
+        Marks an image as just used, with its new size after a download (None keeps the known size).
+        """
+        with self.lock:
+            if self.files is None:
+                self.scan()
+            previous = self.files.get(image_name)
+            if size is None:
+                size = previous[1] if previous else os.path.getsize(os.path.join(self.image_dir, image_name))
+            self.total_bytes += size - (previous[1] if previous else 0)
+            self.files[image_name] = (time.time(), size)
+
+    def evict(self, max_bytes: int, protected: set) -> int:
+        with self.lock:
+            if self.files is None:
+                self.scan()
+            evicted = 0
+            if self.total_bytes <= max_bytes:
+                return evicted
+            for image_name, (_, size) in sorted(self.files.items(), key=lambda item: item[1][0]):
+                if self.total_bytes <= max_bytes:
+                    break
+                if image_name in protected:
+                    continue
+                try:
+                    os.remove(os.path.join(self.image_dir, image_name))
+                except FileNotFoundError:
+                    pass  # already removed by another process
+                del self.files[image_name]
+                self.total_bytes -= size
+                evicted += 1
+            return evicted
+
+image_dir_usage = ImageDirUsage(IMAGE_DIR)
+
+def download_image(image_name: str) -> Union[bytes, None]:
+    """
+    Downloads an image from Supabase storage through the shared client and stores it in IMAGE_DIR atomically,
+    so a concurrent reader never sees a partial file. Returns the image bytes, or None if the download failed.
+    """
+    try:
+        res = get_supabase_client().storage.from_(IMAGE_BUCKET).download(image_name)
+    except Exception as e:
+        print(f"Error downloading image {image_name}: {e}")
+        failed_downloads.add(image_name)
+        return None
+    
+    local_path = os.path.join(IMAGE_DIR, image_name)
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    write_bytes_atomically(local_path, res)
+    image_dir_usage.touch(image_name, len(res))
+    return res
+
+def prefetch_images(image_names: List[str], max_workers: int = 8, max_bytes: int = IMAGE_DIR_MAX_BYTES) -> dict:
+    """
+    Downloads every image of a batch that is not stored locally yet (and did not fail to download
+    earlier in this run), at most max_workers at a time, then trims IMAGE_DIR back under max_bytes without evicting any image of this batch.
+    
+    Returns:
+        {'requested', 'downloaded', 'failed', 'evicted'}
+    """
+    unique_names = list(dict.fromkeys(image_name for image_name in image_names if image_name))
+    missing = [image_name for image_name in unique_names
+               if image_name not in failed_downloads and not os.path.exists(os.path.join(IMAGE_DIR, image_name))]
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(download_image, missing))
+    
+    failed = sum(res is None for res in results)
+    evicted = evict_least_recently_used_images(max_bytes, protected=set(unique_names))
+    stats = {'requested': len(unique_names), 'downloaded': len(missing) - failed, 'failed': failed, 'evicted': evicted}
+    if missing or evicted:
+        print(f"Prefetched {stats['downloaded']}/{len(missing)} missing images "
+              f"({failed} failed, {evicted} evicted from {IMAGE_DIR})")
+    return stats
+
+def evict_least_recently_used_images(max_bytes: int, protected: set = frozenset()) -> int:
+    """
+    Deletes the least recently used files in IMAGE_DIR until it fits in max_bytes, judged by
+    image_dir_usage's running totals rather than a fresh walk of the directory.
+    
+    Returns:
+        Number of files deleted
+    """
+    return image_dir_usage.evict(max_bytes, protected)
+
+def load_image(image_name: str) -> Union[Image.Image, None]:
     """
     Load an image from local path or Supabase storage.
-    Returns a PIL Image (not tensor) if found, None if not.
+    Returns a PIL Image (not tensor) if found, None if not. Images that already failed to
+    download in this run (see prefetch_images) are not requested again.
     """
     # Handle empty or None image_name
     if not image_name:
-        return Image.new('RGB', (224, 224), color='white')
+        return None
     
-    local_path = os.path.join("data_images", image_name)
+    local_path = os.path.join(IMAGE_DIR, image_name)
     
     # Try to load from local path first
     if os.path.exists(local_path):
         try:
             img = Image.open(local_path).convert('RGB')
+            os.utime(local_path)  # mark as recently used for LRU eviction, also for later runs
+            image_dir_usage.touch(image_name)
             return img  # Return PIL Image, not tensor
         except Exception as e:
             print(f"Error loading local image {image_name}: {e}")
-            return Image.new('RGB', (224, 224), color='white')
+            return None
     
     # Try to download from Supabase if not found locally
+    if image_name in failed_downloads:
+        return None
+    res = download_image(image_name)
+    if res is None:
+        return None
+    
     try:
-        supabase_client: Client = initialize_supabase_session()
-        res = supabase_client.storage.from_('question-answer-pair-assets').download(image_name)
-        
-        # Create directory if it doesn't exist
-        os.makedirs(os.path.dirname(local_path), exist_ok=True)
-        
-        # Save the downloaded file locally
-        with open(local_path, "wb") as f:
-            f.write(res)
-        
         # Load and return PIL image (not tensor)
-        img = Image.open(io.BytesIO(res)).convert('RGB')
-        return img
-        
+        return Image.open(io.BytesIO(res)).convert('RGB')
     except Exception as e:
-        print(f"Error downloading/processing image {image_name}: {e}")
-        return Image.new('RGB', (224, 224), color='white')
+        print(f"Error processing image {image_name}: {e}")
+        return None
     
 
 def text_to_image(text: str, width: int = 800, font_size: int = 16) -> Image.Image:
@@ -144,49 +257,13 @@ def combine_images_vertically(images: List[Image.Image], target_width: int = 800
 
 def get_keywords(sentence):
     """
-    Extract keywords using YAKE library
+    Extract keywords using YAKE library (shared extractor, see text_features.extract_keywords)
     """
-    if not sentence or not isinstance(sentence, str):
-        return []
-    
-    # manually exclude keywords that are not related to subject matter or concept matter
-    excluded = ["lowest to highest", "highest to lowest", "correct order", "identify terms", "describes the solution", 
-                "find the missing", "directly", "Find", "find", "select", "Select",]
-
-    language = "en"
-    max_ngram_size = 3  # Extract up to 3-word phrases
-    deduplication_threshold = 0.9
-    num_keywords = 10
-    
-    custom_kw_extractor = yake.KeywordExtractor(
-        lan=language,
-        n=max_ngram_size,
-        dedupLim=deduplication_threshold,
-        top=num_keywords
-    )
-    
-    keywords = custom_kw_extractor.extract_keywords(sentence)
-    
-    # Return just the keyword strings (YAKE returns tuples with scores)
-    return [keyword for keyword, score in keywords if keyword not in excluded]
+    return extract_keywords(sentence)
 
 def get_is_math(sentence):
-    if not sentence or not isinstance(sentence, str):
-        return False
-    
-    latex_matches = re.findall(r'\$(.+?)\$', sentence)
-    
-    if not latex_matches:
-        return False
-    
-    for latex_expr in latex_matches:
-        try:
-            latex2sympy(latex_expr.strip())
-            return True
-        except:
-            continue
-    
-    return False
+    is_math, _ = detect_is_math(sentence)
+    return is_math
 
 def filter_df_for_k_means(df):
     """
@@ -0,0 +1,191 @@
+# db_migrations.py
+import sqlite3
+from sqlite3 import Connection
+from utility.vector_store import encode_vector_value
+
+# Applied to every connection opened on data.db
+# WAL lets readers (e.g. neural net pre-processing) run while the sync writes, and with WAL
+# synchronous=NORMAL only fsyncs at checkpoints instead of on every commit.
+CONNECTION_PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -65536",       # 64 MiB page cache (negative values are KiB)
+    "PRAGMA mmap_size = 268435456",     # 256 MiB memory mapped reads
+    "PRAGMA busy_timeout = 5000",
+]
+
+# Columns computed or tracked locally that Supabase does not necessarily have
+LOCAL_PAIR_COLUMNS = {
+    'question_vector': 'TEXT',
+    'doc': 'TEXT',
+    'k_nearest_neighbors': 'TEXT',
+    'knn_pushed': 'TEXT',           # last k_nearest_neighbors accepted by Supabase
+    'is_math': 'INTEGER',           # SQLite stores booleans as integers
+    'keywords': 'TEXT',
+}
+
+def add_column_if_missing(cursor, table_name: str, column_name: str, column_type: str) -> None:
+    """
+    Adds a column unless it already exists. Databases created before migrations existed
+    may already carry any of the locally computed columns.
+    """
+    cursor.execute(f"PRAGMA table_info({table_name})")
+    if column_name not in {row[1] for row in cursor.fetchall()}:
+        cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}")
+
+def migration_001_create_tables(cursor) -> None:
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS question_answer_pairs (
+        question_id TEXT NOT NULL PRIMARY KEY,
+        time_stamp TEXT,
+        citation TEXT,
+        question_elements TEXT NOT NULL,
+        answer_elements TEXT NOT NULL,
+        concepts TEXT,
+        subjects TEXT,
+        question_type TEXT NOT NULL,
+        options TEXT,
+        correct_option_index INTEGER,
+        correct_order TEXT,
+        index_options_that_apply TEXT,
+        qst_contrib TEXT NOT NULL,
+        ans_contrib TEXT,
+        qst_reviewer TEXT,
+        has_been_reviewed INTEGER NOT NULL DEFAULT 0,
+        ans_flagged INTEGER NOT NULL DEFAULT 0,
+        flag_for_removal INTEGER NOT NULL DEFAULT 0,
+        completed INTEGER,
+        last_modified_timestamp TEXT,
+        has_media SMALLINT,
+        answers_to_blanks TEXT
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS question_answer_attempts (
+        time_stamp TEXT NOT NULL,
+        question_id TEXT NOT NULL,
+        participant_id TEXT NOT NULL,
+        avg_react_time REAL NOT NULL,
+        response_result INTEGER NOT NULL,
+        was_first_attempt INTEGER NOT NULL,
+        last_revised_date TEXT,
+        days_since_last_revision REAL,
+        total_attempts INTEGER NOT NULL,
+        revision_streak INTEGER NOT NULL,
+        question_vector TEXT,
+        question_type TEXT,
+        num_mcq_options INTEGER DEFAULT 0,
+        num_so_options INTEGER DEFAULT 0,
+        num_sata_options INTEGER DEFAULT 0,
+        num_blanks INTEGER DEFAULT 0,
+        total_correct_attempts INTEGER,
+        total_incorrect_attempts INTEGER,
+        accuracy_rate REAL,
+        time_of_presentation TEXT,
+        days_since_first_introduced REAL,
+        attempt_day_ratio REAL,
+        user_stats_vector TEXT,
+        module_performance_vector TEXT,
+        user_profile_record TEXT,
+        PRIMARY KEY (time_stamp, question_id, participant_id)
+    )
+    """)
+
+def migration_002_local_pair_columns(cursor) -> None:
+    for column_name, column_type in LOCAL_PAIR_COLUMNS.items():
+        add_column_if_missing(cursor, 'question_answer_pairs', column_name, column_type)
+
+def migration_003_normalize_empty_work_columns(cursor) -> None:
+    # "Needs work" is expressed as IS NULL from here on, so the partial indexes below cover it
+    cursor.execute("UPDATE question_answer_pairs SET doc = NULL WHERE doc = ''")
+    cursor.execute("UPDATE question_answer_pairs SET question_vector = NULL WHERE question_vector = ''")
+
+def migration_004_indexes(cursor) -> None:
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_attempts_question_id ON question_answer_attempts (question_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_attempts_participant_time ON question_answer_attempts (participant_id, time_stamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pairs_last_modified ON question_answer_pairs (last_modified_timestamp)")
+    # Partial indexes only hold the rows still waiting on a pipeline stage, so they stay tiny
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pairs_needs_doc ON question_answer_pairs (question_id) WHERE doc IS NULL")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pairs_needs_vector ON question_answer_pairs (question_id) WHERE question_vector IS NULL")
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_pairs_knn_unpushed ON question_answer_pairs (question_id)
+        WHERE k_nearest_neighbors IS NOT knn_pushed
+    """)
+
+def migration_005_question_vector_blobs(cursor) -> None:
+    # JSON text arrays -> little-endian float32 BLOBs (see vector_store.py), readers still accept leftover JSON
+    cursor.connection.create_function('encode_vector_value', 1, encode_vector_value, deterministic=True)
+    for table_name in ('question_answer_pairs', 'question_answer_attempts'):
+        cursor.execute(f"""
+            UPDATE {table_name} SET question_vector = encode_vector_value(question_vector)
+            WHERE typeof(question_vector) = 'text'
+        """)
+        print(f"Converted {cursor.rowcount} {table_name}.question_vector values to float32 BLOBs")
+
+def migration_006_drop_attempt_vector_copies(cursor) -> None:
+    # Attempts join their question's vector at read time, the per-attempt copies are dead weight
+    cursor.execute("UPDATE question_answer_attempts SET question_vector = NULL WHERE question_vector IS NOT NULL")
+    print(f"Cleared {cursor.rowcount} copied question_answer_attempts.question_vector values (run VACUUM to shrink data.db)")
+
+def migration_007_feature_index(cursor) -> None:
+    # is_math / keywords are filled by the text feature stage, NULL until then
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pairs_needs_features ON question_answer_pairs (question_id) WHERE is_math IS NULL")
+
+# Ordered list, the position of a migration (1-based) is the schema version it produces.
+# Never edit or reorder an applied migration, append a new one instead.
+MIGRATIONS = [
+    migration_001_create_tables,
+    migration_002_local_pair_columns,
+    migration_003_normalize_empty_work_columns,
+    migration_004_indexes,
+    migration_005_question_vector_blobs,
+    migration_006_drop_attempt_vector_copies,
+    migration_007_feature_index,
+]
+
+def apply_connection_pragmas(db: Connection) -> None:
+    cursor = db.cursor()
+    for pragma in CONNECTION_PRAGMAS:
+        cursor.execute(pragma)
+
+def get_schema_version(db: Connection) -> int:
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate_database(db: Connection) -> int:
+    """
+    Brings the local schema up to date by applying every migration newer than PRAGMA user_version.
+
+    Each migration runs in its own transaction together with the user_version bump,
+    so an interrupted run resumes at the first migration that did not complete.
+
+    Returns:
+        The schema version after migrating.
+    """
+    current_version = get_schema_version(db)
+    if current_version > len(MIGRATIONS):
+        raise RuntimeError(f"data.db schema version {current_version} is newer than this code ({len(MIGRATIONS)})")
+
+    cursor = db.cursor()
+    if db.in_transaction:
+        db.commit()
+
+    for version, migration in enumerate(MIGRATIONS[current_version:], start=current_version + 1):
+        print(f"Applying schema migration {version}: {migration.__name__}")
+        with db:
+            cursor.execute("BEGIN")
+            migration(cursor)
+            cursor.execute(f"PRAGMA user_version = {version}")
+
+    if current_version < len(MIGRATIONS):
+        cursor.execute("ANALYZE")
+    return len(MIGRATIONS)
+
+def open_database(db_file: str) -> Connection:
+    """
+    Opens a SQLite database with the tuned pragmas applied and the schema migrated.
+    """
+    db: Connection = sqlite3.connect(db_file)
+    apply_connection_pragmas(db)
+    migrate_database(db)
+    return db
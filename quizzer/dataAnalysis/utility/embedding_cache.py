@@ -0,0 +1,42 @@
+# embedding_cache.py
+import typing
+import numpy as np
+from sqlite3 import Connection
+from utility.vector_store import encode_vector, decode_vector
+from utility.content_cache import open_content_cache, content_hash, cache_timestamp, lookup_cached_rows, store_cached_rows
+
+EMBEDDING_CACHE_FILE = "embedding_cache.db"
+# One float32 BLOB per hash of (model variant, doc text)
+EMBEDDING_CACHE_SCHEMA = ["""
+    CREATE TABLE IF NOT EXISTS doc_embeddings (
+        cache_key TEXT NOT NULL PRIMARY KEY,
+        model_variant TEXT NOT NULL,
+        vector BLOB NOT NULL,
+        created_at TEXT NOT NULL,
+        last_used_at TEXT NOT NULL,
+        hit_count INTEGER NOT NULL DEFAULT 0
+    )
+"""]
+
+def open_embedding_cache(cache_file: str = EMBEDDING_CACHE_FILE) -> Connection:
+    return open_content_cache(cache_file, EMBEDDING_CACHE_SCHEMA)
+
+def embedding_cache_key(model_variant: str, doc: str) -> str:
+    return content_hash(model_variant, doc)
+
+def lookup_embeddings(cache_db: Connection, cache_keys: typing.List[str]) -> typing.Dict[str, np.ndarray]:
+    """
+    Returns {cache_key: vector} for every key already embedded, and counts the hits.
+    """
+    found = lookup_cached_rows(cache_db, 'doc_embeddings', 'cache_key', ['vector'], cache_keys, count_hits=True)
+    return {cache_key: decode_vector(vector) for cache_key, (vector,) in found.items()}
+
+def store_embeddings(cache_db: Connection, model_variant: str, vectors: typing.Dict[str, np.ndarray]) -> None:
+    """
+    Stores freshly computed embeddings {cache_key: vector} in one transaction.
+    """
+    now = cache_timestamp()
+    store_cached_rows(cache_db, 'doc_embeddings', ['cache_key'], [
+        {'cache_key': cache_key, 'model_variant': model_variant, 'vector': encode_vector(vector), 'created_at': now, 'last_used_at': now}
+        for cache_key, vector in vectors.items()
+    ])
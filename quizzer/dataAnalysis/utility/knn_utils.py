@@ -3,48 +3,104 @@ import numpy as np
 import json
 import matplotlib.pyplot as plt
 from sklearn.neighbors import NearestNeighbors
+from sklearn.metrics import pairwise_distances
+from sklearn.metrics.pairwise import paired_distances
 from pathlib import Path
 import pandas as pd
 
-def compute_complete_pairwise_distances(embeddings, metric='manhattan'):
+# Plotted histogram bins, and the finer bins the quantiles and CDF are read from
+DISTANCE_HISTOGRAM_BINS = 100
+DISTANCE_QUANTILE_BINS = 10000
+
+def iterate_pairwise_distances(embeddings, metric='manhattan', chunk_size=256, max_pairs=None, seed=0):
     """
-    Computes all pairwise distances between embeddings (full distance matrix).
+    Yields the distances of every pair i < j (each pair once, self excluded), one block of rows at a time.
     
     Args:
         embeddings: numpy array of shape (n_samples, n_features)
         metric: distance metric ('manhattan', 'euclidean', 'cosine', etc.)
-    
-    Returns:
-        distance_matrix: complete n x n distance matrix
-        question_ids: list of corresponding question IDs (for reference)
+        chunk_size: rows per block, at most chunk_size x n_samples distances are held at once
+        max_pairs: when there are more pairs than this, yield this many pairs sampled uniformly instead
+        seed: sampling seed, the same seed yields the same pairs
     """
     n_samples = embeddings.shape[0]
+    if max_pairs is not None and n_samples * (n_samples - 1) // 2 > max_pairs:
+        rng = np.random.default_rng(seed)
+        for start in range(0, max_pairs, chunk_size * n_samples):
+            size = min(chunk_size * n_samples, max_pairs - start)
+            rows = rng.integers(0, n_samples, size)
+            # Uniform over the other n - 1 points, so a pair never pairs a point with itself
+            others = rng.integers(0, n_samples - 1, size)
+            others += others >= rows
+            yield paired_distances(embeddings[rows], embeddings[others], metric=metric)
+        return
+    for start in range(0, n_samples, chunk_size):
+        block = pairwise_distances(embeddings[start:start + chunk_size], embeddings[start:], metric=metric)
+        yield block[np.triu_indices(block.shape[0], k=1, m=block.shape[1])]
+
+def compute_distance_distribution(embeddings, metric='manhattan', bins=DISTANCE_HISTOGRAM_BINS, chunk_size=256, max_pairs=None):
+    """
+    Streams the pairwise distances into fixed-bin histograms and summary statistics, without
+    materializing the n x n distance matrix. Two passes: the first finds the range and the
+    mean / std (merged per block), the second fills the histograms over that range.
     
-    # Initialize distance matrix
-    distance_matrix = np.zeros((n_samples, n_samples))
-    
-    # Use NearestNeighbors to compute all distances efficiently
-    knn = NearestNeighbors(n_neighbors=n_samples, metric=metric)
-    knn.fit(embeddings)
-    
-    # Get distances to all points (including self)
-    distances, _ = knn.kneighbors(embeddings, n_neighbors=n_samples)
-    
-    # Fill the distance matrix
-    for i in range(n_samples):
-        distance_matrix[i] = distances[i]
-    
-    # Make sure diagonal is 0 (distance to self)
-    np.fill_diagonal(distance_matrix, 0)
+    On every pair (max_pairs None) the histogram equals np.histogram(distances, bins) of the full
+    upper triangle. Quantiles are interpolated from DISTANCE_QUANTILE_BINS bins.
     
-    return distance_matrix
+    Returns:
+        dict with 'counts' and 'bin_edges' (plotted histogram), 'fine_counts' and 'fine_edges',
+        'mean', 'std', 'min', 'max', 'total_pairs' and 'sampled' (pairs were sampled)
+    """
+    total_pairs, mean, m2 = 0, 0.0, 0.0
+    low, high = np.inf, -np.inf
+    for distances in iterate_pairwise_distances(embeddings, metric, chunk_size, max_pairs):
+        if not len(distances):
+            continue
+        # Chan et al. merge of the running and the block mean / squared deviations
+        block_mean = distances.mean()
+        delta = block_mean - mean
+        combined = total_pairs + len(distances)
+        mean += delta * len(distances) / combined
+        m2 += ((distances - block_mean) ** 2).sum() + delta ** 2 * total_pairs * len(distances) / combined
+        total_pairs = combined
+        low, high = min(low, distances.min()), max(high, distances.max())
+    if not total_pairs:
+        raise ValueError("At least two embeddings are needed for a distance distribution")
 
-def plot_distance_distribution(distance_matrix, output_dir="distance_plots", prefix="raw"):
+    # Same range np.histogram picks for the full set of distances
+    histogram_range = (low - 0.5, high + 0.5) if low == high else (low, high)
+    counts = np.zeros(bins, dtype=np.int64)
+    fine_counts = np.zeros(DISTANCE_QUANTILE_BINS, dtype=np.int64)
+    for distances in iterate_pairwise_distances(embeddings, metric, chunk_size, max_pairs):
+        counts += np.histogram(distances, bins=bins, range=histogram_range)[0]
+        fine_counts += np.histogram(distances, bins=DISTANCE_QUANTILE_BINS, range=histogram_range)[0]
+
+    return {
+        'counts': counts,
+        'bin_edges': np.linspace(*histogram_range, bins + 1),
+        'fine_counts': fine_counts,
+        'fine_edges': np.linspace(*histogram_range, DISTANCE_QUANTILE_BINS + 1),
+        'mean': mean,
+        'std': np.sqrt(m2 / total_pairs),
+        'min': low,
+        'max': high,
+        'total_pairs': total_pairs,
+        'sampled': max_pairs is not None and total_pairs == max_pairs,
+    }
+
+def distribution_quantile(distribution, q):
+    """
+    Distance below which a fraction q of the pairs lie, linearly interpolated within the fine bins.
+    """
+    cdf = np.concatenate([[0], np.cumsum(distribution['fine_counts'])]) / distribution['total_pairs']
+    return float(np.interp(q, cdf, distribution['fine_edges']))
+
+def plot_distance_distribution(distribution, output_dir="distance_plots", prefix="raw"):
     """
-    Plots the distribution of distances from the complete distance matrix.
+    Plots the distribution of pairwise distances from compute_distance_distribution's histograms.
     
     Args:
-        distance_matrix: n x n numpy array of distances
+        distribution: dict returned by compute_distance_distribution
         output_dir: directory to save plots
         prefix: prefix for filenames (e.g., "raw", "normalized")
     """
@@ -52,38 +108,38 @@ def plot_distance_distribution(distance_matrix, output_dir="distance_plots", pre
     output_path = Path(output_dir)
     output_path.mkdir(exist_ok=True)
     
-    # Flatten the upper triangle (excluding diagonal) to avoid double counting
-    n = distance_matrix.shape[0]
-    triu_indices = np.triu_indices(n, k=1)
-    distances_flat = distance_matrix[triu_indices]
+    counts, bin_edges = distribution['counts'], distribution['bin_edges']
+    q25, median, q75 = (distribution_quantile(distribution, q) for q in (0.25, 0.5, 0.75))
     
     # Create figure
     fig, axes = plt.subplots(2, 2, figsize=(15, 12))
     
     # 1. Histogram of all distances
-    axes[0, 0].hist(distances_flat, bins=100, alpha=0.7, edgecolor='black')
+    axes[0, 0].hist(bin_edges[:-1], bins=bin_edges, weights=counts, alpha=0.7, edgecolor='black')
     axes[0, 0].set_xlabel('Distance')
     axes[0, 0].set_ylabel('Frequency')
     axes[0, 0].set_title(f'Distribution of All Pairwise Distances ({prefix})')
     axes[0, 0].grid(True, alpha=0.3)
     
-    # 2. Box plot
-    axes[0, 1].boxplot(distances_flat, vert=True, patch_artist=True)
+    # 2. Box plot, whiskers at 1.5 IQR clipped to the range, individual outliers are not kept
+    iqr = q75 - q25
+    axes[0, 1].bxp([{'med': median, 'q1': q25, 'q3': q75, 'fliers': [],
+                     'whislo': max(distribution['min'], q25 - 1.5 * iqr),
+                     'whishi': min(distribution['max'], q75 + 1.5 * iqr)}], patch_artist=True)
     axes[0, 1].set_ylabel('Distance')
     axes[0, 1].set_title(f'Box Plot of Distances ({prefix})')
     axes[0, 1].grid(True, alpha=0.3)
     
     # 3. Cumulative distribution
-    sorted_dists = np.sort(distances_flat)
-    cdf = np.arange(1, len(sorted_dists) + 1) / len(sorted_dists)
-    axes[1, 0].plot(sorted_dists, cdf, linewidth=2)
+    cdf = np.cumsum(distribution['fine_counts']) / distribution['total_pairs']
+    axes[1, 0].plot(distribution['fine_edges'][1:], cdf, linewidth=2)
     axes[1, 0].set_xlabel('Distance')
     axes[1, 0].set_ylabel('Cumulative Probability')
     axes[1, 0].set_title(f'Cumulative Distribution Function ({prefix})')
     axes[1, 0].grid(True, alpha=0.3)
     
     # 4. Log-scale histogram for tail behavior
-    axes[1, 1].hist(distances_flat, bins=100, alpha=0.7, edgecolor='black', log=True)
+    axes[1, 1].hist(bin_edges[:-1], bins=bin_edges, weights=counts, alpha=0.7, edgecolor='black', log=True)
     axes[1, 1].set_xlabel('Distance')
     axes[1, 1].set_ylabel('Frequency (log scale)')
     axes[1, 1].set_title(f'Log-Scale Distribution ({prefix})')
@@ -95,14 +151,15 @@ def plot_distance_distribution(distance_matrix, output_dir="distance_plots", pre
     
     # Also save statistics to a CSV file
     stats = {
-        'mean': np.mean(distances_flat),
-        'median': np.median(distances_flat),
-        'std': np.std(distances_flat),
-        'min': np.min(distances_flat),
-        'max': np.max(distances_flat),
-        'q25': np.percentile(distances_flat, 25),
-        'q75': np.percentile(distances_flat, 75),
-        'total_pairs': len(distances_flat)
+        'mean': distribution['mean'],
+        'median': median,
+        'std': distribution['std'],
+        'min': distribution['min'],
+        'max': distribution['max'],
+        'q25': q25,
+        'q75': q75,
+        'total_pairs': distribution['total_pairs'],
+        'sampled': distribution['sampled']
     }
     
     stats_df = pd.DataFrame([stats])
@@ -126,39 +183,35 @@ def compute_knn_model(embeddings, k=25, metric='manhattan'):
     knn_model.fit(embeddings)
     return knn_model
 
-def update_knn_vectors_locally(db, question_ids, knn_model, embeddings):
+def update_knn_vectors_locally(db, question_ids, knn_model, embeddings, query_rows=None, neighbors=None):
     """
     Updates KNN vectors in database only for records that have actually changed.
     
     Args:
         db: SQLite database connection
         question_ids: list of question_ids corresponding to the embeddings
-        knn_model: fitted NearestNeighbors model
+        knn_model: fitted NearestNeighbors model, or any index with the same kneighbors (see ann_index.py)
         embeddings: numpy array of embeddings used to fit the model
+        query_rows: rows whose neighbours may have changed (see ann_index.find_affected_rows), None queries every row
+        neighbors: (distances, indices) of query_rows when already queried (see ann_index.refresh_knn_index)
     
     Returns:
         tuple: (changed_records, total_records)
         - changed_records: list of question_ids that were updated
         - total_records: total number of records processed
     """
-    # Compute distances and indices for all embeddings
-    distances, indices = knn_model.kneighbors(embeddings)
+    if query_rows is None:
+        query_rows = np.arange(len(question_ids))
+    # Compute distances and indices for the queried embeddings
+    distances, indices = knn_model.kneighbors(embeddings[query_rows]) if neighbors is None else neighbors
     
     cursor = db.cursor()
     
-    # Ensure column exists
-    cursor.execute("PRAGMA table_info(question_answer_pairs)")
-    columns = [col[1] for col in cursor.fetchall()]
-    
-    if 'k_nearest_neighbors' not in columns:
-        cursor.execute("ALTER TABLE question_answer_pairs ADD COLUMN k_nearest_neighbors TEXT")
-    
-    db.commit()
-    
     changed_records = []
     total_records = len(question_ids)
     
-    for i, question_id in enumerate(question_ids):
+    for i, row in enumerate(query_rows):
+        question_id = question_ids[row]
         # Create new neighbors map with distances
         new_neighbors_map = {
             question_ids[idx]: float(dist) 
@@ -197,6 +250,6 @@ def update_knn_vectors_locally(db, question_ids, knn_model, embeddings):
         print(f"Updated {len(changed_records)}/{total_records} records with new KNN vectors")
         print(f"Records needing server reset: {len(changed_records)}")
     else:
-        print(f"No KNN vectors changed. All {total_records} records unchanged.")
+        print(f"No KNN vectors changed. All {total_records} records unchanged ({len(query_rows)} queried).")
     
     return changed_records, total_records
\ No newline at end of file
@@ -0,0 +1,168 @@
+# latex_conversion.py
+import re
+import functools
+import typing
+from sqlite3 import Connection
+from pylatexenc import macrospec, latexwalker
+from pylatexenc.latexwalker import LatexMacroNode, LatexGroupNode, LatexCharsNode
+from utility.content_cache import open_content_cache, cache_timestamp, lookup_cached_rows, store_cached_rows
+
+LATEX_CACHE_FILE = "latex_cache.db"
+# Bump whenever the conversion rules below change, older cached conversions are then ignored
+LATEX_CONVERTER_VERSION = "1"
+# One English conversion per (LaTeX expression, converter version)
+LATEX_CACHE_SCHEMA = ["""
+    CREATE TABLE IF NOT EXISTS latex_conversions (
+        latex TEXT NOT NULL,
+        converter_version TEXT NOT NULL,
+        english TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        PRIMARY KEY (latex, converter_version)
+    )
+"""]
+
+# LaTeX delimited by $$ ... $$ or $ ... $
+LATEX_PATTERN = re.compile(r'\$\$([^\$]+)\$\$|\$([^\$]+)\$')
+# Chemical notation is left untouched
+CHEMICAL_PATTERN = re.compile(r'\b(NADH|NAD|ATP|ADP|DNA|RNA|CO2|H2O|NH3|CH4|FAD|FADH|CoA)\b|\b[A-Z][a-z]?\d*\^?[\+\-]?\d*\b')
+
+# No replacement contains one of the replaced characters, so a single translate pass matches chained replaces
+CHAR_WORDS = str.maketrans({
+    '+': ' plus ',
+    '-': ' minus ',
+    '=': ' equals ',
+    '/': ' divided by ',
+    '*': ' times ',
+    '%': ' percent ',
+    '<': ' less than ',
+    '>': ' greater than ',
+    '(': ' open parenthesis ',
+    ')': ' close parenthesis ',
+})
+
+# Macros read as a fixed phrase, frac and sqrt take arguments and are handled in latex_node_to_english
+MACRO_WORDS = {
+    'int': ' integral ', 'sum': ' summation ', 'prod': ' product ', 'lim': ' limit ',
+    'cdot': ' times ', 'times': ' times ', 'div': ' divided by ',
+    'pm': ' plus or minus ', 'mp': ' minus or plus ',
+    'neq': ' not equal to ', 'leq': ' less than or equal to ', 'geq': ' greater than or equal to ',
+    'approx': ' approximately equal to ', 'equiv': ' equivalent to ', 'propto': ' proportional to ',
+    'infty': ' infinity ', 'partial': ' partial derivative ', 'nabla': ' del ',
+    'to': ' approaches ', 'rightarrow': ' approaches ',
+    'sin': ' sine ', 'cos': ' cosine ', 'tan': ' tangent ', 'sec': ' secant ', 'csc': ' cosecant ', 'cot': ' cotangent ',
+    'arcsin': ' arcsine ', 'arccos': ' arccosine ', 'arctan': ' arctangent ',
+    'sinh': ' hyperbolic sine ', 'cosh': ' hyperbolic cosine ', 'tanh': ' hyperbolic tangent ',
+    'log': ' logarithm ', 'ln': ' natural logarithm ', 'exp': ' exponential ',
+    'max': ' maximum ', 'min': ' minimum ', 'sup': ' supremum ', 'inf': ' infimum ',
+    'det': ' determinant ', 'gcd': ' greatest common divisor ', 'arg': ' argument ', 'deg': ' degree ', 'dim': ' dimension ',
+    'cup': ' union ', 'cap': ' intersection ', 'in': ' element of ', 'notin': ' not element of ',
+    'subset': ' subset of ', 'subseteq': ' subset of ', 'supset': ' superset of ', 'supseteq': ' superset of ',
+    'emptyset': ' empty set ', 'forall': ' for all ', 'exists': ' there exists ',
+    'land': ' logical and ', 'wedge': ' wedge ', 'lor': ' logical or ', 'vee': ' vee ',
+    'neg': ' logical not ', 'lnot': ' logical not ',
+    'implies': ' implies ', 'Rightarrow': ' implies ', 'iff': ' biconditional ', 'Leftrightarrow': ' biconditional ',
+}
+
+def build_latex_context():
+    """
+    pylatexenc's default context, plus ^ and _ parsed as specials taking one argument.
+    """
+    latex_context = latexwalker.get_default_latex_context_db()
+    latex_context.add_context_category('powers', specials=[
+        macrospec.SpecialsSpec('^', args_parser=macrospec.MacroStandardArgsParser('{')),
+        macrospec.SpecialsSpec('_', args_parser=macrospec.MacroStandardArgsParser('{')),
+    ])
+    return latex_context
+
+# Built once per process and shared by every conversion
+LATEX_CONTEXT = build_latex_context()
+
+def node_arguments(node) -> list:
+    if node.nodeargd and hasattr(node.nodeargd, 'argnlist'):
+        return node.nodeargd.argnlist
+    return []
+
+def latex_node_to_english(node) -> str:
+    """Recursively process a single LaTeX node to English."""
+    if isinstance(node, LatexCharsNode):
+        return node.chars.translate(CHAR_WORDS)
+
+    if isinstance(node, LatexGroupNode):
+        return ''.join(latex_node_to_english(n) for n in node.nodelist)
+
+    if isinstance(node, latexwalker.LatexSpecialsNode):
+        arguments = node_arguments(node)
+        if node.specials_chars == '^':
+            return f' to the power of {latex_node_to_english(arguments[0])}' if arguments else ' to the power of '
+        elif node.specials_chars == '_':
+            return f' subscript {latex_node_to_english(arguments[0])}' if arguments else ' subscript '
+
+    if isinstance(node, LatexMacroNode):
+        macro = node.macroname
+        arguments = node_arguments(node)
+        if macro == 'frac':
+            if len(arguments) >= 2:
+                return f' {latex_node_to_english(arguments[0])} divided by {latex_node_to_english(arguments[1])} '
+            return ' fraction '
+        elif macro == 'sqrt':
+            return f' square root of {latex_node_to_english(arguments[0])} ' if arguments else ' square root '
+        return MACRO_WORDS.get(macro, f' {macro} ')
+
+    if hasattr(node, 'chars'):
+        return node.chars
+
+    return ''
+
+@functools.lru_cache(maxsize=65536)
+def latex_expression_to_english(latex_expr: str) -> str:
+    """
+    Converts the inside of one $...$ expression to plain English. Memoized, formulas repeat heavily across questions.
+    """
+    latex_expr = latex_expr.strip()
+    if CHEMICAL_PATTERN.search(latex_expr):
+        return latex_expr
+
+    try:
+        walker = latexwalker.LatexWalker(latex_expr, latex_context=LATEX_CONTEXT)
+        nodes, _, _ = walker.get_latex_nodes()
+        return ''.join(latex_node_to_english(node) for node in nodes)
+    except Exception:
+        return latex_expr
+
+def open_latex_cache(cache_file: str = LATEX_CACHE_FILE) -> Connection:
+    return open_content_cache(cache_file, LATEX_CACHE_SCHEMA)
+
+def lookup_latex_conversions(cache_db: Connection, expressions: typing.List[str]) -> typing.Dict[str, str]:
+    found = lookup_cached_rows(cache_db, 'latex_conversions', 'latex', ['english'], expressions,
+                               filters={'converter_version': LATEX_CONVERTER_VERSION})
+    return {latex: english for latex, (english,) in found.items()}
+
+def store_latex_conversions(cache_db: Connection, conversions: typing.Dict[str, str]) -> None:
+    now = cache_timestamp()
+    store_cached_rows(cache_db, 'latex_conversions', ['latex', 'converter_version'], [
+        {'latex': latex, 'converter_version': LATEX_CONVERTER_VERSION, 'english': english, 'created_at': now}
+        for latex, english in conversions.items()
+    ])
+
+def convert_latex_docs(docs: typing.List[str], cache_db: Connection) -> typing.Tuple[typing.List[str], typing.Dict[str, int]]:
+    """
+    Converts LaTeX mathematical expressions to plain English in many docs at once.
+    Finds LaTeX delimited by $ or $$ and replaces with English equivalents. Skips chemical notation.
+
+    The unique expressions of all docs are resolved once each: first from the persistent cache,
+    the rest through the memoized converter, whose results are then stored in the persistent cache.
+
+    Returns:
+        (converted docs in input order, {'expressions', 'cache_hits', 'converted'})
+    """
+    expressions = list(dict.fromkeys(
+        match.group(1) or match.group(2) for doc in docs for match in LATEX_PATTERN.finditer(doc)
+    ))
+    conversions = lookup_latex_conversions(cache_db, expressions)
+    new_conversions = {latex: latex_expression_to_english(latex) for latex in expressions if latex not in conversions}
+    if new_conversions:
+        store_latex_conversions(cache_db, new_conversions)
+    conversions.update(new_conversions)
+
+    converted_docs = [LATEX_PATTERN.sub(lambda match: conversions[match.group(1) or match.group(2)], doc) for doc in docs]
+    return converted_docs, {'expressions': len(expressions), 'cache_hits': len(expressions) - len(new_conversions), 'converted': len(new_conversions)}
@@ -3,6 +3,7 @@ import json
 import sqlite3
 from sqlite3 import Connection
 from utility.sync_fetch_data import initialize_and_fetch_db
+from utility.vector_store import decode_vector
 
 def load_question_data() -> pd.DataFrame:
     """
@@ -53,7 +54,6 @@ def pre_process_record(record):
         "options",
         "index_options_that_apply",
         "answers_to_blanks",
-        "question_vector",
         "keywords"
     ]
 
@@ -66,6 +66,10 @@ def pre_process_record(record):
                 # If JSON parsing fails, the field remains a string.
                 pass
     
+    # question_vector is a float32 BLOB (or legacy JSON text), decoded to a numpy array
+    if "question_vector" in record:
+        record["question_vector"] = decode_vector(record["question_vector"])
+
     # Handle numeric fields that might be stored as floats with NaN
     # or need conversion to integers.
     numeric_fields = ["correct_option_index", "completed", "has_media", "has_been_reviewed", "ans_flagged", "flag_for_removal"]
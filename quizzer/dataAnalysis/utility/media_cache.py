@@ -0,0 +1,132 @@
+# media_cache.py
+import sys
+import hashlib
+import typing
+from sqlite3 import Connection
+from PIL import Image
+from utility.sync_fetch_data import initialize_and_fetch_db
+from utility.content_cache import open_content_cache, cache_timestamp, lookup_cached_rows, store_cached_rows
+
+MEDIA_CACHE_FILE = "media_cache.db"
+# Generation settings behind a caption / OCR text, combined with the model variant into the annotator key
+# (see image_annotator), changing models or settings invalidates the cache
+IMAGE_ANNOTATION_SETTINGS = "max_length=50:num_beams=5|tesseract:psm6"
+# image_annotations holds one BLIP caption and OCR text per image content hash and annotator.
+# image_names remembers which stored image file had which content, so entries no
+# question references any more can be evicted.
+MEDIA_CACHE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS image_annotations (
+        content_hash TEXT NOT NULL,
+        annotator TEXT NOT NULL,
+        caption TEXT NOT NULL,
+        ocr_text TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        last_used_at TEXT NOT NULL,
+        hit_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (content_hash, annotator)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS image_names (
+        image_name TEXT NOT NULL PRIMARY KEY,
+        content_hash TEXT NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_image_names_hash ON image_names (content_hash)",
+]
+
+def image_annotator(caption_model_variant: str) -> str:
+    return f"{caption_model_variant}|{IMAGE_ANNOTATION_SETTINGS}"
+
+def open_media_cache(cache_file: str = MEDIA_CACHE_FILE) -> Connection:
+    return open_content_cache(cache_file, MEDIA_CACHE_SCHEMA)
+
+def image_content_hash(img_pil: Image.Image) -> str:
+    """
+    sha256 of the decoded pixels (plus mode and size), identical images share a hash whatever their file name.
+    """
+    digest = hashlib.sha256(f"{img_pil.mode}:{img_pil.size[0]}x{img_pil.size[1]}:".encode('utf-8'))
+    digest.update(img_pil.tobytes())
+    return digest.hexdigest()
+
+def lookup_image_annotations(cache_db: Connection, content_hashes: typing.List[str], annotator: str) -> typing.Dict[str, typing.Tuple[str, str]]:
+    """
+    Returns {content_hash: (caption, ocr_text)} for every hash already annotated, and counts the hits.
+    """
+    return lookup_cached_rows(cache_db, 'image_annotations', 'content_hash', ['caption', 'ocr_text'], content_hashes,
+                              filters={'annotator': annotator}, count_hits=True)
+
+def store_image_annotations(cache_db: Connection, annotations: typing.Dict[str, typing.Tuple[str, str]],
+                            image_names: typing.Dict[str, str], annotator: str) -> None:
+    """
+    Stores freshly computed annotations and the image_name -> content_hash mapping of a chunk.
+
+    Args:
+        annotations: {content_hash: (caption, ocr_text)}
+        image_names: {image_name: content_hash} for every image seen, hits included
+    """
+    now = cache_timestamp()
+    store_cached_rows(cache_db, 'image_annotations', ['content_hash', 'annotator'], [
+        {'content_hash': content_hash, 'annotator': annotator, 'caption': caption, 'ocr_text': ocr_text, 'created_at': now, 'last_used_at': now}
+        for content_hash, (caption, ocr_text) in annotations.items()
+    ])
+    store_cached_rows(cache_db, 'image_names', ['image_name'], [
+        {'image_name': image_name, 'content_hash': content_hash} for image_name, content_hash in image_names.items()
+    ])
+
+def get_referenced_image_names(db: Connection) -> typing.Set[str]:
+    """
+    Every image file name used by a question, answer or option element in question_answer_pairs.
+    """
+    element_columns = ['question_elements', 'answer_elements', 'options']
+    query = ' UNION '.join(f"""
+        SELECT json_extract(element.value, '$.content')
+        FROM question_answer_pairs, json_each(question_answer_pairs.{column}) AS element
+        WHERE json_valid(question_answer_pairs.{column}) AND json_extract(element.value, '$.type') = 'image'
+    """ for column in element_columns)
+    return {row[0] for row in db.execute(query).fetchall() if row[0]}
+
+def evict_orphaned_annotations(cache_db: Connection, referenced_image_names: typing.Set[str]) -> typing.Tuple[int, int]:
+    """
+    Forgets image names no question references any more, then deletes annotations no remaining name points to.
+
+    Returns:
+        (evicted_names, evicted_annotations)
+    """
+    with cache_db:
+        cache_db.execute("DROP TABLE IF EXISTS temp.referenced_image_names")
+        cache_db.execute("CREATE TEMP TABLE referenced_image_names (image_name TEXT PRIMARY KEY)")
+        cache_db.executemany("INSERT INTO temp.referenced_image_names VALUES (?)", ((image_name,) for image_name in referenced_image_names))
+        evicted_names = cache_db.execute("""
+            DELETE FROM image_names WHERE image_name NOT IN (SELECT image_name FROM temp.referenced_image_names)
+        """).rowcount
+        evicted_annotations = cache_db.execute("""
+            DELETE FROM image_annotations WHERE content_hash NOT IN (SELECT content_hash FROM image_names)
+        """).rowcount
+        cache_db.execute("DROP TABLE temp.referenced_image_names")
+    return evicted_names, evicted_annotations
+
+def print_cache_summary(cache_db: Connection) -> None:
+    entries, hits = cache_db.execute("SELECT COUNT(*), COALESCE(SUM(hit_count), 0) FROM image_annotations").fetchone()
+    names = cache_db.execute("SELECT COUNT(*) FROM image_names").fetchone()[0]
+    print(f"Media cache: {entries} annotated images, {names} image names, {hits} lifetime hits")
+
+def main():
+    """
+    python -m utility.media_cache [stats|evict]
+    """
+    command = sys.argv[1] if len(sys.argv) > 1 else "stats"
+    cache_db = open_media_cache()
+    if command == "evict":
+        db = initialize_and_fetch_db()
+        evicted_names, evicted_annotations = evict_orphaned_annotations(cache_db, get_referenced_image_names(db))
+        db.close()
+        print(f"Evicted {evicted_names} orphaned image names and {evicted_annotations} orphaned annotations")
+    elif command != "stats":
+        raise ValueError(f"Unknown command {command}, expected 'stats' or 'evict'")
+    print_cache_summary(cache_db)
+    cache_db.close()
+
+if __name__ == "__main__":
+    main()
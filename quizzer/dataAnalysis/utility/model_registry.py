@@ -0,0 +1,151 @@
+# model_registry.py
+import resource
+import sys
+import threading
+import timeit
+import typing
+import torch
+from PIL import Image
+from transformers import AutoConfig, AutoTokenizer, AutoModel, BlipProcessor, BlipForConditionalGeneration
+
+BLIP_MODEL_NAME = "Salesforce/blip-image-captioning-base"
+SCIBERT_MODEL_NAME = "allenai/scibert_scivocab_uncased"
+# Inference backends for the SciBERT embedding model, 'onnx' runs an exported graph on onnxruntime (see onnx_backend)
+EMBEDDING_BACKENDS = ('torch', 'onnx')
+
+# Process-wide settings, change them with configure_model_registry before the first model is loaded
+MODEL_SETTINGS = {
+    'num_threads': None,      # torch intra-op threads, None keeps torch's default
+    'quantize_int8': False,   # dynamic int8 quantization of Linear layers (CPU only)
+    'embedding_backend': 'torch',  # one of EMBEDDING_BACKENDS
+}
+
+_loaded_models = {}
+_loaded_models_lock = threading.Lock()
+_warmed_up_models = set()
+
+def configure_model_registry(num_threads: typing.Union[int, None] = None, quantize_int8: bool = False,
+                             embedding_backend: str = 'torch') -> None:
+    """
+    Sets the torch thread count, whether models are quantized and which backend runs SciBERT
+    when they are first loaded.
+    """
+    if embedding_backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding_backend {embedding_backend}, expected one of {EMBEDDING_BACKENDS}")
+    if _loaded_models and (quantize_int8 != MODEL_SETTINGS['quantize_int8'] or embedding_backend != MODEL_SETTINGS['embedding_backend']):
+        raise RuntimeError(f"Models {list(_loaded_models)} are already loaded, quantization and backend can no longer change")
+    MODEL_SETTINGS['num_threads'] = num_threads
+    MODEL_SETTINGS['quantize_int8'] = quantize_int8
+    MODEL_SETTINGS['embedding_backend'] = embedding_backend
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+        print(f"torch intra-op threads set to {num_threads}")
+
+def get_model_variant(model_name: str) -> str:
+    """
+    Identifies the exact weights that produce a model's outputs, used to key caches of those outputs.
+    """
+    model_variant = model_name
+    if model_name == SCIBERT_MODEL_NAME and MODEL_SETTINGS['embedding_backend'] != 'torch':
+        model_variant += f":{MODEL_SETTINGS['embedding_backend']}"
+    return f"{model_variant}:int8" if MODEL_SETTINGS['quantize_int8'] else model_variant
+
+def prepare_model(model: torch.nn.Module, quantize_int8: bool) -> torch.nn.Module:
+    model.eval()
+    if quantize_int8:
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+def load_blip():
+    processor = BlipProcessor.from_pretrained(BLIP_MODEL_NAME)
+    model = BlipForConditionalGeneration.from_pretrained(BLIP_MODEL_NAME)
+    return processor, prepare_model(model, MODEL_SETTINGS['quantize_int8'])
+
+def load_scibert(embedding_backend: typing.Union[str, None] = None, quantize_int8: typing.Union[bool, None] = None):
+    """
+    Loads SciBERT for the configured backend (or the given one, used to compare backends side by side).
+    The onnx backend quantizes the exported graph instead of the eager model.
+    """
+    embedding_backend = MODEL_SETTINGS['embedding_backend'] if embedding_backend is None else embedding_backend
+    quantize_int8 = MODEL_SETTINGS['quantize_int8'] if quantize_int8 is None else quantize_int8
+    tokenizer = AutoTokenizer.from_pretrained(SCIBERT_MODEL_NAME)
+    if embedding_backend == 'onnx':
+        # onnxruntime is only needed when the onnx backend is selected, and the eager weights only to export the graph
+        from utility.onnx_backend import load_onnx_encoder
+        def load_eager_model():
+            return prepare_model(AutoModel.from_pretrained(SCIBERT_MODEL_NAME), False)
+        return tokenizer, load_onnx_encoder(SCIBERT_MODEL_NAME, load_eager_model, AutoConfig.from_pretrained(SCIBERT_MODEL_NAME),
+                                            tokenizer, quantize_int8, MODEL_SETTINGS['num_threads'])
+    return tokenizer, prepare_model(AutoModel.from_pretrained(SCIBERT_MODEL_NAME), quantize_int8)
+
+MODEL_LOADERS = {
+    BLIP_MODEL_NAME: load_blip,
+    SCIBERT_MODEL_NAME: load_scibert,
+}
+
+def get_model(model_name: str):
+    """
+    Returns (processor_or_tokenizer, model), loading it on first use only. Every later call in the
+    process, from any thread, gets the same instance.
+    """
+    with _loaded_models_lock:
+        if model_name not in _loaded_models:
+            start = timeit.default_timer()
+            _loaded_models[model_name] = MODEL_LOADERS[model_name]()
+            print(f"Loaded {get_model_variant(model_name)} in {timeit.default_timer() - start:.2f}s")
+        return _loaded_models[model_name]
+
+def get_blip():
+    return get_model(BLIP_MODEL_NAME)
+
+def get_scibert():
+    return get_model(SCIBERT_MODEL_NAME)
+
+def warm_up_models(model_names: typing.List[str]) -> None:
+    """
+    Loads the given models and runs one small inference each, so one-off allocation and kernel
+    selection costs land here instead of in the first timed batch. Models already warmed up are skipped.
+    """
+    for model_name in model_names:
+        if model_name in _warmed_up_models:
+            continue
+        start = timeit.default_timer()
+        processor, model = get_model(model_name)
+        with torch.inference_mode():
+            if model_name == BLIP_MODEL_NAME:
+                inputs = processor(images=[Image.new('RGB', (224, 224), color='white')], return_tensors="pt")
+                model.generate(**inputs, max_length=5)
+            else:
+                model(**processor(["warm up"], return_tensors="pt"))
+        _warmed_up_models.add(model_name)
+        print(f"Warmed up {get_model_variant(model_name)} in {timeit.default_timer() - start:.2f}s")
+
+def model_size_bytes(model) -> int:
+    """
+    Bytes held by a model's weights and buffers, including packed quantized weights.
+    Models on another backend report their own size (an exported graph's file size).
+    """
+    if not isinstance(model, torch.nn.Module):
+        return model.size_bytes()
+    def tensor_bytes(value) -> int:
+        if isinstance(value, torch.Tensor):
+            return value.numel() * value.element_size()
+        if isinstance(value, (tuple, list)):
+            return sum(tensor_bytes(item) for item in value)
+        return 0
+    return sum(tensor_bytes(value) for value in model.state_dict().values())
+
+def report_model_memory() -> typing.Dict[str, int]:
+    """
+    Prints the weight footprint of every loaded model and the process's peak resident memory.
+
+    Returns:
+        {model variant: bytes}
+    """
+    sizes = {get_model_variant(model_name): model_size_bytes(model) for model_name, (_, model) in _loaded_models.items()}
+    for model_variant, size in sizes.items():
+        print(f"  - {model_variant:<45} {size / 1024 ** 2:8.1f} MiB")
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    print(f"  - peak process RSS{'':<29} {peak_rss / 1024 ** 2:8.1f} MiB")
+    return sizes
@@ -0,0 +1,122 @@
+# onnx_backend.py
+import os
+import types
+import typing
+import numpy as np
+import torch
+import onnxruntime
+from onnxruntime.quantization import quantize_dynamic, QuantType
+
+# Exported graphs are regenerated from the Hugging Face weights whenever a file is missing
+ONNX_MODEL_DIR = "onnx_models"
+ONNX_OPSET_VERSION = 14
+
+class LastHiddenState(torch.nn.Module):
+    """
+    Wraps an encoder so the exported graph takes (input_ids, attention_mask) and returns only last_hidden_state.
+    """
+    def __init__(self, model: torch.nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+
+class OnnxEncoder:
+    """
+    Runs an exported encoder on onnxruntime behind the same call signature as the eager model:
+    model(**tokenizer_batch).last_hidden_state, with model.config.hidden_size.
+    """
+    def __init__(self, session: onnxruntime.InferenceSession, config, model_path: str):
+        self.session = session
+        self.config = config
+        self.model_path = model_path
+        self.input_names = [model_input.name for model_input in session.get_inputs()]
+
+    def __call__(self, **inputs):
+        feed = {name: inputs[name].cpu().numpy().astype(np.int64) for name in self.input_names}
+        last_hidden_state = self.session.run(['last_hidden_state'], feed)[0]
+        return types.SimpleNamespace(last_hidden_state=torch.from_numpy(last_hidden_state))
+
+    def size_bytes(self) -> int:
+        return os.path.getsize(self.model_path)
+
+def onnx_model_path(model_name: str, quantize_int8: bool) -> str:
+    file_name = model_name.replace('/', '__') + ('.int8' if quantize_int8 else '') + '.onnx'
+    return os.path.join(ONNX_MODEL_DIR, file_name)
+
+def export_onnx_model(model: torch.nn.Module, tokenizer, model_path: str) -> None:
+    """
+    Exports an eager encoder to ONNX with dynamic batch and sequence axes.
+    Written to a temporary file first, so an interrupted export never leaves a truncated graph behind.
+    """
+    os.makedirs(os.path.dirname(model_path), exist_ok=True)
+    sample = tokenizer(["export sample"], return_tensors="pt")
+    temp_path = f"{model_path}.{os.getpid()}.tmp"
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in ['input_ids', 'attention_mask', 'last_hidden_state']}
+    # no_grad rather than inference_mode, tracing inference tensors breaks torch.onnx.export
+    with torch.no_grad():
+        torch.onnx.export(
+            LastHiddenState(model).eval(),
+            (sample['input_ids'], sample['attention_mask']),
+            temp_path,
+            input_names=['input_ids', 'attention_mask'],
+            output_names=['last_hidden_state'],
+            dynamic_axes=dynamic_axes,
+            opset_version=ONNX_OPSET_VERSION,
+            do_constant_folding=True,
+            # The TorchScript exporter, dynamic_axes is its API (newer torch defaults to the dynamo exporter)
+            dynamo=False
+        )
+    os.replace(temp_path, model_path)
+    print(f"Exported {model_path} ({os.path.getsize(model_path) / 1024 ** 2:.1f} MiB)")
+
+def quantize_onnx_model(source_path: str, model_path: str) -> None:
+    """
+    Dynamic int8 quantization of an exported graph's weights (activations stay float, quantized per batch).
+    """
+    temp_path = f"{model_path}.{os.getpid()}.tmp"
+    quantize_dynamic(source_path, temp_path, weight_type=QuantType.QInt8)
+    os.replace(temp_path, model_path)
+    print(f"Quantized {model_path} ({os.path.getsize(model_path) / 1024 ** 2:.1f} MiB)")
+
+def create_inference_session(model_path: str, num_threads: typing.Union[int, None]) -> onnxruntime.InferenceSession:
+    """
+    CPU session with every graph optimization enabled (constant folding, node fusion such as attention and GELU).
+    """
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if num_threads is not None:
+        options.intra_op_num_threads = num_threads
+    return onnxruntime.InferenceSession(model_path, sess_options=options, providers=['CPUExecutionProvider'])
+
+def load_onnx_encoder(model_name: str, load_model: typing.Callable[[], torch.nn.Module], config, tokenizer,
+                      quantize_int8: bool, num_threads: typing.Union[int, None]) -> OnnxEncoder:
+    """
+    Returns an OnnxEncoder for an encoder, exporting (and quantizing) it on first use only.
+    load_model is only called when the graph has to be exported, runs on an existing export never load the eager weights.
+    """
+    float_path = onnx_model_path(model_name, False)
+    model_path = onnx_model_path(model_name, quantize_int8)
+    if not os.path.exists(model_path) and not os.path.exists(float_path):
+        export_onnx_model(load_model(), tokenizer, float_path)
+    if not os.path.exists(model_path):
+        quantize_onnx_model(float_path, model_path)
+    return OnnxEncoder(create_inference_session(model_path, num_threads), config, model_path)
+
+def embedding_cosine_similarity(reference: np.ndarray, candidate: np.ndarray) -> np.ndarray:
+    """
+    Row-wise cosine similarity between two (n, dims) embedding matrices.
+    """
+    norms = np.linalg.norm(reference, axis=1) * np.linalg.norm(candidate, axis=1)
+    return np.sum(reference * candidate, axis=1) / np.maximum(norms, 1e-12)
+
+def check_embedding_parity(reference: np.ndarray, candidate: np.ndarray, threshold: float = 0.999) -> typing.Dict[str, float]:
+    """
+    Compares a backend's embeddings against the eager model's for the same docs.
+
+    Returns:
+        {'min_cosine', 'mean_cosine', 'passed'}
+    """
+    cosine = embedding_cosine_similarity(reference, candidate)
+    return {'min_cosine': float(cosine.min()), 'mean_cosine': float(cosine.mean()), 'passed': bool(cosine.min() >= threshold)}
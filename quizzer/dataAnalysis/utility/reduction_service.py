@@ -0,0 +1,92 @@
+# reduction_service.py
+import datetime
+import timeit
+import typing
+import umap
+import numpy as np
+from sklearn.neighbors import NearestNeighbors
+
+# The UMAP that reduces 768-dim SciBERT vectors for HDBSCAN and KNN, fitted as part of the topic model
+UMAP_SETTINGS = {
+    'n_neighbors': 25,
+    'n_components': 25,
+    'min_dist': 0.01,
+    'spread': 0.5,
+    'random_state': 0,
+    'metric': 'manhattan',
+}
+# Scheduled full refit, between refits new and changed questions are projected into the fitted space
+REDUCER_REFIT_INTERVAL_DAYS = 7
+# Points sampled when comparing neighbourhoods between projected coordinates and a full refit
+OVERLAP_SAMPLE_SIZE = 2000
+
+def build_umap_model() -> umap.UMAP:
+    return umap.UMAP(**UMAP_SETTINGS)
+
+def project_embeddings(umap_model: umap.UMAP, embeddings: np.ndarray) -> typing.Tuple[np.ndarray, float]:
+    """
+    Projects new SciBERT vectors into a fitted UMAP space without refitting.
+
+    Returns:
+        (reduced embeddings, seconds per projected question)
+    """
+    if not len(embeddings):
+        return np.zeros((0, umap_model.n_components), dtype=np.float32), 0.0
+    start = timeit.default_timer()
+    reduced = np.asarray(umap_model.transform(embeddings), dtype=np.float32)
+    return reduced, (timeit.default_timer() - start) / len(embeddings)
+
+def reducer_refit_due(fitted_at: str, interval_days: float = REDUCER_REFIT_INTERVAL_DAYS) -> typing.Tuple[bool, str]:
+    """
+    Whether the fitted UMAP is older than the refit schedule allows.
+    """
+    age = datetime.datetime.now(datetime.timezone.utc) - datetime.datetime.fromisoformat(fitted_at)
+    age_days = age.total_seconds() / 86400
+    return age_days > interval_days, f"UMAP fitted {age_days:.1f} days ago (refit every {interval_days} days)"
+
+def neighbor_overlap(reference: np.ndarray, candidate: np.ndarray, query_rows: np.ndarray,
+                     k: int = 25, metric: str = UMAP_SETTINGS['metric']) -> np.ndarray:
+    """
+    For every query row, the fraction of its k nearest neighbours (self excluded) shared
+    between two coordinate sets of the same points.
+    """
+    neighbor_sets = []
+    for coordinates in (reference, candidate):
+        knn = NearestNeighbors(n_neighbors=min(k + 1, len(coordinates)), metric=metric).fit(coordinates)
+        _, indices = knn.kneighbors(coordinates[query_rows])
+        neighbor_sets.append([set(row) - {query_row} for row, query_row in zip(indices.tolist(), query_rows)])
+    return np.array([len(before & after) / max(len(after), 1) for before, after in zip(*neighbor_sets)])
+
+def measure_projection_drift(previous_state: typing.Dict[str, typing.Any], question_ids: typing.List[str],
+                             refit_reduced: np.ndarray, k: int = 25, sample_size: int = OVERLAP_SAMPLE_SIZE,
+                             seed: int = 0) -> typing.Dict[str, float]:
+    """
+    Compares the coordinates every question had before a full refit (fitted or projected) with the
+    refit's, as the mean k-NN overlap over a sample of questions. Projected questions are reported
+    separately, their overlap shows how far transform drifted from what a refit gives.
+
+    Returns:
+        {'overall_overlap', 'projected_overlap', 'projected_questions', 'sampled'}
+    """
+    previous_rows = {question_id: row for row, question_id in enumerate(previous_state['question_ids'])}
+    shared = np.array([index for index, question_id in enumerate(question_ids) if question_id in previous_rows], dtype=np.int64)
+    if len(shared) <= k:
+        return {'overall_overlap': float('nan'), 'projected_overlap': float('nan'), 'projected_questions': 0, 'sampled': 0}
+
+    shared_rows = np.array([previous_rows[question_ids[index]] for index in shared])
+    before = previous_state['reduced_embeddings'][shared_rows]
+    after = refit_reduced[shared]
+    projected = previous_state['projected'][shared_rows]
+
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(shared), min(sample_size, len(shared)), replace=False)
+    projected_rows = np.flatnonzero(projected)
+    projected_sample = rng.choice(projected_rows, min(sample_size, len(projected_rows)), replace=False)
+    query_rows = np.union1d(sample, projected_sample)
+    overlap = dict(zip(query_rows.tolist(), neighbor_overlap(before, after, query_rows, k)))
+    return {
+        'overall_overlap': float(np.mean([overlap[row] for row in sample])),
+        'projected_overlap': float(np.mean([overlap[row] for row in projected_sample])) if len(projected_sample) else float('nan'),
+        'projected_questions': int(len(projected_rows)),
+        'sampled': int(len(query_rows)),
+    }
@@ -0,0 +1,146 @@
+# text_features.py
+import re
+import json
+import signal
+import threading
+import contextlib
+import functools
+import typing
+import yake
+from sqlite3 import Connection
+from concurrent.futures import Executor
+from latex2sympy2 import latex2sympy
+from utility.content_cache import open_content_cache, content_hash, cache_timestamp, lookup_cached_rows, store_cached_rows
+
+FEATURE_CACHE_FILE = "feature_cache.db"
+# Bump whenever the settings below change, older cached features are then ignored
+FEATURE_EXTRACTOR_VERSION = "yake:en:n=3:dedup=0.9:top=10|latex2sympy"
+# One is_math flag and keyword list per hash of (extractor version, text)
+FEATURE_CACHE_SCHEMA = ["""
+    CREATE TABLE IF NOT EXISTS text_features (
+        text_hash TEXT NOT NULL PRIMARY KEY,
+        is_math INTEGER NOT NULL,
+        keywords TEXT NOT NULL,
+        timed_out INTEGER NOT NULL,
+        created_at TEXT NOT NULL
+    )
+"""]
+
+INLINE_LATEX_PATTERN = re.compile(r'\$(.+?)\$')
+# manually exclude keywords that are not related to subject matter or concept matter
+EXCLUDED_KEYWORDS = {"lowest to highest", "highest to lowest", "correct order", "identify terms", "describes the solution",
+                     "find the missing", "directly", "Find", "find", "select", "Select"}
+
+@functools.lru_cache(maxsize=None)
+def get_keyword_extractor() -> yake.KeywordExtractor:
+    """
+    One YAKE extractor per process, building it loads stopword lists every time.
+    """
+    return yake.KeywordExtractor(lan="en", n=3, dedupLim=0.9, top=10)
+
+def extract_keywords(sentence: str) -> typing.List[str]:
+    """
+    Extract keywords using YAKE library
+    """
+    if not sentence or not isinstance(sentence, str):
+        return []
+    # Return just the keyword strings (YAKE returns tuples with scores)
+    return [keyword for keyword, score in get_keyword_extractor().extract_keywords(sentence) if keyword not in EXCLUDED_KEYWORDS]
+
+def raise_parse_timeout(signum, frame):
+    raise TimeoutError("latex2sympy parse exceeded its time limit")
+
+@contextlib.contextmanager
+def parse_time_limit(seconds: typing.Union[float, None]):
+    """
+    Interrupts the wrapped block with TimeoutError after seconds (SIGALRM, Unix main thread only).
+    Elsewhere, or with seconds None, the block runs without a limit.
+    """
+    if seconds is None or not hasattr(signal, 'setitimer') or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+    previous_handler = signal.signal(signal.SIGALRM, raise_parse_timeout)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+def detect_is_math(sentence: str, parse_timeout: typing.Union[float, None] = None) -> typing.Tuple[bool, int]:
+    """
+    A sentence is math when one of its $...$ expressions parses with latex2sympy.
+    Each parse gets at most parse_timeout seconds, an expression that runs out counts as not parsing.
+
+    Returns:
+        (is_math, timed_out_expressions)
+    """
+    if not sentence or not isinstance(sentence, str):
+        return False, 0
+
+    timed_out = 0
+    for latex_expr in INLINE_LATEX_PATTERN.findall(sentence):
+        try:
+            with parse_time_limit(parse_timeout):
+                latex2sympy(latex_expr.strip())
+            return True, timed_out
+        except TimeoutError:
+            timed_out += 1
+        except Exception:
+            continue
+    return False, timed_out
+
+def extract_features_for_text(text: str, parse_timeout: typing.Union[float, None]) -> typing.Tuple[bool, typing.List[str], int]:
+    """
+    Process pool task, returns (is_math, keywords, timed_out_expressions) for one text.
+    """
+    is_math, timed_out = detect_is_math(text, parse_timeout)
+    return is_math, extract_keywords(text), timed_out
+
+def open_feature_cache(cache_file: str = FEATURE_CACHE_FILE) -> Connection:
+    return open_content_cache(cache_file, FEATURE_CACHE_SCHEMA)
+
+def text_feature_hash(text: str) -> str:
+    return content_hash(FEATURE_EXTRACTOR_VERSION, text)
+
+def lookup_text_features(cache_db: Connection, text_hashes: typing.List[str]) -> typing.Dict[str, typing.Tuple[bool, typing.List[str]]]:
+    found = lookup_cached_rows(cache_db, 'text_features', 'text_hash', ['is_math', 'keywords'], text_hashes)
+    return {text_hash: (bool(is_math), json.loads(keywords)) for text_hash, (is_math, keywords) in found.items()}
+
+def store_text_features(cache_db: Connection, features: typing.Dict[str, typing.Tuple[bool, typing.List[str], int]]) -> None:
+    now = cache_timestamp()
+    store_cached_rows(cache_db, 'text_features', ['text_hash'], [
+        {'text_hash': text_hash, 'is_math': int(is_math), 'keywords': json.dumps(keywords), 'timed_out': timed_out, 'created_at': now}
+        for text_hash, (is_math, keywords, timed_out) in features.items()
+    ])
+
+def extract_text_features(texts: typing.List[str], cache_db: Connection, pool: Executor,
+                          parse_timeout: typing.Union[float, None] = 2.0) -> typing.Tuple[typing.List[typing.Tuple[bool, typing.List[str]]], typing.Dict[str, int]]:
+    """
+    Computes (is_math, keywords) for many texts at once.
+
+    Identical texts are extracted once, texts already in the feature cache are not extracted at all,
+    the rest are spread over the pool (every worker reuses its own YAKE extractor) and cached.
+
+    Returns:
+        (features in input order, {'texts', 'cache_hits', 'extracted', 'timeouts'})
+    """
+    text_hashes = [text_feature_hash(text) for text in texts]
+    features = lookup_text_features(cache_db, list(set(text_hashes)))
+    missing = {}
+    for text_hash, text in zip(text_hashes, texts):
+        if text_hash not in features:
+            missing.setdefault(text_hash, text)
+
+    extract = functools.partial(extract_features_for_text, parse_timeout=parse_timeout)
+    new_features = dict(zip(missing.keys(), pool.map(extract, missing.values(), chunksize=8)))
+    if new_features:
+        store_text_features(cache_db, new_features)
+    features.update((text_hash, (is_math, keywords)) for text_hash, (is_math, keywords, _) in new_features.items())
+
+    return [features[text_hash] for text_hash in text_hashes], {
+        'texts': len(texts),
+        'cache_hits': sum(text_hash not in missing for text_hash in text_hashes),
+        'extracted': len(new_features),
+        'timeouts': sum(timed_out for _, _, timed_out in new_features.values())
+    }
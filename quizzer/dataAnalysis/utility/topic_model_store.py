@@ -0,0 +1,156 @@
+# topic_model_store.py
+import io
+import os
+import hashlib
+import datetime
+import typing
+import numpy as np
+from pathlib import Path
+from bertopic import BERTopic
+from bertopic.dimensionality import BaseDimensionalityReduction
+from utility.sync_fetch_data import write_bytes_atomically
+from utility.reduction_service import project_embeddings, reducer_refit_due
+
+# The fitted BERTopic model (pickled with its UMAP and HDBSCAN models, so transform works after loading)
+# and the per-question state of the last fit or update
+TOPIC_MODEL_DIR = Path("topic_model")
+TOPIC_MODEL_FILE = TOPIC_MODEL_DIR / "bertopic.pickle"
+TOPIC_MODEL_STATE_FILE = TOPIC_MODEL_DIR / "state.npz"
+
+# Drift thresholds, crossing either one triggers a full refit instead of an incremental transform
+MAX_CHANGED_DOC_FRACTION = 0.10    # new + changed + removed docs since the last full fit, relative to the docs it was fit on
+MAX_OUTLIER_RATE_INCREASE = 0.10   # outlier rate of the transformed docs above the outlier rate at fit time
+
+def doc_hash(doc: str) -> str:
+    return hashlib.sha256(doc.encode('utf-8')).hexdigest()
+
+def outlier_rate(topics) -> float:
+    topics = np.asarray(topics)
+    return float(np.mean(topics == -1)) if len(topics) else 0.0
+
+# Describe the last full fit, carried over unchanged by incremental updates (changed_since_fit adds up
+# the docs every incremental update transformed or removed)
+FIT_INFO_KEYS = ['fit_doc_count', 'fit_outlier_rate', 'fit_seconds', 'fitted_at', 'changed_since_fit']
+
+def new_fit_info(topics, fit_seconds: float) -> typing.Dict[str, typing.Any]:
+    return {
+        'fit_doc_count': len(topics),
+        'fit_outlier_rate': outlier_rate(topics),
+        'fit_seconds': fit_seconds,
+        'fitted_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'changed_since_fit': 0,
+    }
+
+def build_topic_model_state(question_ids: typing.List[str], docs: typing.List[str], embeddings: np.ndarray,
+                            reduced_embeddings: np.ndarray, topics, fit_info: typing.Dict[str, typing.Any],
+                            projected: typing.Union[np.ndarray, None] = None) -> typing.Dict[str, typing.Any]:
+    """
+    Everything remembered per question between runs, rows aligned with question_ids.
+    projected marks questions whose reduced embedding came from UMAP transform rather than the fit.
+    """
+    return {
+        'question_ids': np.asarray(question_ids, dtype=str),
+        'doc_hashes': np.asarray([doc_hash(doc) for doc in docs], dtype=str),
+        'embeddings': np.asarray(embeddings, dtype=np.float32),
+        'reduced_embeddings': np.asarray(reduced_embeddings, dtype=np.float32),
+        'topics': np.asarray(topics, dtype=np.int32),
+        'projected': np.zeros(len(question_ids), dtype=bool) if projected is None else np.asarray(projected, dtype=bool),
+        **{key: fit_info[key] for key in FIT_INFO_KEYS},
+        'updated_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+
+def save_topic_model_snapshot(topic_model: typing.Union[BERTopic, None], state: typing.Dict[str, typing.Any]) -> None:
+    """
+    Persists the state and, when given, the fitted model (without its embedding model, which is passed
+    back in on load). Both files are replaced atomically, a crash never leaves half a snapshot behind.
+    """
+    TOPIC_MODEL_DIR.mkdir(exist_ok=True)
+    if topic_model is not None:
+        temp_file = TOPIC_MODEL_FILE.with_suffix(f".{os.getpid()}.tmp")
+        topic_model.save(str(temp_file), serialization="pickle", save_embedding_model=False)
+        os.replace(temp_file, TOPIC_MODEL_FILE)
+    buffer = io.BytesIO()
+    np.savez(buffer, **state)
+    write_bytes_atomically(str(TOPIC_MODEL_STATE_FILE), buffer.getvalue())
+
+def load_topic_model_snapshot(embedding_model) -> typing.Tuple[typing.Union[BERTopic, None], typing.Union[typing.Dict[str, typing.Any], None]]:
+    """
+    Returns (topic_model, state) of the last run, or (None, None) when nothing (or an older state layout) was saved.
+    """
+    if not TOPIC_MODEL_FILE.exists() or not TOPIC_MODEL_STATE_FILE.exists():
+        return None, None
+    with np.load(TOPIC_MODEL_STATE_FILE) as saved:
+        state = {key: saved[key] if saved[key].ndim else saved[key].item() for key in saved.files}
+    if not set(FIT_INFO_KEYS + ['projected']) <= set(state):
+        return None, None
+    topic_model = BERTopic.load(str(TOPIC_MODEL_FILE), embedding_model=embedding_model)
+    return topic_model, state
+
+def plan_topic_model_update(state: typing.Union[typing.Dict[str, typing.Any], None], question_ids: typing.List[str],
+                            docs: typing.List[str], max_changed_fraction: float = MAX_CHANGED_DOC_FRACTION) -> typing.Dict[str, typing.Any]:
+    """
+    Compares the current docs against the saved state, and checks the UMAP refit schedule.
+
+    Returns:
+        {'refit': bool, 'reason': str, 'changed': indices into question_ids of new or changed docs, 'removed': int}
+    """
+    if state is None:
+        return {'refit': True, 'reason': "no saved topic model", 'changed': np.arange(len(question_ids)), 'removed': 0}
+
+    saved_hashes = dict(zip(state['question_ids'], state['doc_hashes']))
+    changed = np.array([index for index, (question_id, doc) in enumerate(zip(question_ids, docs))
+                        if saved_hashes.get(question_id) != doc_hash(doc)], dtype=np.int64)
+    removed = len(set(saved_hashes) - set(question_ids))
+    changed_fraction = (state['changed_since_fit'] + len(changed) + removed) / max(state['fit_doc_count'], 1)
+    refit_due, schedule_reason = reducer_refit_due(state['fitted_at'])
+    return {'refit': changed_fraction > max_changed_fraction or refit_due,
+            'reason': f"{changed_fraction:.1%} of docs new, changed or removed since the last fit, {schedule_reason}",
+            'changed': changed, 'removed': removed}
+
+def update_topic_model_incrementally(topic_model: BERTopic, state: typing.Dict[str, typing.Any], plan: typing.Dict[str, typing.Any],
+                                     question_ids: typing.List[str], docs: typing.List[str], embeddings: np.ndarray,
+                                     max_outlier_rate_increase: float = MAX_OUTLIER_RATE_INCREASE) -> typing.Tuple[typing.Union[typing.Dict[str, typing.Any], None], typing.Dict[str, typing.Any]]:
+    """
+    Assigns new and changed docs with the saved model's transform and carries every other
+    question's topic and reduced embedding over from the saved state. Removed questions are dropped.
+    The changed docs' SciBERT vectors are projected into the fitted UMAP space once (see reduction_service),
+    the projection is both stored and what the topics are assigned from.
+
+    Returns:
+        (new state, report), state is None when the transformed docs' outlier rate drifted past the threshold,
+        report is {'reason', 'projected', 'seconds_per_question'}
+    """
+    changed = plan['changed']
+    saved_rows = {question_id: row for row, question_id in enumerate(state['question_ids'])}
+    topics = np.full(len(question_ids), -1, dtype=np.int32)
+    projected = np.zeros(len(question_ids), dtype=bool)
+    reduced_embeddings = np.zeros((len(question_ids), state['reduced_embeddings'].shape[1]), dtype=np.float32)
+    unchanged = np.setdiff1d(np.arange(len(question_ids)), changed)
+    unchanged_rows = [saved_rows[question_ids[index]] for index in unchanged]
+    topics[unchanged] = state['topics'][unchanged_rows]
+    reduced_embeddings[unchanged] = state['reduced_embeddings'][unchanged_rows]
+    projected[unchanged] = state['projected'][unchanged_rows]
+    seconds_per_question = 0.0
+
+    if len(changed):
+        changed_docs = [docs[index] for index in changed]
+        reduced_embeddings[changed], seconds_per_question = project_embeddings(topic_model.umap_model, embeddings[changed])
+        projected[changed] = True
+        # A pass-through reducer for the duration of transform, so it clusters the projection above instead of running UMAP again
+        umap_model, topic_model.umap_model = topic_model.umap_model, BaseDimensionalityReduction()
+        try:
+            changed_topics, _ = topic_model.transform(changed_docs, reduced_embeddings[changed])
+        finally:
+            topic_model.umap_model = umap_model
+        topics[changed] = changed_topics
+
+        changed_outlier_rate = outlier_rate(changed_topics)
+        if changed_outlier_rate > state['fit_outlier_rate'] + max_outlier_rate_increase:
+            return None, {'reason': f"outlier rate of {len(changed)} transformed docs is {changed_outlier_rate:.1%}, "
+                                    f"{state['fit_outlier_rate']:.1%} at fit time",
+                          'projected': len(changed), 'seconds_per_question': seconds_per_question}
+
+    fit_info = dict({key: state[key] for key in FIT_INFO_KEYS}, changed_since_fit=state['changed_since_fit'] + len(changed) + plan['removed'])
+    new_state = build_topic_model_state(question_ids, docs, embeddings, reduced_embeddings, topics, fit_info, projected)
+    return new_state, {'reason': f"transformed {len(changed)} docs, outlier rate {outlier_rate(topics):.1%}",
+                       'projected': len(changed), 'seconds_per_question': seconds_per_question}
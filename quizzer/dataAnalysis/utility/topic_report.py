@@ -0,0 +1,76 @@
+# topic_report.py
+import timeit
+import typing
+import multiprocessing
+import numpy as np
+from pathlib import Path
+from bertopic import BERTopic
+from utility.topic_model_store import TOPIC_MODEL_FILE
+
+TOPIC_REPORT_DIR = Path("bertopic_visualizations")
+# Document plots show at most this many docs per topic, so HTML size and render time stay bounded
+MAX_DOCS_PER_TOPIC = 100
+
+def stratified_sample_indices(topics, max_docs_per_topic: int, seed: int = 0) -> np.ndarray:
+    """
+    Picks at most max_docs_per_topic docs of every topic (outliers included) at random.
+    Topics smaller than that keep all their docs. Returns sorted indices into topics.
+    """
+    topics = np.asarray(topics)
+    rng = np.random.default_rng(seed)
+    sampled = [
+        indices if len(indices) <= max_docs_per_topic else rng.choice(indices, max_docs_per_topic, replace=False)
+        for indices in (np.flatnonzero(topics == topic) for topic in np.unique(topics))
+    ]
+    return np.sort(np.concatenate(sampled)) if sampled else np.array([], dtype=np.int64)
+
+def render_topic_report(model_file: str, docs: typing.List[str], embeddings: np.ndarray, topics,
+                        max_docs_per_topic: int = MAX_DOCS_PER_TOPIC, output_dir: str = str(TOPIC_REPORT_DIR)) -> None:
+    """
+    Writes topic_info.csv and every BERTopic HTML visualization from a saved model snapshot.
+
+    topics assigns every doc (the snapshot's own topics_ only covers the docs it was fit on).
+    hierarchical_topics is computed once over all docs and shared by the hierarchy plots.
+    Document plots only show a stratified sample of at most max_docs_per_topic docs per topic.
+    """
+    start = timeit.default_timer()
+    vis_dir = Path(output_dir)
+    vis_dir.mkdir(exist_ok=True)
+    # The snapshot was saved without its embedding model, the plots only need the stored embeddings
+    topic_model = BERTopic.load(model_file)
+    topic_model.topics_ = [int(topic) for topic in topics]
+
+    # Get topic info
+    topic_model.get_topic_info().to_csv(vis_dir / "topic_info.csv", index=False)
+
+    # Generate and save all BERTopic visualizations
+    topic_model.visualize_topics().write_html(str(vis_dir / "topics.html"))
+    topic_model.visualize_barchart(top_n_topics=50).write_html(str(vis_dir / "barchart.html"))
+    topic_model.visualize_heatmap().write_html(str(vis_dir / "heatmap.html"))
+    # topic_model.visualize_term_rank().write_html(str(vis_dir / "term_rank.html"))
+    hierarchical_topics = topic_model.hierarchical_topics(docs)
+    topic_model.visualize_hierarchy(hierarchical_topics=hierarchical_topics).write_html(str(vis_dir / "hierarchy.html"))
+
+    sample = stratified_sample_indices(topics, max_docs_per_topic)
+    sample_docs = [docs[index] for index in sample]
+    topic_model.topics_ = [int(topics[index]) for index in sample]
+    topic_model.visualize_documents(sample_docs, embeddings=embeddings[sample], hide_annotations=True).write_html(str(vis_dir / "documents.html"))
+    topic_model.visualize_hierarchical_documents(sample_docs, hierarchical_topics=hierarchical_topics,
+                                                 embeddings=embeddings[sample]).write_html(str(vis_dir / "hierarchical_documents.html"))
+
+    print(f"Visualizations saved to {vis_dir} in {timeit.default_timer() - start:.2f}s "
+          f"(document plots show {len(sample)}/{len(docs)} docs)")
+
+def start_topic_report(docs: typing.List[str], embeddings: np.ndarray, topics,
+                       max_docs_per_topic: int = MAX_DOCS_PER_TOPIC) -> multiprocessing.Process:
+    """
+    Renders the topic report in a background process from the saved snapshot, so nothing waits on it.
+    join() the returned process before exiting.
+    """
+    process = multiprocessing.get_context('spawn').Process(
+        target=render_topic_report,
+        args=(str(TOPIC_MODEL_FILE), docs, embeddings, np.asarray(topics), max_docs_per_topic),
+        name="topic-report"
+    )
+    process.start()
+    return process
@@ -5,11 +5,16 @@ import numpy as np
 import time
 from PIL import Image
 import torch
-from utility.data_utils import load_image, text_to_image, combine_images_vertically, get_is_math, get_keywords
-from transformers import AutoTokenizer, AutoModel
+from utility.data_utils import load_image, text_to_image, combine_images_vertically
+from utility.model_registry import SCIBERT_MODEL_NAME, get_scibert, get_model_variant, warm_up_models
+from utility.embedding_cache import open_embedding_cache, embedding_cache_key, lookup_embeddings, store_embeddings
 import pytesseract
 import torch.nn.functional as F
-from utility.sync_fetch_data import get_empty_vector_record, upsert_question_record, initialize_and_fetch_db
+from utility.sync_fetch_data import get_empty_vector_records, save_question_vectors, get_empty_feature_records, save_question_features, initialize_and_fetch_db
+from utility.text_features import open_feature_cache, extract_text_features
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from utility.load_question_data import pre_process_record
 
 
@@ -79,72 +84,290 @@ def simplify_question_record(record: Dict[str, Any]) -> Dict[str, Any]:
     }
 
 
-def vectorize_records() -> None:
+# How docs longer than one SciBERT window are embedded: 'truncate' keeps only the first window,
+# 'mean' averages the [CLS] vectors of overlapping windows, 'length_weighted' weights each window's
+# [CLS] vector by its token count (a plain count, not learned attention, so a short tail window counts less)
+LONG_DOC_MODES = ('truncate', 'mean', 'length_weighted')
+TOKEN_LENGTH_BINS = [0, 64, 128, 256, 512, 1024, 2048, 4096]
+
+def split_into_windows(token_ids: List[int], window_size: int, overlap: int, long_doc_mode: str) -> List[List[int]]:
+    """
+    Cuts a doc's token ids (without special tokens) into windows of at most window_size tokens,
+    consecutive windows sharing overlap tokens. Docs that fit in one window are returned as is.
+    Raises ValueError unless 0 <= overlap < window_size, otherwise the windows would never advance.
+    """
+    if not 0 <= overlap < window_size:
+        raise ValueError(f"window overlap must satisfy 0 <= overlap < window_size ({window_size}), got {overlap}")
+    if len(token_ids) <= window_size:
+        return [token_ids]
+    if long_doc_mode == 'truncate':
+        return [token_ids[:window_size]]
+    step = window_size - overlap
+    return [token_ids[start:start + window_size] for start in range(0, len(token_ids) - overlap, step)]
+
+def embed_docs(tokenizer, model, docs: List[str], batch_size: int, max_length: int = 512,
+               long_doc_mode: str = 'truncate', window_overlap: int = 128) -> Dict[str, Any]:
+    """
+    Embeds docs with SciBERT ([CLS] token of the last hidden state) using length-bucketed batches.
+    
+    All docs are tokenized once without truncation and split into windows of max_length tokens
+    (special tokens included, see split_into_windows). The windows of all docs are sorted by length
+    and cut into batches of similar length, each padded only to its own longest sequence, so long
+    docs are embedded in the same batched pass as short ones. Each doc's window vectors are then
+    pooled according to long_doc_mode. Docs that fit in one window take their [CLS] vector directly.
+    Output rows are in input order.
+    
+    Returns:
+        {'embeddings': (len(docs), hidden) float32 array, 'tokens': real tokens, 'padded_tokens': tokens incl. padding,
+         'doc_lengths': untruncated token count per doc, 'long_docs': docs longer than one window,
+         'windows': windows embedded}
+    """
+    if long_doc_mode not in LONG_DOC_MODES:
+        raise ValueError(f"Unknown long_doc_mode {long_doc_mode}, expected one of {LONG_DOC_MODES}")
+    
+    content_ids = tokenizer(docs, add_special_tokens=False, verbose=False)['input_ids']
+    window_size = max_length - tokenizer.num_special_tokens_to_add(pair=False)
+    windows = []
+    window_docs = []
+    for doc_index, token_ids in enumerate(content_ids):
+        for window in split_into_windows(token_ids, window_size, window_overlap, long_doc_mode):
+            windows.append(tokenizer.build_inputs_with_special_tokens(window))
+            window_docs.append(doc_index)
+    window_docs = np.array(window_docs)
+    lengths = np.array([len(input_ids) for input_ids in windows])
+    order = np.argsort(lengths, kind='stable')
+    
+    # Per-window pooling weights, normalized so each doc's weights sum to 1
+    if long_doc_mode == 'length_weighted':
+        weights = lengths.astype(np.float32)
+    else:
+        weights = np.ones(len(windows), dtype=np.float32)
+    weights /= np.bincount(window_docs, weights=weights, minlength=len(docs))[window_docs]
+    
+    embeddings = np.zeros((len(docs), model.config.hidden_size), dtype=np.float32)
+    padded_tokens = 0
+    for i in range(0, len(order), batch_size):
+        batch_indices = order[i:i + batch_size]
+        batch = tokenizer.pad(
+            {'input_ids': [windows[index] for index in batch_indices]},
+            return_tensors="pt"
+        )
+        padded_tokens += batch['input_ids'].numel()
+        with torch.inference_mode():
+            outputs = model(**batch)
+        # Use [CLS] token embedding as the window representation
+        cls_vectors = outputs.last_hidden_state[:, 0, :].float().cpu().numpy()
+        np.add.at(embeddings, window_docs[batch_indices], cls_vectors * weights[batch_indices, None])
+    
+    return {
+        'embeddings': embeddings,
+        'tokens': int(lengths.sum()),
+        'padded_tokens': padded_tokens,
+        'doc_lengths': [len(token_ids) for token_ids in content_ids],
+        'long_docs': sum(len(token_ids) > window_size for token_ids in content_ids),
+        'windows': len(windows)
+    }
+
+def print_token_length_histogram(doc_lengths: List[int]) -> None:
+    """
+    Prints how many embedded docs fall into each token length bin.
+    """
+    if not doc_lengths:
+        return
+    edges = TOKEN_LENGTH_BINS + [max(max(doc_lengths), TOKEN_LENGTH_BINS[-1]) + 1]
+    counts, _ = np.histogram(doc_lengths, bins=edges)
+    print(f"  - Doc token lengths (median {int(np.median(doc_lengths))}, max {max(doc_lengths)}):")
+    for low, high, count in zip(edges[:-1], edges[1:], counts):
+        print(f"      {low:>5}-{high - 1:<6} {count:>7} {'#' * int(np.ceil(50 * count / len(doc_lengths)))}")
+
+def vectorize_records(chunk_size: int = 1024, batch_size: int = 32, long_doc_mode: str = 'truncate',
+                      window_overlap: int = 128) -> Dict[str, float]:
     """
     Vectorizes question records from database using SciBERT.
     
     Retrieves pre-computed 'doc' field from database and generates embeddings.
     The 'doc' field should already contain question text + answer text + OCR text + image captions.
     
-    Fetches records from DB, processes them, and saves back to DB until complete.
+    Records needing a vector are read chunk_size at a time and embedded batch_size sequences
+    per forward pass (see embed_docs). Each chunk's vectors are written in one transaction.
+    Docs longer than one 512-token window are truncated, or split into overlapping windows and
+    pooled with long_doc_mode 'mean' / 'length_weighted'. Only docs embedded from then on use the
+    new mode, vectors already in data.db are kept: after switching modes run with
+    reset_question_vector so the whole corpus shares one embedding space.
+    Docs whose (model, doc text) hash is already in the embedding cache skip the model entirely.
+    
+    Args:
+        chunk_size: Records read, embedded and committed together
+        batch_size: Sequences (windows) per SciBERT forward pass
+        long_doc_mode: One of LONG_DOC_MODES
+        window_overlap: Tokens shared by consecutive windows of a long doc
+    
+    Returns:
+        {'records', 'embedded', 'long_docs', 'cache_hits', 'seconds', 'sequences_per_sec'}
     """
-    scibert_tokenizer = AutoTokenizer.from_pretrained("allenai/scibert_scivocab_uncased")
-    scibert_model = AutoModel.from_pretrained("allenai/scibert_scivocab_uncased")
+    if long_doc_mode not in LONG_DOC_MODES:
+        raise ValueError(f"Unknown long_doc_mode {long_doc_mode}, expected one of {LONG_DOC_MODES}")
+    # Identifies how a doc was turned into a vector, part of the embedding cache key
+    model_variant = f"{get_model_variant(SCIBERT_MODEL_NAME)}|cls:max_length=512"
+    if long_doc_mode != 'truncate':
+        model_variant += f":{long_doc_mode}:overlap={window_overlap}"
     db = initialize_and_fetch_db()
+    cache_db = open_embedding_cache()
     processed_count = 0
+    embedded_count = 0
+    long_doc_count = 0
+    window_count = 0
+    doc_lengths = []
+    cache_hits = 0
+    total_tokens = 0
+    total_padded_tokens = 0
+    inference_seconds = 0.0
+    last_question_id = ''
+    start = time.time()
     
-    print("Starting vectorization process with SciBERT...")
+    print(f"Starting vectorization process with SciBERT (chunk_size={chunk_size}, batch_size={batch_size})...")
     
     while True:
-        # Get next record that needs vectorization
-        record = get_empty_vector_record(db)
+        records = get_empty_vector_records(db, chunk_size, last_question_id)
         
         # Break if no more records need processing
-        if record is None:
-            print(f"Vectorization complete! Processed {processed_count} records.")
+        if not records:
             break
+        last_question_id = records[-1][0]
         
-        question_id = record.get('question_id', '')
-        doc = record.get('doc', '')
-        
-        # If doc doesn't exist, skip this record
-        if not doc or doc == '':
-            print(f"Skipping record {question_id}: no doc field found")
-            record['question_vector'] = np.zeros(768, dtype=np.float32)
-            upsert_question_record(db, record)
-            processed_count += 1
-            continue
-        
-        # Tokenize and encode with SciBERT
-        inputs = scibert_tokenizer(
-            doc,
-            max_length=512,
-            truncation=True,
-            padding=True,
-            return_tensors="pt"
-        )
-        
-        with torch.no_grad():
-            outputs = scibert_model(**inputs)
-            # Use [CLS] token embedding as the document representation
-            embedding = outputs.last_hidden_state[:, 0, :].squeeze()
-            embedding = embedding.cpu().numpy()
+        vectors = {}
+        # Records without a doc get a zero vector
+        for question_id, doc in records:
+            if not doc:
+                print(f"Skipping record {question_id}: no doc field found")
+                vectors[question_id] = np.zeros(768, dtype=np.float32)
         
-        # Update the record with computed values
-        record['question_vector'] = embedding
+        # Docs embedded before (by any question, in any run) are served from the cache,
+        # identical docs within the chunk are embedded once
+        cache_keys = {question_id: embedding_cache_key(model_variant, doc) for question_id, doc in records if doc}
+        cached = lookup_embeddings(cache_db, list(set(cache_keys.values())))
+        cache_hits += sum(cache_key in cached for cache_key in cache_keys.values())
+        to_embed = {}
+        for question_id, doc in records:
+            if doc and cache_keys[question_id] not in cached:
+                to_embed.setdefault(cache_keys[question_id], doc)
         
-        # Save back to database
-        success = upsert_question_record(db, record)
+        if to_embed:
+            # SciBERT is only loaded (and warmed up) once a doc misses the cache
+            warm_up_models([SCIBERT_MODEL_NAME])
+            scibert_tokenizer, scibert_model = get_scibert()
+            inference_start = time.time()
+            result = embed_docs(scibert_tokenizer, scibert_model, list(to_embed.values()), batch_size,
+                                long_doc_mode=long_doc_mode, window_overlap=window_overlap)
+            inference_seconds += time.time() - inference_start
+            new_embeddings = dict(zip(to_embed.keys(), result['embeddings']))
+            store_embeddings(cache_db, model_variant, new_embeddings)
+            cached.update(new_embeddings)
+            embedded_count += len(to_embed)
+            long_doc_count += result['long_docs']
+            window_count += result['windows']
+            doc_lengths.extend(result['doc_lengths'])
+            total_tokens += result['tokens']
+            total_padded_tokens += result['padded_tokens']
+        vectors.update((question_id, cached[cache_key]) for question_id, cache_key in cache_keys.items())
         
-        if success:
-            processed_count += 1
-            print(f"Processed record {processed_count}: {question_id}")
-            # print(f"  - Doc length: {len(doc)} chars")
-            # print(f"  - SciBERT embedding shape: {embedding.shape}")
-        else:
-            print(f"Failed to save record: {question_id}")
+        saved = save_question_vectors(db, vectors)
+        processed_count += saved
+        if saved < len(vectors):
+            print(f"Failed to save {len(vectors) - saved}/{len(vectors)} vectors of this chunk")
+        print(f"Processed {processed_count} records, "
+              f"{embedded_count / inference_seconds if inference_seconds > 0 else 0:.1f} sequences/sec")
+    
+    total_time = time.time() - start
+    print(f"Vectorization complete! Processed {processed_count} records in {total_time:.2f}s.")
+    print(f"  - Embedding cache: {cache_hits} hits, {embedded_count} docs embedded "
+          f"({cache_hits / (cache_hits + embedded_count) if cache_hits + embedded_count else 0:.1%} hit rate)")
+    if embedded_count:
+        print(f"  - {embedded_count} sequences embedded in {inference_seconds:.2f}s "
+              f"({embedded_count / inference_seconds:.1f} sequences/sec, {total_tokens / inference_seconds:.0f} tokens/sec)")
+        print(f"  - Padding efficiency: {total_tokens / total_padded_tokens:.1%} of processed tokens were real")
+        print(f"  - {long_doc_count} docs longer than one window embedded as {window_count - embedded_count + long_doc_count} "
+              f"windows ({long_doc_mode}), {window_count} windows in total")
+        print_token_length_histogram(doc_lengths)
+    
+    cache_db.close()
+    db.close()
+    return {
+        'records': processed_count,
+        'embedded': embedded_count,
+        'long_docs': long_doc_count,
+        'cache_hits': cache_hits,
+        'seconds': total_time,
+        'sequences_per_sec': embedded_count / inference_seconds if inference_seconds > 0 else 0.0
+    }
+
+def fill_question_features(chunk_size: int = 512, workers: int = None, parse_timeout: float = 2.0) -> Dict[str, float]:
+    """
+    Fills is_math and keywords for every record that has none yet, from its question and answer text.
+    
+    Records are read chunk_size at a time and their texts extracted in one batch across a process
+    pool (see text_features.extract_text_features), with at most parse_timeout seconds per
+    latex2sympy parse. Results are cached by text hash, each chunk is committed in one transaction.
+    The workers are spawned rather than forked, so they never inherit the BLIP / SciBERT weights
+    this process may already hold.
+    
+    Args:
+        chunk_size: Records read, extracted and committed together
+        workers: Extraction processes (default: half the CPU cores)
+        parse_timeout: Seconds allowed for one latex2sympy parse
+    
+    Returns:
+        {'records', 'extracted', 'cache_hits', 'timeouts', 'seconds', 'records_per_sec'}
+    """
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 2) // 2)
+    db = initialize_and_fetch_db()
+    cache_db = open_feature_cache()
+    totals = {'records': 0, 'extracted': 0, 'cache_hits': 0, 'timeouts': 0}
+    last_question_id = ''
+    start = time.time()
+    
+    print(f"Starting text feature extraction (chunk_size={chunk_size}, workers={workers}, parse_timeout={parse_timeout}s)...")
+    
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        while True:
+            raw_records = get_empty_feature_records(db, chunk_size, last_question_id)
+            if not raw_records:
+                break
+            last_question_id = raw_records[-1]['question_id']
+            
+            # Malformed records get empty features so they are not picked up again
+            features = {}
+            texts = {}
+            for raw_record in raw_records:
+                try:
+                    record = simplify_question_record(raw_record)
+                    texts[raw_record['question_id']] = f"{record['question_text']} {record['answer_text']}".strip()
+                except Exception as e:
+                    print(f"Error processing record {raw_record['question_id']}: {e}")
+                    features[raw_record['question_id']] = (False, [])
+            
+            extracted, stats = extract_text_features(list(texts.values()), cache_db, pool, parse_timeout)
+            features.update(zip(texts.keys(), extracted))
+            saved = save_question_features(db, features)
+            
+            totals['records'] += saved
+            totals['extracted'] += stats['extracted']
+            totals['cache_hits'] += stats['cache_hits']
+            totals['timeouts'] += stats['timeouts']
+            print(f"Processed {totals['records']} records, {totals['records'] / (time.time() - start):.1f} records/sec")
+            if saved < len(features):
+                print(f"Failed to save {len(features) - saved}/{len(features)} features of this chunk")
+    
+    total_time = time.time() - start
+    print(f"Text feature extraction complete! Processed {totals['records']} records in {total_time:.2f}s.")
+    print(f"  - Feature cache: {totals['cache_hits']} hits, {totals['extracted']} texts extracted "
+          f"({totals['cache_hits'] / (totals['cache_hits'] + totals['extracted']) if totals['cache_hits'] + totals['extracted'] else 0:.1%} hit rate)")
+    print(f"  - {totals['timeouts']} latex2sympy parses hit the {parse_timeout}s time limit")
     
+    cache_db.close()
     db.close()
+    return dict(totals, seconds=total_time, records_per_sec=totals['records'] / total_time if total_time > 0 else 0.0)
 
 def main():
     """
@@ -0,0 +1,84 @@
+# vector_store.py
+import json
+import typing
+import numpy as np
+
+# question_vector is stored as raw little-endian float32 bytes (768 dims -> 3 KB instead of ~10 KB of JSON text)
+VECTOR_DTYPE = np.dtype('<f4')
+# Columns holding an embedding, encoded on the way into SQLite regardless of the table
+VECTOR_COLUMNS = {'question_vector'}
+
+def encode_vector(vector) -> bytes:
+    """
+    Encodes a vector (numpy array or list of floats) as a little-endian float32 BLOB.
+    """
+    return np.asarray(vector, dtype=VECTOR_DTYPE).tobytes()
+
+def decode_vector(value) -> typing.Union[np.ndarray, None]:
+    """
+    Decodes a stored question_vector into a float32 numpy array.
+
+    BLOBs are wrapped with np.frombuffer without copying (the result is read-only).
+    JSON text (rows written before the BLOB migration, or vectors as they arrive from Supabase)
+    and plain lists are still accepted. Missing values return None.
+    """
+    if value is None:
+        return None
+    if isinstance(value, (bytes, memoryview)):
+        return np.frombuffer(value, dtype=VECTOR_DTYPE)
+    if isinstance(value, str):
+        if not value.strip():
+            return None
+        value = json.loads(value)
+    return np.asarray(value, dtype=VECTOR_DTYPE)
+
+def encode_vector_value(value) -> typing.Union[bytes, None]:
+    """
+    Normalizes any stored or received vector representation into the BLOB stored locally.
+    """
+    vector = decode_vector(value)
+    if vector is None:
+        return None
+    return encode_vector(vector)
+
+def vector_to_json(value) -> typing.Union[str, None]:
+    """
+    Serializes a stored vector back to the JSON text array Supabase expects (conversion happens at the edge).
+    """
+    vector = decode_vector(value)
+    if vector is None:
+        return None
+    return json.dumps(vector.tolist())
+
+def stack_vectors(values: typing.Iterable, dimensions: typing.Union[int, None] = None) -> np.ndarray:
+    """
+    Decodes stored vectors into one dense float32 matrix. Missing vectors become zero rows,
+    shorter vectors are zero padded to the longest one (or to dimensions when given).
+    """
+    vectors = [decode_vector(value) for value in values]
+    if dimensions is None:
+        dimensions = max((len(vector) for vector in vectors if vector is not None), default=0)
+
+    matrix = np.zeros((len(vectors), dimensions), dtype=VECTOR_DTYPE)
+    for row, vector in enumerate(vectors):
+        if vector is not None:
+            length = min(len(vector), dimensions)
+            matrix[row, :length] = vector[:length]
+    return matrix
+
+def load_question_vector_matrix(db) -> typing.Tuple[typing.Dict[str, int], np.ndarray]:
+    """
+    Loads every question_answer_pairs vector once as a dense float32 matrix.
+
+    Returns:
+        (row_index, matrix): row_index maps question_id -> row of matrix, matrix has shape (n_questions, dims)
+    """
+    cursor = db.cursor()
+    cursor.execute("""
+        SELECT question_id, question_vector FROM question_answer_pairs
+        WHERE question_vector IS NOT NULL
+        ORDER BY question_id
+    """)
+    rows = cursor.fetchall()
+    row_index = {question_id: row for row, (question_id, _) in enumerate(rows)}
+    return row_index, stack_vectors(question_vector for _, question_vector in rows)